@@ -0,0 +1,470 @@
+# -----------------------------------------------------------------------------
+# Checkmarx intrumentation metrics for Prometheus
+# End to end scrape benchmark
+#
+# Starts the exporter against a local fake SAST, with injected latency
+# and payload size, drives /metrics with concurrent scrapers at a fixed
+# rate and reports scrape latency, throughput, cpu and memory over time
+#
+# usage:    python cxbench.py [options], see python cxbench.py --help
+# -----------------------------------------------------------------------------
+
+
+# IMPORTS
+try:
+    import sys
+    import os
+    import json
+    import time
+    import datetime
+    import random
+    import math
+    import threading
+    import subprocess
+    import tempfile
+    import shutil
+    import argparse
+    import urllib.request
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+except ImportError:
+    print("Could not load needed modules, exiting...")
+    sys.exit(65)
+
+# Optional, process cpu and memory on any platform (/proc is used otherwise, on linux)
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+
+
+
+# ------------------------------------------------------------------
+# General constants
+# ------------------------------------------------------------------
+__author__          = "Joao Costa"
+__version__         = "1.0.0"
+__date__            = "February 2020"
+__maintainer__      = "Joao Costa"
+__email__           = "joao.costa@checmarx.com"
+__status__          = "Production"
+
+
+
+
+# ------------------------------------------------------------------
+# Global vars
+# ------------------------------------------------------------------
+_exporter       = "cxprometheus.py"     # Exporter script, in this script folder
+_reportfolder   = "reports"             # Folder where the benchmark reports are written
+_percentiles    = [ 50, 90, 95, 99 ]
+_starttimeout   = 30                    # Seconds to wait for the exporter to answer
+_scrapetimeout  = 60                    # Seconds a scrape may take
+
+
+
+
+# ------------------------------------------------------------------
+# Percentile
+# ------------------------------------------------------------------
+# usage:    nearest-rank percentile over a list of values
+# values:   the values, not required to be sorted
+# pct:      the percentile, 0 to 100
+# returns:  the percentile value, or None for an empty list
+# ------------------------------------------------------------------
+def percentile( values, pct ):
+    if (values == []):
+        return None
+    svalues = sorted(values)
+    idx = int( math.ceil( (pct / 100.0) * len(svalues) ) ) - 1
+    if (idx < 0):
+        idx = 0
+    return round( svalues[idx], 3 )
+
+
+
+# ------------------------------------------------------------------
+# The fake SAST
+# ------------------------------------------------------------------
+# Answers the REST calls the exporter makes (token, engineServers,
+# scansQueue), with a fixed engines farm and scans queue, after the
+# injected latency (milliseconds, with up to 20% jitter). Scans can
+# be padded to make the payload larger
+# ------------------------------------------------------------------
+class CxFakeSAST(object):
+
+    def __init__(self, engines = 4, scans = 100, latency = 0, padding = 0):
+        self.latency    = latency
+        self.requests   = 0
+        self.lock       = threading.Lock()
+        self.engines    = [ { "id": idx, "name": "engine" + str(idx), "uri": "http://127.0.0.1:1/engine" + str(idx),
+                              "minLoc": 0 if (idx == 1) else (idx - 1) * 100000, "maxLoc": idx * 200000,
+                              "maxScans": 2, "cxVersion": "9.0", "status": { "id": 1, "value": "Idle" } }
+                            for idx in range(1, engines + 1) ]
+        self.payloads   = dict()
+        self.payloads["/cxrestapi/sast/engineServers"] = json.dumps( self.engines ).encode('utf-8')
+        self.payloads["/cxrestapi/sast/scansQueue"] = json.dumps( self.makescans( scans, padding ) ).encode('utf-8')
+        self.payloads["/cxrestapi/auth/identity/connect/token"] = json.dumps( { "token_type": "Bearer", "access_token": "benchmark", "expires_in": 86400 } ).encode('utf-8')
+        self.server     = None
+
+    def makescans(self, count, padding):
+        # Scans spread over the stages, the running ones filling the engines slots first
+        rng  = random.Random( 1 )
+        now  = time.time()
+        iso  = lambda t: datetime.datetime.fromtimestamp(t).strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3]
+        slots = [ engine["id"] for engine in self.engines for slot in range(engine["maxScans"]) ]
+        scans = []
+        for idx in range(count):
+            created = now - rng.uniform( 60, 7200 )
+            if (idx < len(slots)):
+                stage, engine = 4, { "id": slots[idx], "link": None }
+            else:
+                stage, engine = rng.choice( [ 1, 2, 3, 3, 3, 7, 9, 10 ] ), None
+            scan = { "id": 100000 + idx, "stage": { "id": stage, "value": "" }, "engine": engine,
+                     "project": { "id": idx % 50, "name": "project" + str(idx % 50) }, "teamId": "1",
+                     "loc": rng.randint( 1000, 400000 ), "dateCreated": iso(created),
+                     "queuedOn": iso(created + 30) if (stage not in [1, 2, 10]) else None,
+                     "engineStartedOn": iso(created + 60) if (stage >= 4) and (stage <= 9) else None,
+                     "completedOn": iso(now - 10) if (stage in [7, 9]) else None }
+            if (padding > 0):
+                scan["comment"] = "x" * padding
+            scans.append( scan )
+        return scans
+
+    def start(self):
+        fake = self
+        class handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+            def answer(self):
+                fake.lock.acquire()
+                try:
+                    fake.requests += 1
+                finally:
+                    fake.lock.release()
+                if (fake.latency > 0):
+                    time.sleep( fake.latency * random.uniform( 0.8, 1.2 ) / 1000.0 )
+                payload = fake.payloads.get( self.path.split("?")[0] )
+                if (payload == None):
+                    self.send_response( 404 )
+                    self.send_header( "Content-Length", "0" )
+                    self.end_headers()
+                    return
+                self.send_response( 200 )
+                self.send_header( "Content-Type", "application/json" )
+                self.send_header( "Content-Length", str(len(payload)) )
+                self.end_headers()
+                self.wfile.write( payload )
+            def do_GET(self):
+                self.answer()
+            def do_POST(self):
+                self.rfile.read( int(self.headers.get("Content-Length", 0)) )
+                self.answer()
+        self.server = ThreadingHTTPServer( ( "127.0.0.1", 0 ), handler )
+        self.server.daemon_threads = True
+        threading.Thread( target = self.server.serve_forever, name = "fakesast", daemon = True ).start()
+        return self.server.server_address[1]
+
+    def stop(self):
+        if (self.server != None):
+            self.server.shutdown()
+            self.server.server_close()
+
+
+
+# ------------------------------------------------------------------
+# Process usage
+# ------------------------------------------------------------------
+# usage:    cpu seconds and resident memory of a process and its
+#           children (worker processes), with psutil or from /proc
+# returns:  ( cpu seconds, rss bytes ), ( None, None ) if unavailable
+# ------------------------------------------------------------------
+def processusage( pid ):
+    if (psutil != None):
+        try:
+            processes = [ psutil.Process(pid) ]
+            processes = processes + processes[0].children( recursive = True )
+            cpu = 0.0
+            rss = 0
+            for process in processes:
+                times = process.cpu_times()
+                cpu = cpu + times.user + times.system
+                rss = rss + process.memory_info().rss
+            return cpu, rss
+        except psutil.Error:
+            return None, None
+    if (not os.path.isdir("/proc")):
+        return None, None
+    ticks    = os.sysconf( "SC_CLK_TCK" )
+    pagesize = os.sysconf( "SC_PAGE_SIZE" )
+    cpu = 0.0
+    rss = 0
+    pids = [ pid ]
+    try:
+        while (pids != []):
+            ppid = pids.pop()
+            fp = open( "/proc/" + str(ppid) + "/stat", 'r' )
+            try:
+                fields = fp.read().rsplit( ")", 1 )[1].split()
+            finally:
+                fp.close()
+            cpu = cpu + ( int(fields[11]) + int(fields[12]) ) / ticks
+            rss = rss + int(fields[21]) * pagesize
+            for task in os.listdir( "/proc/" + str(ppid) + "/task" ):
+                fp = open( "/proc/" + str(ppid) + "/task/" + task + "/children", 'r' )
+                try:
+                    pids = pids + [ int(child) for child in fp.read().split() ]
+                finally:
+                    fp.close()
+    except (OSError, IndexError, ValueError):
+        return None, None
+    return cpu, rss
+
+
+
+# ------------------------------------------------------------------
+# The benchmark class
+# ------------------------------------------------------------------
+# Runs the scrapers against the exporter and samples its process
+# every second, keeping the time series for the report
+# ------------------------------------------------------------------
+class CxBenchmark(object):
+
+    def __init__(self, url, pid, scrapers, rate, duration):
+        self.url        = url
+        self.pid        = pid
+        self.scrapers   = scrapers
+        self.rate       = rate                  # Scrapes per second, per scraper
+        self.duration   = duration
+        self.lock       = threading.Lock()
+        self.latencies  = []                    # Scrape latencies, in seconds
+        self.window     = []                    # Latencies of the current second
+        self.errors     = 0
+        self.late       = 0                     # Scrapes started after their schedule
+        self.bytes      = 0
+        self.timeseries = []
+
+    def scrape(self, index):
+        # Fixed rate, each scraper offset within the interval
+        interval = 1.0 / self.rate
+        start    = self.started + interval * index / self.scrapers
+        count    = 0
+        while (True):
+            scheduled = start + count * interval
+            if (scheduled - self.started >= self.duration):
+                break
+            wait = scheduled - time.time()
+            if (wait > 0):
+                time.sleep( wait )
+            elif (wait < -interval):
+                self.lock.acquire()
+                self.late += 1
+                self.lock.release()
+            count = count + 1
+            clock = time.time()
+            try:
+                response = urllib.request.urlopen( self.url, timeout = _scrapetimeout )
+                content  = response.read()
+                ok = (response.status == 200)
+            except Exception:
+                content = b""
+                ok = False
+            latency = time.time() - clock
+            self.lock.acquire()
+            try:
+                if (ok):
+                    self.latencies.append( latency )
+                    self.window.append( latency )
+                    self.bytes += len(content)
+                else:
+                    self.errors += 1
+            finally:
+                self.lock.release()
+
+    def sample(self, stop):
+        lastcpu, lastat = processusage( self.pid )[0], time.time()
+        while (not stop.wait( 1.0 )):
+            cpu, rss = processusage( self.pid )
+            now = time.time()
+            self.lock.acquire()
+            try:
+                window = self.window
+                self.window = []
+            finally:
+                self.lock.release()
+            point = { 'elapsed': round(now - self.started, 1), 'scrapes': len(window),
+                      'latencyP50Ms': None, 'latencyP99Ms': None, 'cpuPercent': None, 'rssMB': None }
+            if (window != []):
+                point['latencyP50Ms'] = percentile( [ l * 1000 for l in window ], 50 )
+                point['latencyP99Ms'] = percentile( [ l * 1000 for l in window ], 99 )
+            if (cpu != None) and (lastcpu != None):
+                point['cpuPercent'] = round( 100.0 * (cpu - lastcpu) / (now - lastat), 1 )
+                point['rssMB'] = round( rss / 1048576.0, 2 )
+            lastcpu, lastat = cpu, now
+            self.timeseries.append( point )
+
+    def run(self):
+        self.started = time.time()
+        stop    = threading.Event()
+        sampler = threading.Thread( target = self.sample, args = ( stop, ), daemon = True )
+        sampler.start()
+        threads = [ threading.Thread( target = self.scrape, args = ( idx, ), daemon = True ) for idx in range(self.scrapers) ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - self.started
+        stop.set()
+        sampler.join()
+        return self.summarize( elapsed )
+
+    def summarize(self, elapsed):
+        latencies = [ l * 1000 for l in self.latencies ]
+        cpus = [ p['cpuPercent'] for p in self.timeseries if p['cpuPercent'] != None ]
+        rsss = [ p['rssMB'] for p in self.timeseries if p['rssMB'] != None ]
+        res = dict()
+        res['seconds']      = round(elapsed, 2)
+        res['scrapes']      = len(latencies)
+        res['errors']       = self.errors
+        res['late']         = self.late
+        res['throughput']   = round( len(latencies) / elapsed, 3 )
+        res['payloadBytes'] = int( self.bytes / len(latencies) ) if (latencies != []) else 0
+        res['latencyMs']    = dict( [ ('p' + str(p), percentile(latencies, p)) for p in _percentiles ] )
+        res['latencyMs']['mean'] = round( sum(latencies) / len(latencies), 3 ) if (latencies != []) else None
+        res['latencyMs']['max']  = round( max(latencies), 3 ) if (latencies != []) else None
+        res['cpuPercent']   = { 'mean': round( sum(cpus) / len(cpus), 1 ) if (cpus != []) else None, 'max': max(cpus) if (cpus != []) else None }
+        res['rssMB']        = { 'mean': round( sum(rsss) / len(rsss), 2 ) if (rsss != []) else None, 'max': max(rsss) if (rsss != []) else None }
+        return res
+
+
+
+# ------------------------------------------------------------------
+# Free port
+# ------------------------------------------------------------------
+def freeport():
+    import socket
+    sock = socket.socket( socket.AF_INET, socket.SOCK_STREAM )
+    try:
+        sock.bind( ( "127.0.0.1", 0 ) )
+        return sock.getsockname()[1]
+    finally:
+        sock.close()
+
+
+
+# ------------------------------------------------------------------
+# Git revision
+# ------------------------------------------------------------------
+# returns:  the exporter source revision, empty if not in a git tree
+# ------------------------------------------------------------------
+def gitrevision():
+    try:
+        return subprocess.check_output( [ "git", "rev-parse", "--short", "HEAD" ], cwd = os.path.dirname( os.path.abspath(__file__) ),
+                                        stderr = subprocess.DEVNULL ).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+
+# ------------------------------------------------------------------
+# Run benchmark
+# ------------------------------------------------------------------
+# usage:    starts the fake SAST and the exporter, in a temporary
+#           folder with its own configurations, runs the scrapers,
+#           stops everything and writes the benchmark report
+# returns:  the report dictionary
+# ------------------------------------------------------------------
+def runbenchmark( args ):
+    fake = CxFakeSAST( args.engines, args.scans, args.latency, args.padding )
+    sastport = fake.start()
+    promport = freeport()
+    workdir  = tempfile.mkdtemp( prefix = "cxbench" )
+    configs  = { "hostname": "http://127.0.0.1:" + str(sastport), "username": "benchmark", "password": "benchmark",
+                 "promport": promport, "loglevel": 30, "stateinterval": 0 }
+    for item in args.config:
+        key, value = item.split( "=", 1 )
+        try:
+            configs[key] = json.loads( value )
+        except ValueError:
+            configs[key] = value
+    fp = open( os.path.join( workdir, "configs.json" ), 'w' )
+    try:
+        json.dump( configs, fp, indent = 4 )
+    finally:
+        fp.close()
+    exporter = os.path.join( os.path.dirname( os.path.abspath(__file__) ), _exporter )
+    process  = subprocess.Popen( [ sys.executable, exporter ], cwd = workdir )
+    url      = "http://127.0.0.1:" + str(promport) + "/metrics"
+    try:
+        # Wait for the exporter, the first scrape warms it up (logon, engines)
+        deadline = time.time() + _starttimeout
+        while (True):
+            try:
+                urllib.request.urlopen( url, timeout = _scrapetimeout ).read()
+                break
+            except Exception:
+                if (process.poll() != None) or (time.time() > deadline):
+                    raise RuntimeError( "Exporter did not start, see " + os.path.join( workdir, "logs" ) )
+                time.sleep( 0.2 )
+        requests = fake.requests
+        benchmark = CxBenchmark( url, process.pid, args.scrapers, args.rate, args.duration )
+        summary = benchmark.run()
+        summary['sastRequests'] = fake.requests - requests
+    finally:
+        process.terminate()
+        try:
+            process.wait( 30 )
+        except subprocess.TimeoutExpired:
+            process.kill()
+        fake.stop()
+        if (not args.keep):
+            shutil.rmtree( workdir, ignore_errors = True )
+    report = dict()
+    report['label']         = args.label
+    report['revision']      = gitrevision()
+    report['python']        = sys.version.split()[0]
+    report['started']       = datetime.datetime.fromtimestamp( benchmark.started ).isoformat()
+    report['parameters']    = { 'scrapers': args.scrapers, 'rate': args.rate, 'duration': args.duration, 'engines': args.engines,
+                                'scans': args.scans, 'latencyMs': args.latency, 'padding': args.padding,
+                                'sastPayloadBytes': len( fake.payloads["/cxrestapi/sast/scansQueue"] ), 'configs': args.config }
+    report['summary']       = summary
+    report['timeseries']    = benchmark.timeseries
+    return report
+
+
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser( description = "End to end scrape benchmark of the exporter, against a local fake SAST" )
+    parser.add_argument( "--scrapers", type = int, default = 4, help = "concurrent scrapers (default 4)" )
+    parser.add_argument( "--rate", type = float, default = 1.0, help = "scrapes per second, per scraper (default 1)" )
+    parser.add_argument( "--duration", type = float, default = 60, help = "seconds to run (default 60)" )
+    parser.add_argument( "--engines", type = int, default = 4, help = "engines in the fake SAST (default 4)" )
+    parser.add_argument( "--scans", type = int, default = 100, help = "scans in the fake SAST queue (default 100)" )
+    parser.add_argument( "--latency", type = float, default = 0, help = "fake SAST latency per request, in milliseconds (default 0)" )
+    parser.add_argument( "--padding", type = int, default = 0, help = "bytes added to every scan in the queue payload (default 0)" )
+    parser.add_argument( "--config", action = "append", default = [], metavar = "KEY=VALUE", help = "exporter configuration, json values (repeatable)" )
+    parser.add_argument( "--label", default = "bench", help = "label of the run, in the report name (default bench)" )
+    parser.add_argument( "--output", default = "", help = "report file name (default reports/bench_<label>_<timestamp>.json)" )
+    parser.add_argument( "--keep", action = "store_true", help = "keep the exporter working folder (logs)" )
+    args = parser.parse_args()
+
+    report = runbenchmark( args )
+
+    # Write report
+    reportname = args.output
+    if (reportname == ""):
+        if (not os.path.isdir(_reportfolder)):
+            os.mkdir(_reportfolder)
+        reportname = _reportfolder + os.path.sep + "bench_" + args.label + "_" + datetime.datetime.now().strftime("%Y%m%d_%H%M%S") + ".json"
+    fp = open( reportname, 'w' )
+    try:
+        json.dump( report, fp, indent = 2 )
+    finally:
+        fp.close()
+    summary = report['summary']
+    print( "Scrapes: " + str(summary['scrapes']) + " (" + str(summary['throughput']) + "/s), errors " + str(summary['errors']) )
+    print( "Latency ms: " + json.dumps( summary['latencyMs'] ) )
+    print( "Cpu %: " + json.dumps( summary['cpuPercent'] ) + ", rss MB: " + json.dumps( summary['rssMB'] ) )
+    print( "Report written to " + reportname )
@@ -8,6 +8,11 @@
 # -----------------------------------------------------------------------------
 
 
+# Process start, one shot runs (--once) report their startup time
+import time
+_starttime = time.time()
+
+
 # IMPORTS
 try:
     import sys
@@ -15,16 +20,51 @@ try:
     import json
     import requests
     import threading
-    import time
     import datetime
     import collections
+    import signal
     import logging
-    from prometheus_client.core import GaugeMetricFamily, REGISTRY
-    from prometheus_client import start_http_server, CollectorRegistry
+    import logging.handlers
+    import queue
+    import zlib
+    import bisect
+    import math
+    import struct
+    import mmap
+    import socketserver
+    import wsgiref.simple_server
+    import urllib.parse
+    import hmac
+    import io
+    import marshal
+    import tempfile
+    import http.client
+    import ssl
+    import heapq
+    import itertools
+    from prometheus_client.core import GaugeMetricFamily, CounterMetricFamily, HistogramMetricFamily, REGISTRY
+    from prometheus_client import make_wsgi_app, CollectorRegistry, generate_latest
 except ImportError:
     print("Could not load needed modules, exiting...")
     sys.exit(65)
 
+# Modules only needed by some features, imported once configured (see importmodules)
+# so that one shot runs start fast
+numpy           = None                  # Optional, columnar processing of very large scan queues
+snappy          = None                  # Optional, remote write compression (uncompressed snappy framing otherwise)
+multiprocessing = None                  # Worker processes
+concurrent      = None                  # Engine servers probes
+cProfile        = None                  # On demand profiling
+pstats          = None
+tracemalloc     = None
+
+# File locks, for the replicas coordination
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
 
 
 
@@ -51,6 +91,41 @@ _promport   = 9700                  # Prometheus listening port
 _loglevel   = 20                    # Log level (10=Debug, 20=Info, 30=Warning, 40=Error, 50=Critical)
 _configfile = "configs.json"        # File name holding configurations
 _logfile    = "cxprometheus.log"    # File name holding log entries (path is ./logs)
+_logrotate  = "size"                # Log rotation, by "size" or by "time" (daily, at midnight)
+_logmaxsize = 10485760              # Log file size triggering rotation, in bytes, when rotating by size
+_logbackups = 5                     # Number of rotated log files to keep
+_loglistener = None                 # Background thread writing the queued log records
+_loghandler  = None                 # Log file handler, kept to change its level on reload
+_targets     = collections.OrderedDict()    # SAST targets in use, name -> connection details and generation
+_labeltarget = False                # Metrics carry a "target" label, when several targets are configured
+_workers     = 0                    # Worker processes running the targets collection (0 = in-process)
+_workertimeout = 120                # Seconds to wait for a worker process to answer
+# Columnar processing: from columnar scans in the queue on, the scans durations (metrics 2
+# to 5) are computed over numpy columns rather than one scan at a time, with the same
+# samples. Needs numpy (see requirements.txt), without it scans are processed one by one
+_columnar    = 0                    # Scans queue size from which scans are processed as numpy columns (0 = never)
+_textfile    = "cxprometheus.prom"  # File the one shot runs (--once) write, for the node_exporter textfile collector
+_probeinterval = 0                  # Seconds between engine servers health probes (0 = no probes)
+_probetimeout  = 2                  # Seconds an engine server probe may take
+_probeworkers  = 256                # Engine servers probed in parallel, at most (a probes round takes probetimeout seconds per probeworkers unreachable engines)
+_estimatorwindow = 3600             # Seconds over which the scan durations and completions estimates decay (time constant)
+_seriesbudget  = 0                  # Series exposed per scan metric, at most, or budgets by metric name (0 = no limit)
+_enrichment    = False              # Scan metrics labeled with project and team names, from SAST scan, project and team details
+_enrichttl     = 3600               # Seconds scan, project and team details are cached
+_enrichcache   = 10000              # Details cached, at most, the least recently used dropped first
+_enrichworkers = 8                  # Details requested in parallel, at most
+
+
+
+
+# ------------------------------------------------------------------
+# Local vars for configurations reload
+# ------------------------------------------------------------------
+_configlock  = threading.Lock()     # Guards the configurations being replaced at once
+_configgen   = 0                    # Incremented each time the SAST connection details change
+_configs     = None                 # The configurations in use, as read from the file
+_configmtime = 0                    # Configurations file modification time, when last loaded
+_reloadevent = threading.Event()    # Set on SIGHUP, to reload configurations on the main loop
 
 
 
@@ -66,7 +141,7 @@ _metric1_labels     = [ "engineId", "engineName", "engineScan", "status" ]
 
 # Queue duration metric gauge
 # Value is duration in minutes
-_metricx_labels     = [ "scanId", "engineId", "engineName", "locMin", "locMax" ]
+_metricx_labels     = [ "scanId", "engineId", "engineName", "locMin", "locMax", "projectName", "teamName" ]
 
 _metric2_name       = "checkmarx_sast_scans_pulling"
 _metric2_desc       = "Checkmarx sast scans pulling workload in minutes"
@@ -80,15 +155,278 @@ _metric4_desc       = "Checkmarx sast scans scanning workload in minutes"
 _metric5_name       = "checkmarx_sast_scans_full"
 _metric5_desc       = "Checkmarx sast scans full workload in minutes"
 
+# Scan throughput counters, from stage transitions between polls
+# Value is the number of scans (exposed with the _total suffix)
+_metric6_name       = "checkmarx_sast_scans_started"
+_metric6_desc       = "Checkmarx sast scans started on an engine"
+_metric6_labels     = [ "engineId" ]
+
+_metric7_name       = "checkmarx_sast_scans_finished"
+_metric7_desc       = "Checkmarx sast scans finished, by result (finished, canceled, failed, or unknown when the scan left the queue unseen)"
+_metric7_labels     = [ "engineId", "result" ]
+
+# Completed scans duration histograms
+# Values are durations in minutes
+_metric8_name       = "checkmarx_sast_scans_queue_wait_minutes"
+_metric8_desc       = "Checkmarx sast scans time queued before starting on an engine, in minutes"
+_metric8_labels     = [ "engineId" ]
+_metric8_buckets    = [ 1, 2, 5, 10, 15, 30, 60, 120, 240, 480 ]
+
+_metric9_name       = "checkmarx_sast_scans_duration_minutes"
+_metric9_desc       = "Checkmarx sast scans time scanning on an engine, in minutes"
+_metric9_labels     = [ "engineId" ]
+_metric9_buckets    = [ 1, 5, 10, 15, 30, 60, 120, 240, 480, 960 ]
+
+# Engines capacity and utilization gauges, pre-aggregated
+# Values are number of scan slots, scans or a ratio (0 to 1)
+_metricy_labels     = [ "engineId", "engineName" ]
+_metricz_labels     = [ "locMin", "locMax" ]
+
+_metric10_name      = "checkmarx_sast_engine_slots"
+_metric10_desc      = "Checkmarx sast engine concurrent scan slots"
+
+_metric11_name      = "checkmarx_sast_engine_slots_busy"
+_metric11_desc      = "Checkmarx sast engine scan slots in use"
+
+_metric12_name      = "checkmarx_sast_engine_scans_queued"
+_metric12_desc      = "Checkmarx sast scans queued for the engine"
+
+_metric13_name      = "checkmarx_sast_engine_utilization"
+_metric13_desc      = "Checkmarx sast engine scan slots in use ratio"
+
+_metric14_name      = "checkmarx_sast_slots"
+_metric14_desc      = "Checkmarx sast concurrent scan slots, all engines"
+
+_metric15_name      = "checkmarx_sast_slots_busy"
+_metric15_desc      = "Checkmarx sast scan slots in use, all engines"
+
+_metric16_name      = "checkmarx_sast_queue_length"
+_metric16_desc      = "Checkmarx sast number of scans queued, all engines"
+
+_metric17_name      = "checkmarx_sast_utilization"
+_metric17_desc      = "Checkmarx sast scan slots in use ratio, all engines"
+
+_metric18_name      = "checkmarx_sast_loc_band_slots"
+_metric18_desc      = "Checkmarx sast concurrent scan slots of the engines serving a lines of code band"
+
+_metric19_name      = "checkmarx_sast_loc_band_slots_busy"
+_metric19_desc      = "Checkmarx sast scan slots in use of the engines serving a lines of code band"
+
+# Engines health, probing the engine servers endpoints (see probeinterval)
+# Values are 1 (reachable) or 0, and the probe latency in seconds
+_metric20_name      = "checkmarx_sast_engine_reachable"
+_metric20_desc      = "Checkmarx sast engine server answering on its endpoint (1) or not (0)"
+
+_metric21_name      = "checkmarx_sast_engine_probe_seconds"
+_metric21_desc      = "Checkmarx sast engine server endpoint probe latency, in seconds"
+
+# Streaming estimates of the scan durations and completions, by engine (see CxSketch)
+# and the queue wait a new scan can expect, by engine and by LOC band
+# Values are in minutes, and scans per minute for the service rate
+_metric22_name      = "checkmarx_sast_engine_scan_minutes_estimate"
+_metric22_desc      = "Checkmarx sast engine scan duration estimates (mean, p50, p90), in minutes, over the estimator window"
+_metric22_labels    = [ "engineId", "engineName", "estimate" ]
+
+_metric23_name      = "checkmarx_sast_engine_service_rate"
+_metric23_desc      = "Checkmarx sast engine scans completed per minute, over the estimator window"
+
+_metric24_name      = "checkmarx_sast_engine_queue_wait_forecast_minutes"
+_metric24_desc      = "Checkmarx sast engine forecast wait of a new scan for a slot, in minutes"
+
+_metric25_name      = "checkmarx_sast_loc_band_queue_wait_forecast_minutes"
+_metric25_desc      = "Checkmarx sast forecast wait of a new scan for a slot of the engines serving a lines of code band, in minutes"
+
+# Pre-aggregated eligibility gauges, by lines of code band, the bands split at every engine minLoc and maxLoc
+_metric26_name      = "checkmarx_sast_loc_band_eligible_free_slots"
+_metric26_desc      = "Checkmarx sast free slots of the engines able to take a scan with lines of code in the band, bands split at the engines minLoc and maxLoc"
+
+_metric27_name      = "checkmarx_sast_loc_band_queued_demand"
+_metric27_desc      = "Checkmarx sast scans queued with lines of code in the band, bands split at the engines minLoc and maxLoc"
+
+# Series dropped over the series budget gauge
+_metricb1_name      = "checkmarx_sast_series_dropped"
+_metricb1_desc      = "Checkmarx sast scan series over the series budget, left out and aggregated in the scanId=other series"
+_metricb1_labels    = [ "metric" ]
+
+# Scan durations sketch buckets upper bounds, in minutes, log spaced (25% apart, up to 50 hours)
+_sketchbounds       = [ 0.5 * 1.25 ** idx for idx in range(40) ]
+
+# Scan result by final stage
+_scanresults        = { 7: "finished", 8: "canceled", 9: "failed" }
+
+# Metric families, in exposition order
+_metrics            = [ ( _metric1_name, _metric1_desc, _metric1_labels, "gauge" ),
+                        ( _metric2_name, _metric2_desc, _metricx_labels, "gauge" ),
+                        ( _metric3_name, _metric3_desc, _metricx_labels, "gauge" ),
+                        ( _metric4_name, _metric4_desc, _metricx_labels, "gauge" ),
+                        ( _metric5_name, _metric5_desc, _metricx_labels, "gauge" ),
+                        ( _metric6_name, _metric6_desc, _metric6_labels, "counter" ),
+                        ( _metric7_name, _metric7_desc, _metric7_labels, "counter" ),
+                        ( _metric8_name, _metric8_desc, _metric8_labels, "histogram" ),
+                        ( _metric9_name, _metric9_desc, _metric9_labels, "histogram" ),
+                        ( _metric10_name, _metric10_desc, _metricy_labels, "gauge" ),
+                        ( _metric11_name, _metric11_desc, _metricy_labels, "gauge" ),
+                        ( _metric12_name, _metric12_desc, _metricy_labels, "gauge" ),
+                        ( _metric13_name, _metric13_desc, _metricy_labels, "gauge" ),
+                        ( _metric14_name, _metric14_desc, [], "gauge" ),
+                        ( _metric15_name, _metric15_desc, [], "gauge" ),
+                        ( _metric16_name, _metric16_desc, [], "gauge" ),
+                        ( _metric17_name, _metric17_desc, [], "gauge" ),
+                        ( _metric18_name, _metric18_desc, _metricz_labels, "gauge" ),
+                        ( _metric19_name, _metric19_desc, _metricz_labels, "gauge" ),
+                        ( _metric20_name, _metric20_desc, _metricy_labels, "gauge" ),
+                        ( _metric21_name, _metric21_desc, _metricy_labels, "gauge" ),
+                        ( _metric22_name, _metric22_desc, _metric22_labels, "gauge" ),
+                        ( _metric23_name, _metric23_desc, _metricy_labels, "gauge" ),
+                        ( _metric24_name, _metric24_desc, _metricy_labels, "gauge" ),
+                        ( _metric25_name, _metric25_desc, _metricz_labels, "gauge" ),
+                        ( _metric26_name, _metric26_desc, _metricz_labels, "gauge" ),
+                        ( _metric27_name, _metric27_desc, _metricz_labels, "gauge" ) ]
+
+# Metric families with one series per scan, limited by the series budget
+_scanmetrics        = [ _metric2_name, _metric3_name, _metric4_name, _metric5_name ]
+
+
+
+
+# ------------------------------------------------------------------
+# Local vars for authentication token management
+# ------------------------------------------------------------------
+_tokenmaxage = 1400             # seconds a token is reused before a new logon
+
+
+
+
+# ------------------------------------------------------------------
+# Local vars for engine servers probes
+# ------------------------------------------------------------------
+# One TLS context for all the probes, accepting self-signed certificates
+_probecontext = ssl.SSLContext( ssl.PROTOCOL_TLS_CLIENT )
+_probecontext.check_hostname = False
+_probecontext.verify_mode    = ssl.CERT_NONE
+
+
+
+
+# ------------------------------------------------------------------
+# Local vars for collector state persistence
+# ------------------------------------------------------------------
+_statefile      = "cxprometheus.state"  # File name holding collector state snapshots (path is ./state)
+_stateinterval  = 60                    # Seconds between state snapshots (0 disables persistence)
+_statemaxlines  = 100                   # Snapshots appended to the state file before it is compacted
+_statelines     = 0                     # Snapshots currently in the state file
+_statelast      = ""                    # Last snapshot written, to skip unchanged ones
+
+
+
+
+# ------------------------------------------------------------------
+# Local vars for on demand profiling
+# ------------------------------------------------------------------
+_profiling      = False                 # Profiling endpoint (/debug/profile) enabled
+_profiletoken   = ""                    # Bearer token required by the profiling endpoint, mandatory when enabled
+_profiler       = None                  # Profile capturing the next collection cycles, None when inactive
+_profileresult  = None                  # Last profile finished, ready to download
+_profilelock    = threading.Lock()      # Guards starting and finishing profiles
+_profilemaxcycles = 100                 # Collection cycles a profile can capture, at most
+_profileinterval = 0.005                # Seconds between stack samples, on sampling profiles
+_profileformats = { "cprofile": [ "pstats", "text" ], "sampling": [ "collapsed" ], "tracemalloc": [ "text", "snapshot" ] }
+
+
+
+
+# ------------------------------------------------------------------
+# Local vars for scan events ingestion
+# ------------------------------------------------------------------
+_events         = False                 # Scan events endpoint (/events) enabled
+_eventstoken    = ""                    # Bearer token required by the events endpoint, mandatory when enabled
+_reconcileinterval = 300                # Seconds between full polls reconciling the events, when enabled
+_eventsmax      = 1000                  # Events accepted in one request, at most
+_eventsmaxsize  = 1048576               # Events request size accepted, at most, in bytes
+_stageids       = { "New": 1, "PreScan": 2, "Queued": 3, "Scanning": 4, "PostScan": 6, "Finished": 7,
+                    "Canceled": 8, "Failed": 9, "SourcePullingAndDeployment": 10 }
+
+
+
+
+# ------------------------------------------------------------------
+# Local vars for background polling and replicas coordination
+# ------------------------------------------------------------------
+_pollinterval   = 0                     # Seconds between background polls (0 = poll on each scrape)
+_pollmin        = 0                     # Seconds between background polls, at least, while the queue is active (0 = pollinterval)
+_pollmax        = 0                     # Seconds between background polls, at most, while the queue is unchanged (0 = pollinterval)
+_sharedsnapshot = ""                    # Snapshot file shared by replicas, only one of them polling (empty = no replicas)
+_sharedmagic    = b"CXPS"               # Shared snapshot file header: magic, sequence, timestamp, payload length
+_sharedheader   = struct.Struct( "<4sQdQ" )
+
+# Exporter metrics gauges, when polling in background
+_metricp1_name      = "checkmarx_sast_exporter_poller"
+_metricp1_desc      = "Checkmarx sast exporter polling SAST (1) or serving the snapshot of another replica (0)"
+
+_metricp2_name      = "checkmarx_sast_exporter_snapshot_age_seconds"
+_metricp2_desc      = "Checkmarx sast exporter age of the snapshot served, in seconds"
+
+_metricp3_name      = "checkmarx_sast_exporter_poll_interval_seconds"
+_metricp3_desc      = "Checkmarx sast exporter current interval between polls, in seconds"
+
+
+
+
+# ------------------------------------------------------------------
+# Local vars for remote write push
+# ------------------------------------------------------------------
+_remotewrite        = ""                # Prometheus remote write endpoint the metrics are pushed to (empty = pull only)
+_remotewriteheaders = {}                # Additional HTTP headers of the remote write requests (authorization, tenant)
+_remotewritelabels  = { "job": "cxprometheus" }    # Labels added to every series pushed, as the scrape would
+_remotewritebatch   = 1000              # Samples per remote write request, at most
+_remotewriteflush   = 15                # Seconds between flushes of the samples polled
+_remotewritebuffer  = 100000            # Samples kept for retrying, at most, the oldest being dropped
+_remotewritespool   = ""                # File keeping the samples not yet sent across restarts (empty = memory only)
+_remotewritetimeout = 30                # Seconds a remote write request may take
+_remotewritebackoff = 300               # Seconds between retries, at most, while the endpoint fails
+
+# Exporter metrics, when pushing
+_metricr1_name      = "checkmarx_sast_exporter_remote_write_pending_samples"
+_metricr1_desc      = "Checkmarx sast exporter samples waiting to be pushed"
+
+_metricr2_name      = "checkmarx_sast_exporter_remote_write_sent_samples"
+_metricr2_desc      = "Checkmarx sast exporter samples pushed"
+
+_metricr3_name      = "checkmarx_sast_exporter_remote_write_dropped_samples"
+_metricr3_desc      = "Checkmarx sast exporter samples dropped, buffer full or rejected by the endpoint"
+
+_metricr4_name      = "checkmarx_sast_exporter_remote_write_failures"
+_metricr4_desc      = "Checkmarx sast exporter remote write requests failed, to be retried"
+
 
 
 
 # ------------------------------------------------------------------
-# Local vars for authentication token thread sharing management
+# Local vars for one shot runs (--once)
 # ------------------------------------------------------------------
-_token      = ""                # token
-_tokenread  = 0                 # timestamp the token was last read
-_tokenlock  = threading.Lock()  # threading
+# Exporter metrics gauges, written with the collected ones
+_metrico1_name      = "checkmarx_sast_exporter_startup_seconds"
+_metrico1_desc      = "Checkmarx sast exporter one shot run startup, from process start to collection, in seconds"
+
+_metrico2_name      = "checkmarx_sast_exporter_collection_seconds"
+_metrico2_desc      = "Checkmarx sast exporter one shot run collection time, in seconds"
+
+_metrico3_name      = "checkmarx_sast_exporter_last_run_timestamp_seconds"
+_metrico3_desc      = "Checkmarx sast exporter one shot run time, since epoch"
+
+
+
+
+# ------------------------------------------------------------------
+# Local vars for the query api
+# ------------------------------------------------------------------
+_api            = False                 # Query api (/api) enabled, answering from the last snapshot collected
+_apitoken       = ""                    # Bearer token required by the query api, if not empty
+_apilimit       = 1000                  # Scans answered by query, by default
+_apistages      = collections.OrderedDict( [ ( _metric2_name, "pulling" ), ( _metric3_name, "queued" ), ( _metric4_name, "scanning" ) ] )
+_apiengines     = collections.OrderedDict( [ ( _metric10_name, "slots" ), ( _metric11_name, "busy" ), ( _metric12_name, "queued" ),
+                                             ( _metric13_name, "utilization" ), ( _metric20_name, "reachable" ),
+                                             ( _metric21_name, "probeSeconds" ), ( _metric24_name, "queueWaitForecastMinutes" ) ] )
 
 
 
@@ -102,10 +440,11 @@ _tokenlock  = threading.Lock()  # threading
 #           can be prefixed with "http://" or "https://""
 #           can be suffixed with a port number in the form ":port"
 #           if not prefixed then http:// is assumed
+# session:  optional requests session, to reuse connections
 # returns   on success the authentication bearer token usabled for future calls
 #           on error an empty string
 # ------------------------------------------------------------------
-def cxlogon( hostname = "", username = "", password = "" ):
+def cxlogon( hostname = "", username = "", password = "", session = None ):
     logger = logging.getLogger('cxprometheus')    
     stoken  = ""
     sapipath = hostname.lower()
@@ -122,17 +461,17 @@ def cxlogon( hostname = "", username = "", password = "" ):
                 'scope':'sast_rest_api',
                 'client_id':'resource_owner_client',
                 'client_secret':'014DF517-39D1-4453-B7B3-9930C563627C' }
-    logger.debug( "Logon at " + sapipath )
+    logger.debug( "Logon at %s", sapipath )
     try:
         # Post request to host, accepting self-signed certificates
-        sresponse = requests.post( sapipath, data = sbody, headers = shead, verify = False )
+        sender = session if (session != None) else requests
+        sresponse = sender.post( sapipath, data = sbody, headers = shead, verify = False )
         if (sresponse.status_code not in [200, 201, 202]):
-            logger.error( "Logon response: " + str(sresponse.status_code) + ", " + sresponse.text )
+            logger.error( "Logon response: %s, %s", sresponse.status_code, sresponse.text )
             return ""
     except Exception as err:       
         # This is a critical failure as it is unable to talk to SAST
-        serr = str(err)
-        logger.critical( "Logon: " + serr ) 
+        logger.critical( "Logon: %s", err )
         raise
     # Get token from returned data
     sjson = sresponse.json()
@@ -142,7 +481,7 @@ def cxlogon( hostname = "", username = "", password = "" ):
     skeyval = sjson["access_token"]
     if (skeyval != "") :
         stoken = skeykind + ' ' + skeyval
-    logger.debug( "Logon: " + skeykind + " token was retreieved successfully" )        
+    logger.debug( "Logon: %s token was retreieved successfully", skeykind )        
     return stoken 
 
 
@@ -160,9 +499,10 @@ def cxlogon( hostname = "", username = "", password = "" ):
 # apitoken: a valid Bearer token. (see: cxauthy.py)
 #           when present, version will be retrieved via REST
 #           call to engine servers information
+# session:  optional requests session, to reuse connections
 # returns:  engines list
 # ------------------------------------------------------------------
-def cxgetengines( hostname = "", apitoken = "" ):
+def cxgetengines( hostname = "", apitoken = "", session = None ):
     logger = logging.getLogger('cxprometheus')
     sapipath = hostname.lower()
     if ( sapipath.startswith('http://') == False ) and ( sapipath.startswith('https://') == False ) :
@@ -173,23 +513,23 @@ def cxgetengines( hostname = "", apitoken = "" ):
         sapipath = sapipath + "/cxrestapi/sast/engineServers"
     shead = {'Content-Type':'application/json', 'Authorization':apitoken }
     sbody = {}
-    logger.debug( "Get engines at " + sapipath )
+    logger.debug( "Get engines at %s", sapipath )
     try:
         # Get request to host, accepting self-signed certificates
-        sresponse = requests.get( sapipath, data = sbody, headers = shead, verify = False )
+        sender = session if (session != None) else requests
+        sresponse = sender.get( sapipath, data = sbody, headers = shead, verify = False )
         if (sresponse.status_code not in [200, 201, 202]):
-            logger.error( "Get engines response: " + str(sresponse.status_code) + ", " + sresponse.text )
+            logger.error( "Get engines response: %s, %s", sresponse.status_code, sresponse.text )
             return []
     except Exception as err:
-        serr = str(err)
-        logger.error( "Get engines: " + serr )
+        logger.error( "Get engines: %s", err )
         raise
     # Process result json
     engines = json.loads(sresponse.content)
     if (engines == []):
         logger.debug( "Get engines: no engines found" )
     else:
-        logger.debug( "Get engines: retrieved " + str(len(engines)) + " engine(s)" )
+        logger.debug( "Get engines: retrieved %d engine(s)", len(engines) )
     return engines
 
 
@@ -207,9 +547,10 @@ def cxgetengines( hostname = "", apitoken = "" ):
 # apitoken: a valid Bearer token. (see: cxauthy.py)
 #           when present, version will be retrieved via REST
 #           call to engine servers information
-# returns:  queue list
+# session:  optional requests session, to reuse connections
+# returns:  queue list, None if the queue could not be read
 # ------------------------------------------------------------------
-def cxgetscansqueue( hostname = "", apitoken = "" ):
+def cxgetscansqueue( hostname = "", apitoken = "", session = None ):
     logger = logging.getLogger('cxprometheus')
     sapipath = hostname.lower()
     if ( sapipath.startswith('http://') == False ) and ( sapipath.startswith('https://') == False ) :
@@ -220,70 +561,468 @@ def cxgetscansqueue( hostname = "", apitoken = "" ):
         sapipath = sapipath + "/cxrestapi/sast/scansQueue"
     shead = {'Content-Type':'application/json', 'Authorization':apitoken }
     sbody = {}
-    logger.debug( "Get scan queue at " + sapipath )
+    logger.debug( "Get scan queue at %s", sapipath )
     try:
         # Get request to host, accepting self-signed certificates
-        sresponse = requests.get( sapipath, data = sbody, headers = shead, verify = False )
+        sender = session if (session != None) else requests
+        sresponse = sender.get( sapipath, data = sbody, headers = shead, verify = False )
         if (sresponse.status_code not in [200, 201, 202]):
-            logger.error( "Get scan queue response: " + str(sresponse.status_code) + ", " + sresponse.text )
-            return []
+            logger.error( "Get scan queue response: %s, %s", sresponse.status_code, sresponse.text )
+            return None
     except Exception as err:
-        serr = str(err)
-        logger.error( "Get scan queue: " + serr )
+        logger.error( "Get scan queue: %s", err )
         raise
     # Process result json
     sscans = json.loads(sresponse.content)
     if (sscans == []):
         logger.debug( "Get scan queue: no scans found in queue" )
     else:
-        logger.debug( "Get scan queue: retrieved " + str(len(sscans)) + " scan(s) in queue" )
+        logger.debug( "Get scan queue: retrieved %d scan(s) in queue", len(sscans) )
     return sscans
 
 
 
 
 # ------------------------------------------------------------------
-# Common configurations on external json file
+# SAST details
 # ------------------------------------------------------------------
-# filename: the file where the configurations are stored
-#           see const_configs for default
-# returns   success true or false
+# usage:    retrieves the details of a scan, a project or the teams
+#           using REST, as in "sast/scans/1001", "projects/5" or
+#           "auth/teams"
+# hostname: can be the host or the ip address
+#           can be prefixed with "http://" or "https://""
+#           can be suffixed with a port number in the form ":port"
+#           if not prefixed then http:// is assumed
+# apitoken: a valid Bearer token. (see: cxauthy.py)
+# resource: the REST resource path, after cxrestapi/
+# session:  optional requests session, to reuse connections
+# returns:  the details json, None if they could not be read
 # ------------------------------------------------------------------
-def loadconfigurations():
-    global _promport
-    global _hostname
-    global _username
-    global _password
-    global _loglevel
+def cxgetdetails( hostname = "", apitoken = "", resource = "", session = None ):
+    logger = logging.getLogger('cxprometheus')
+    sapipath = hostname.lower()
+    if ( sapipath.startswith('http://') == False ) and ( sapipath.startswith('https://') == False ) :
+        sapipath = "http://" + sapipath
+    if ( sapipath.endswith( '/') ) :
+        sapipath = sapipath + "cxrestapi/" + resource
+    else :
+        sapipath = sapipath + "/cxrestapi/" + resource
+    shead = {'Content-Type':'application/json', 'Authorization':apitoken }
+    logger.debug( "Get details at %s", sapipath )
+    try:
+        # Get request to host, accepting self-signed certificates
+        sender = session if (session != None) else requests
+        sresponse = sender.get( sapipath, headers = shead, verify = False )
+        if (sresponse.status_code not in [200, 201, 202]):
+            logger.error( "Get details %s response: %s, %s", resource, sresponse.status_code, sresponse.text )
+            return None
+        return json.loads(sresponse.content)
+    except Exception as err:
+        logger.error( "Get details %s: %s", resource, err )
+        return None
 
-    # Configurations file
+
+
+
+# ------------------------------------------------------------------
+# Log level pre-processing
+# ------------------------------------------------------------------
+# loglevel: the log level, as found in the configurations
+# returns   the log level rounded up to a known level
+# ------------------------------------------------------------------
+def normalizeloglevel( loglevel = 20 ):
+    if (loglevel <= 0):
+        return 100                          # Out of scope, no logs
+    elif (loglevel <= logging.DEBUG):      
+        return logging.DEBUG                # 10
+    elif (loglevel <= logging.INFO):
+        return logging.INFO                 # 20
+    elif (loglevel <= logging.WARNING):
+        return logging.WARNING              # 30
+    elif (loglevel <= logging.ERROR):
+        return logging.ERROR                # 40
+    elif (loglevel <= logging.CRITICAL):
+        return logging.CRITICAL             # 50
+    else:
+        return 100                          # Out of scope, no logs
+
+
+
+
+# ------------------------------------------------------------------
+# Read configurations from external json file
+# ------------------------------------------------------------------
+# Reads the configurations file without applying it, so it can be
+# validated first, either at start or when reloading
+# returns   dictionary with all configurations, defaults included
+# ------------------------------------------------------------------
+def readconfigurations():
+    sdict = dict()
     if (os.path.exists(_configfile)):
         fp = open(_configfile, 'r')
         try:
             sdict = json.load(fp)
-            _hostname = sdict.get('hostname', '')
-            _username = sdict.get('username', '')
-            _password = sdict.get('password', '' )
-            _promport = sdict.get('promport', 9700)
-            _loglevel = sdict.get('loglevel', 20)
         finally:
             fp.close()
+    configs = dict()
+    configs['hostname']     = sdict.get('hostname', '')
+    configs['username']     = sdict.get('username', '')
+    configs['password']     = sdict.get('password', '' )
+    configs['promport']     = sdict.get('promport', 9700)
+    configs['loglevel']     = sdict.get('loglevel', 20)
+    if (type(configs['loglevel']) in [ int, float ]):
+        configs['loglevel'] = normalizeloglevel( configs['loglevel'] )
+    configs['logrotate']    = sdict.get('logrotate', "size")
+    configs['logmaxsize']   = sdict.get('logmaxsize', 10485760)
+    configs['logbackups']   = sdict.get('logbackups', 5)
+    configs['stateinterval'] = sdict.get('stateinterval', 60)
+    configs['workers']      = sdict.get('workers', 0)
+    configs['columnar']     = sdict.get('columnar', 0)
+    configs['textfile']     = sdict.get('textfile', 'cxprometheus.prom')
+    configs['probeinterval'] = sdict.get('probeinterval', 0)
+    configs['probetimeout'] = sdict.get('probetimeout', 2)
+    configs['probeworkers'] = sdict.get('probeworkers', 256)
+    configs['estimatorwindow'] = sdict.get('estimatorwindow', 3600)
+    configs['seriesbudget'] = sdict.get('seriesbudget', 0)
+    configs['enrichment']   = sdict.get('enrichment', False)
+    configs['enrichttl']    = sdict.get('enrichttl', 3600)
+    configs['enrichcache']  = sdict.get('enrichcache', 10000)
+    configs['enrichworkers'] = sdict.get('enrichworkers', 8)
+    configs['profiling']    = sdict.get('profiling', False)
+    configs['profiletoken'] = sdict.get('profiletoken', '')
+    configs['events']       = sdict.get('events', False)
+    configs['eventstoken']  = sdict.get('eventstoken', '')
+    configs['api']          = sdict.get('api', False)
+    configs['apitoken']     = sdict.get('apitoken', '')
+    configs['reconcileinterval'] = sdict.get('reconcileinterval', 300)
+    configs['pollinterval'] = sdict.get('pollinterval', 0)
+    configs['sharedsnapshot'] = sdict.get('sharedsnapshot', '')
+    configs['pollmin']      = sdict.get('pollmin', 0)
+    configs['pollmax']      = sdict.get('pollmax', 0)
+    configs['remotewrite']  = sdict.get('remotewrite', '')
+    configs['remotewriteheaders'] = sdict.get('remotewriteheaders', {})
+    configs['remotewritelabels']  = sdict.get('remotewritelabels', { "job": "cxprometheus" })
+    configs['remotewritebatch']   = sdict.get('remotewritebatch', 1000)
+    configs['remotewriteflush']   = sdict.get('remotewriteflush', 15)
+    configs['remotewritebuffer']  = sdict.get('remotewritebuffer', 100000)
+    configs['remotewritespool']   = sdict.get('remotewritespool', '')
+    # Several SAST instances can be aggregated, each one being a named target
+    # credentials not given for a target are the top level ones
+    # without targets, the top level SAST is the only (unnamed) target
+    configs['labeltarget']  = ('targets' in sdict)
+    targets = list()
+    if (configs['labeltarget']):
+        for starget in sdict.get('targets', []):
+            targets.append( { 'name':       str(starget.get('name', '')),
+                              'hostname':   starget.get('hostname', ''),
+                              'username':   starget.get('username', configs['username']),
+                              'password':   starget.get('password', configs['password']) } )
+    else:
+        targets.append( { 'name':       '',
+                          'hostname':   configs['hostname'],
+                          'username':   configs['username'],
+                          'password':   configs['password'] } )
+    configs['targets']      = targets
+    return configs
+
+
 
-    # Pre-process log level
-    if (_loglevel <= 0):
-        _loglevel = 100                     # Out of scope, no logs
-    elif (_loglevel <= logging.DEBUG):      
-        _loglevel = logging.DEBUG           # 10
-    elif (_loglevel <= logging.INFO):
-        _loglevel = logging.INFO            # 20
-    elif (_loglevel <= logging.WARNING):
-        _loglevel = logging.WARNING         # 30
-    elif (_loglevel <= logging.ERROR):
-        _loglevel = logging.ERROR           # 40
-    elif (_loglevel <= logging.CRITICAL):
-        _loglevel = logging.CRITICAL        # 50
+
+# ------------------------------------------------------------------
+# Check configurations
+# ------------------------------------------------------------------
+# configs:  dictionary with configurations (see readconfigurations)
+# returns   list of errors found, empty if none
+# ------------------------------------------------------------------
+def checkconfigurations( configs ):
+    _errors = list()
+    # Values of another type are reported alone, the checks below compare them
+    types = [ ( [ int ],        "an integer",       [ 'promport', 'loglevel', 'logmaxsize', 'logbackups', 'workers', 'columnar', 'probeworkers',
+                                                      'enrichcache', 'enrichworkers', 'remotewritebatch', 'remotewritebuffer' ] ),
+              ( [ int, float ], "a number",         [ 'stateinterval', 'probeinterval', 'probetimeout', 'estimatorwindow', 'enrichttl',
+                                                      'reconcileinterval', 'pollinterval', 'pollmin', 'pollmax', 'remotewriteflush' ] ),
+              ( [ str ],        "a string",         [ 'hostname', 'username', 'password', 'logrotate', 'textfile', 'profiletoken', 'eventstoken',
+                                                      'apitoken', 'sharedsnapshot', 'remotewrite', 'remotewritespool' ] ),
+              ( [ bool ],       "true or false",    [ 'enrichment', 'profiling', 'events', 'api' ] ),
+              ( [ dict ],       "an object",        [ 'remotewriteheaders', 'remotewritelabels' ] ) ]
+    for expected, description, keys in types:
+        for key in keys:
+            if (type(configs[key]) not in expected):
+                _errors.append( "Invalid value in configuration (" + key + "), shall be " + description )
+    if (configs['labeltarget']):
+        for target in configs['targets']:
+            for key in [ 'hostname', 'username', 'password' ]:
+                if (type(target[key]) != str):
+                    _errors.append( "Invalid value in configuration (targets, " + target['name'] + ", " + key + "), shall be a string" )
+    if (_errors != []):
+        return _errors
+    if (not configs['labeltarget']):
+        if (configs['hostname'] == ""):
+            _errors.append( "Missing SAST host name in configuration (hostname)" )
+        if (configs['username'] == ""):
+            _errors.append( "Missing SAST user name in configuration (username)" )
+        if (configs['password'] == ""):
+            _errors.append( "Missing SAST user credentials in configuration (password)" )
+    else:
+        if (configs['targets'] == []):
+            _errors.append( "Missing SAST targets in configuration (targets)" )
+        names = set()
+        for target in configs['targets']:
+            if (target['name'] == ""):
+                _errors.append( "Missing target name in configuration (targets, name)" )
+            elif (target['name'] in names):
+                _errors.append( "Duplicated target name in configuration (targets, " + target['name'] + ")" )
+            names.add( target['name'] )
+            if (target['hostname'] == ""):
+                _errors.append( "Missing SAST host name in configuration (targets, " + target['name'] + ", hostname)" )
+            if (target['username'] == ""):
+                _errors.append( "Missing SAST user name in configuration (targets, " + target['name'] + ", username)" )
+            if (target['password'] == ""):
+                _errors.append( "Missing SAST user credentials in configuration (targets, " + target['name'] + ", password)" )
+    if (configs['workers'] < 0):
+        _errors.append( "Invalid number of worker processes in configuration (workers)" )
+    if (configs['columnar'] < 0):
+        _errors.append( "Invalid scans queue size for columnar processing in configuration (columnar)" )
+    if (configs['probeinterval'] < 0) or (configs['probetimeout'] <= 0) or (configs['probeworkers'] <= 0):
+        _errors.append( "Invalid engine probes interval, timeout or parallelism in configuration (probeinterval, probetimeout, probeworkers)" )
+    if (configs['estimatorwindow'] <= 0):
+        _errors.append( "Invalid estimator window in configuration (estimatorwindow)" )
+    if (type(configs['seriesbudget']) == dict):
+        budgets = configs['seriesbudget']
     else:
-        _loglevel = 100                     # Out of scope, no logs
+        budgets = { _metric2_name: configs['seriesbudget'] }
+    for name, budget in budgets.items():
+        if (name not in _scanmetrics) or (type(budget) != int) or (budget < 0):
+            _errors.append( "Invalid series budget in configuration (seriesbudget), a number or numbers by scan metric name" )
+            break
+    if (configs['enrichttl'] <= 0) or (configs['enrichcache'] <= 0) or (configs['enrichworkers'] <= 0):
+        _errors.append( "Invalid details cache time to live, size or parallelism in configuration (enrichttl, enrichcache, enrichworkers)" )
+    if (configs['profiling']) and (configs['profiletoken'] == ""):
+        _errors.append( "Profiling endpoint (profiling) requires a bearer token in configuration (profiletoken)" )
+    if (configs['events']) and (configs['eventstoken'] == ""):
+        _errors.append( "Scan events endpoint (events) requires a bearer token in configuration (eventstoken)" )
+    if (configs['reconcileinterval'] <= 0):
+        _errors.append( "Invalid reconciliation interval in configuration (reconcileinterval)" )
+    if (configs['pollinterval'] < 0):
+        _errors.append( "Invalid poll interval in configuration (pollinterval)" )
+    if (configs['sharedsnapshot'] != "") and (configs['pollinterval'] <= 0):
+        _errors.append( "Replicas sharing a snapshot (sharedsnapshot) require a poll interval in configuration (pollinterval)" )
+    if (configs['pollmin'] < 0) or (configs['pollmax'] < 0) or \
+       ((configs['pollmin'] or configs['pollinterval']) > (configs['pollmax'] or configs['pollinterval'])):
+        _errors.append( "Invalid poll interval bounds in configuration (pollmin, pollmax), shall be pollmin <= pollmax" )
+    if (configs['remotewrite'] != "") and (not configs['remotewrite'].lower().startswith( ("http://", "https://") )):
+        _errors.append( "Invalid remote write endpoint in configuration (remotewrite), shall be an http or https url" )
+    if (configs['remotewrite'] != "") and (configs['pollinterval'] <= 0):
+        _errors.append( "Remote write (remotewrite) requires background polling in configuration (pollinterval)" )
+    if (configs['remotewritebatch'] <= 0) or (configs['remotewriteflush'] <= 0):
+        _errors.append( "Invalid remote write batch size or flush interval in configuration (remotewritebatch, remotewriteflush)" )
+    if (configs['remotewritebuffer'] < configs['remotewritebatch']):
+        _errors.append( "Invalid remote write buffer in configuration (remotewritebuffer), shall hold one batch at least" )
+    if (configs['promport'] <= 0):
+        _errors.append( "Missing prometheus exporter port in configuration (promport)" )
+    if (configs['logrotate'] not in [ "size", "time" ]):
+        _errors.append( "Invalid log rotation in configuration (logrotate), shall be size or time" )
+    return _errors
+
+
+
+
+# ------------------------------------------------------------------
+# Apply configurations
+# ------------------------------------------------------------------
+# Sets the global vars from a configurations dictionary, all at once
+# configs:  dictionary with configurations (see readconfigurations)
+# ------------------------------------------------------------------
+def applyconfigurations( configs ):
+    global _promport
+    global _hostname
+    global _username
+    global _password
+    global _loglevel
+    global _logrotate
+    global _logmaxsize
+    global _logbackups
+    global _stateinterval
+    global _targets
+    global _labeltarget
+    global _workers
+    global _columnar
+    global _textfile
+    global _probeinterval
+    global _probetimeout
+    global _probeworkers
+    global _estimatorwindow
+    global _seriesbudget
+    global _enrichment
+    global _enrichttl
+    global _enrichcache
+    global _enrichworkers
+    global _profiling
+    global _profiletoken
+    global _events
+    global _eventstoken
+    global _api
+    global _apitoken
+    global _reconcileinterval
+    global _pollinterval
+    global _sharedsnapshot
+    global _pollmin
+    global _pollmax
+    global _remotewrite
+    global _remotewriteheaders
+    global _remotewritelabels
+    global _remotewritebatch
+    global _remotewriteflush
+    global _remotewritebuffer
+    global _remotewritespool
+    global _configgen
+    global _configs
+
+    _configlock.acquire()
+    try:
+        # A new connection generation invalidates the token in use
+        targets = collections.OrderedDict()
+        for target in configs['targets']:
+            previous = _targets.get( target['name'] )
+            if (previous != None) and (previous['hostname'] == target['hostname']) and \
+               (previous['username'] == target['username']) and (previous['password'] == target['password']):
+                targetgen = previous['gen']
+            else:
+                _configgen = _configgen + 1
+                targetgen = _configgen
+            targets[target['name']] = { 'hostname': target['hostname'], 'username': target['username'],
+                                        'password': target['password'], 'gen': targetgen }
+        _targets    = targets
+        _labeltarget = configs['labeltarget']
+        _workers    = configs['workers']
+        _columnar   = configs['columnar']
+        _textfile   = configs['textfile']
+        _probeinterval = configs['probeinterval']
+        _probetimeout = configs['probetimeout']
+        _probeworkers = configs['probeworkers']
+        _estimatorwindow = configs['estimatorwindow']
+        _seriesbudget = configs['seriesbudget']
+        _enrichment = configs['enrichment']
+        _enrichttl  = configs['enrichttl']
+        _enrichcache = configs['enrichcache']
+        _enrichworkers = configs['enrichworkers']
+        _profiling  = configs['profiling']
+        _profiletoken = configs['profiletoken']
+        _events     = configs['events']
+        _eventstoken = configs['eventstoken']
+        _api        = configs['api']
+        _apitoken   = configs['apitoken']
+        _reconcileinterval = configs['reconcileinterval']
+        _pollinterval = configs['pollinterval']
+        _sharedsnapshot = configs['sharedsnapshot']
+        _pollmin    = configs['pollmin']
+        _pollmax    = configs['pollmax']
+        _remotewrite = configs['remotewrite']
+        _remotewriteheaders = configs['remotewriteheaders']
+        _remotewritelabels = configs['remotewritelabels']
+        _remotewritebatch = configs['remotewritebatch']
+        _remotewriteflush = configs['remotewriteflush']
+        _remotewritebuffer = configs['remotewritebuffer']
+        _remotewritespool = configs['remotewritespool']
+        _configs    = configs
+        _hostname   = configs['hostname']
+        _username   = configs['username']
+        _password   = configs['password']
+        _promport   = configs['promport']
+        _loglevel   = configs['loglevel']
+        _logrotate  = configs['logrotate']
+        _logmaxsize = configs['logmaxsize']
+        _logbackups = configs['logbackups']
+        _stateinterval = configs['stateinterval']
+    finally:
+        _configlock.release()
+    importmodules()
+
+
+
+
+# ------------------------------------------------------------------
+# Import modules
+# ------------------------------------------------------------------
+# Imports the modules needed by the features configured, the ones
+# not used being never imported. Optional modules not installed are
+# left as None
+# ------------------------------------------------------------------
+def importmodules():
+    global numpy
+    global snappy
+    global multiprocessing
+    global concurrent
+    global cProfile
+    global pstats
+    global tracemalloc
+
+    if (_columnar > 0) and (numpy == None):
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+    if (_remotewrite != "") and (snappy == None):
+        try:
+            import snappy
+        except ImportError:
+            snappy = None
+    if (_workers > 0) and (multiprocessing == None):
+        import multiprocessing
+    if ((_probeinterval > 0) or (_enrichment)) and (concurrent == None):
+        import concurrent.futures
+    if (_profiling) and (cProfile == None):
+        import cProfile
+        import pstats
+        import tracemalloc
+
+
+
+
+# ------------------------------------------------------------------
+# Get connection
+# ------------------------------------------------------------------
+# target:   the target name, empty for the single unnamed target
+# returns   a consistent set of SAST connection details, as a tuple
+#           ( hostname, username, password, generation )
+#           with an empty hostname if the target is no longer configured
+# ------------------------------------------------------------------
+def getconnection( target = "" ):
+    _configlock.acquire()
+    try:
+        starget = _targets.get( target )
+        if (starget == None):
+            return ( "", "", "", 0 )
+        return ( starget['hostname'], starget['username'], starget['password'], starget['gen'] )
+    finally:
+        _configlock.release()
+
+
+
+
+# ------------------------------------------------------------------
+# Common configurations on external json file
+# ------------------------------------------------------------------
+# filename: the file where the configurations are stored
+#           see const_configs for default
+# once:     true for one shot runs (--once), without the long running
+#           features (polling, replicas, push, probes, endpoints)
+# returns   success true or false
+# ------------------------------------------------------------------
+def loadconfigurations( once = False ):
+    global _loglistener
+    global _loghandler
+    global _configmtime
+
+    # Configurations file
+    if (os.path.exists(_configfile)):
+        _configmtime = os.path.getmtime(_configfile)
+    configs = readconfigurations()
+    # Long running features do not apply to one shot runs
+    if (once):
+        configs.update( { 'pollinterval': 0, 'sharedsnapshot': "", 'remotewrite': "", 'probeinterval': 0,
+                          'profiling': False, 'events': False, 'api': False } )
+    applyconfigurations( configs )
 
     # Check log folder
     if (os.path.exists('logs')):
@@ -297,29 +1036,35 @@ def loadconfigurations():
     logger = logging.getLogger('cxprometheus')
     #logger.setLevel(logging.INFO)
     logger.setLevel(_loglevel)
-    # create a file handler
-    handler = logging.FileHandler(logfilename)
+    # create a rotating file handler
+    if (_logrotate == "time"):
+        handler = logging.handlers.TimedRotatingFileHandler(logfilename, when = 'midnight', backupCount = _logbackups)
+    else:
+        handler = logging.handlers.RotatingFileHandler(logfilename, maxBytes = _logmaxsize, backupCount = _logbackups)
     handler.setLevel(_loglevel)
     # create a logging format
     formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
     #formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
     handler.setFormatter(formatter)
-    # add the file handler to the logger
-    logger.addHandler(handler)
+    # the file is written by a background thread, records are only queued by the callers
+    logqueue = queue.SimpleQueue()
+    logger.addHandler(logging.handlers.QueueHandler(logqueue))
+    _loghandler  = handler
+    _loglistener = logging.handlers.QueueListener(logqueue, handler, respect_handler_level = True)
+    _loglistener.start()
 
-    _errors = list()
     # Check configurations
-    if (_hostname == ""):
-        _errors.append( "Missing SAST host name in configuration (hostname)" )
-    if (_username == ""):
-        _errors.append( "Missing SAST user name in configuration (username)" )
-    if (_password == ""):
-        _errors.append( "Missing SAST user credentials in configuration (password)" )
-    if (_promport <= 0):
-        _errors.append( "Missing prometheus exporter port in configuration (promport)" )
+    _errors = checkconfigurations( configs )
     # Passed :)
     if (_errors == []):
-        logger.info( "Service started, listening on port " + str(_promport) )
+        if (once):
+            logger.info( "One shot run started, writing %s", _textfile )
+        else:
+            logger.info( "Service started, listening on port %s", _promport )
+        if (_columnar > 0) and (numpy == None):
+            logger.warning( "Columnar processing (columnar) requires numpy, scans will be processed one by one" )
+        if (_remotewrite != "") and (snappy == None):
+            logger.warning( "Remote write compression requires python-snappy, requests will be sent uncompressed" )
         return True
     else:
         logger.info( "Unable to start, configurations missing" )
@@ -331,173 +1076,820 @@ def loadconfigurations():
 
 
 # ------------------------------------------------------------------
-# Cleanup
+# Reload configurations
 # ------------------------------------------------------------------
-# Just writes closure to log
+# Re-reads and re-validates the configurations file, applying it at
+# once only if valid. The collector keeps its warm state (token,
+# engines cache) unless the SAST connection details have changed
+# collector: the aggregator, to add or drop targets (see CxAggregator)
+# returns   success true or false
 # ------------------------------------------------------------------
-def cleanup():
+def reloadconfigurations( collector = None ):
     logger = logging.getLogger('cxprometheus')
-    logger.info( "Service stoped" )
+    logger.info( "Reloading configurations from %s", _configfile )
+    try:
+        configs = readconfigurations()
+    except Exception as err:
+        logger.error( "Reload: unable to read configurations, keeping current ones: %s", err )
+        return False
+    # Nothing a reload raises stops the exporter, the configurations in use are kept
+    inuse = _configs
+    try:
+        _errors = checkconfigurations( configs )
+        if (_errors != []):
+            logger.error( "Reload: invalid configurations, keeping current ones" )
+            for _error in _errors:
+                logger.error( _error )
+            return False
+        # Settings bound at start
+        if (configs['labeltarget'] != _labeltarget):
+            logger.error( "Reload: switching between single and multiple targets (targets) requires a restart, keeping current configurations" )
+            return False
+        if (configs['workers'] != _workers):
+            logger.warning( "Reload: worker processes (workers) change requires a restart" )
+            configs['workers'] = _workers
+        if (configs['promport'] != _promport):
+            logger.warning( "Reload: listening port (promport) change requires a restart" )
+            configs['promport'] = _promport
+        if ((configs['pollinterval'] > 0) != (_pollinterval > 0)) or (configs['sharedsnapshot'] != _sharedsnapshot):
+            logger.warning( "Reload: switching background polling (pollinterval) or the shared snapshot (sharedsnapshot) requires a restart" )
+            configs['pollinterval']   = _pollinterval
+            configs['sharedsnapshot'] = _sharedsnapshot
+        if (configs['remotewrite'] != _remotewrite) or (configs['remotewritespool'] != _remotewritespool):
+            logger.warning( "Reload: remote write endpoint (remotewrite) or spool (remotewritespool) change requires a restart" )
+            configs['remotewrite']      = _remotewrite
+            configs['remotewritespool'] = _remotewritespool
+        if (configs['logrotate'] != _logrotate) or (configs['logmaxsize'] != _logmaxsize) or (configs['logbackups'] != _logbackups):
+            logger.warning( "Reload: log rotation (logrotate, logmaxsize, logbackups) change requires a restart" )
+            configs['logrotate']  = _logrotate
+            configs['logmaxsize'] = _logmaxsize
+            configs['logbackups'] = _logbackups
+        for target in configs['targets']:
+            previous = _targets.get( target['name'] )
+            if (previous == None):
+                logger.info( "Reload: target '%s' added", target['name'] )
+            elif (target['hostname'] != previous['hostname']):
+                logger.info( "Reload: target '%s' SAST host changed, cached state will be dropped", target['name'] )
+            elif (target['username'] != previous['username']) or (target['password'] != previous['password']):
+                logger.info( "Reload: target '%s' SAST credentials changed, a new token will be requested", target['name'] )
+        for name in _targets.keys():
+            if (name not in [ target['name'] for target in configs['targets'] ]):
+                logger.info( "Reload: target '%s' removed", name )
+        if (configs['columnar'] > 0) and (numpy == None):
+            logger.warning( "Reload: columnar processing (columnar) requires numpy, scans will be processed one by one" )
+        applyconfigurations( configs )
+        # Log level applies immediately
+        logger.setLevel(_loglevel)
+        if (_loghandler != None):
+            _loghandler.setLevel(_loglevel)
+        # Targets added or removed, engine probes enabled
+        if (collector != None):
+            collector.configure()
+    except Exception as err:
+        logger.error( "Reload: unable to apply configurations, keeping current ones: %s", err )
+        if (_configs is not inuse):
+            applyconfigurations( inuse )
+            logger.setLevel(_loglevel)
+            if (_loghandler != None):
+                _loghandler.setLevel(_loglevel)
+        return False
+    logger.info( "Configurations reloaded" )
+    return True
+
 
 
 
 # ------------------------------------------------------------------
-# The checkmarx collector class
+# Configurations changed
 # ------------------------------------------------------------------
-class CxCollector(object):
+# returns   true if the configurations file was modified since it
+#           was last checked
+# ------------------------------------------------------------------
+def configurationschanged():
+    global _configmtime
+    try:
+        mtime = os.path.getmtime(_configfile)
+    except OSError:
+        return False
+    if (mtime != _configmtime):
+        _configmtime = mtime
+        return True
+    return False
 
-    def __init__(self):
-        logger = logging.getLogger('cxprometheus')
-        logger.debug( "CxCollector: creating new instance (__init__)" )
-        self.enginelist = collections.OrderedDict()
-        # The metrics
-        logger.debug( "CxCollector: creating metric " + _metric1_name )
-        self._metric1 = GaugeMetricFamily( _metric1_name, _metric1_desc, labels=_metric1_labels )
-        logger.debug( "CxCollector: creating metric " + _metric2_name )
-        self._metric2 = GaugeMetricFamily( _metric2_name, _metric2_desc, labels=_metricx_labels )
-        logger.debug( "CxCollector: creating metric " + _metric3_name )
-        self._metric3 = GaugeMetricFamily( _metric3_name, _metric3_desc, labels=_metricx_labels )
-        logger.debug( "CxCollector: creating metric " + _metric4_name )
-        self._metric4 = GaugeMetricFamily( _metric4_name, _metric4_desc, labels=_metricx_labels )
-        logger.debug( "CxCollector: creating metric " + _metric5_name )
-        self._metric5 = GaugeMetricFamily( _metric5_name, _metric5_desc, labels=_metricx_labels )
 
 
-    def gettoken(self):
-        # If the token being used is older than 23.3 hours than get a new one
-        global _token, _tokenread, _tokenlock
-        logger = logging.getLogger('cxprometheus')
-        logger.debug( "CxCollector: running internal gettoken" )
-        _tokenlock.acquire()
-        try:
-            if (_token == "") or (_tokenread == 0) or (time.time() - _tokenread > 1400):
-                if (_token == "") or (_tokenread == 0):
-                    logger.debug( "CxCollector: token is null, calling logon" )
-                elif (time.time() - _tokenread > 1400):
-                    logger.debug( "CxCollector: token is too old, calling logon" )
-                _token = cxlogon( _hostname, _username, _password)
-                if (_token != ""):
-                    _tokenread = time.time()
-        finally:
-            _tokenlock.release()
-        return _token
 
-    def resettoken(self):
-        global _token, _tokenread, _tokenlock
-        logger = logging.getLogger('cxprometheus')
-        logger.debug( "CxCollector: running internal resettoken" )
-        _tokenlock.acquire()
-        try:
-            _token = ""
-            _tokenread = 0
-        finally:
-            _tokenlock.release()
+# ------------------------------------------------------------------
+# Request reload
+# ------------------------------------------------------------------
+# Signal handler (SIGHUP), the reload itself runs on the main loop
+# ------------------------------------------------------------------
+def requestreload( signum, frame ):
+    _reloadevent.set()
 
-    def setenginescan(self, scanid, engineid, scanstatus):
-        logger = logging.getLogger('cxprometheus')
-        logger.debug( "CxCollector: running internal setenginescan" )
-        lfound = False
-        for iengine in self.enginelist.values():
-            if (iengine[0] == engineid) and (iengine[6] == scanid):
-                iengine[7] = scanstatus
-                lfound = True
-                break
-        if (not lfound):
-            for iengine in self.enginelist.values():
-                if (iengine[0] == engineid) and (iengine[6] == 0):
-                    iengine[6] = scanid
-                    iengine[7] = scanstatus
-                    break
 
-    def processdatestring( self, thedate ):
-        if (type(thedate) == str):
-            if ( "." in thedate ):
-                return thedate
-            else:
-                return thedate + ".0"
-        else:
-            return thedate
 
-    def describe(self):
-        logger = logging.getLogger('cxprometheus')
-        logger.debug( "CxCollector: running describe" ) 
-        # The metrics...
-        metric1 = self._metric1
-        metric2 = self._metric2
-        metric3 = self._metric3
-        metric4 = self._metric4
-        metric5 = self._metric5
-        # Yield the metrics
-        yield metric1
-        yield metric2
-        yield metric3        
-        yield metric4
-        yield metric5
-              
-    def collect(self):
-        logger = logging.getLogger('cxprometheus')
-        logger.debug( "CxCollector: running collect" )
-        # The metrics...
-        metric1 = self._metric1
-        metric2 = self._metric2
-        metric3 = self._metric3
-        metric4 = self._metric4
-        metric5 = self._metric5
-        # Grant metrics are clear ...
-        logger.debug( "CxCollector: clear metrics contents" )
-        metric1.samples.clear()
-        metric2.samples.clear()
-        metric3.samples.clear()
-        metric4.samples.clear()
-        metric5.samples.clear()
-
-        # Get authentication token or generate a new one if needed (token shall be valid for 24 hours)
-        apitoken = self.gettoken()
 
-        # Get engines 
-        try:
-            engines = cxgetengines( _hostname, apitoken )
-        except:
-            engines = []            
-        # If no engines returned, recheck authorizations
-        if (engines == []):
-            self.resettoken()
-            apitoken = self.gettoken()
-            engines = cxgetengines( _hostname, apitoken )
+# ------------------------------------------------------------------
+# Save collector state
+# ------------------------------------------------------------------
+# Appends a compact snapshot of the collector warm state to the
+# state file (one json document per line), so that a restart picks
+# up the same engine slot assignments and token. The file is
+# compacted to the last snapshot every _statemaxlines snapshots.
+# Unchanged snapshots are not written.
+# collector: the aggregator (see CxAggregator.getstate)
+# returns   true if a snapshot was written
+# ------------------------------------------------------------------
+def savestate( collector ):
+    global _statelines
+    global _statelast
+    logger = logging.getLogger('cxprometheus')
+    state  = collector.getstate()
+    sstate = json.dumps( state, separators = (',', ':') )
+    if (sstate == _statelast):
+        return False
+    srecord  = '{"time":' + str(time.time()) + ',"state":' + sstate + '}\n'
+    filename = 'state' + os.path.sep + _statefile
+    try:
+        if (not os.path.isdir('state')):
+            os.mkdir('state')
+        if (_statelines <= 0) or (_statelines >= _statemaxlines) or (not os.path.exists(filename)):
+            # Compact, replacing the file with the last snapshot only
+            fd = os.open( filename + ".tmp", os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600 )
+            fp = os.fdopen( fd, 'w' )
+            try:
+                fp.write( srecord )
+                fp.flush()
+                os.fsync( fp.fileno() )
+            finally:
+                fp.close()
+            os.replace( filename + ".tmp", filename )
+            _statelines = 1
+        else:
+            # Append, a torn last line is skipped when loading
+            fd = os.open( filename, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600 )
+            fp = os.fdopen( fd, 'a' )
+            try:
+                fp.write( srecord )
+                fp.flush()
+                os.fsync( fp.fileno() )
+            finally:
+                fp.close()
+            _statelines = _statelines + 1
+    except OSError as err:
+        logger.error( "Save state: %s", err )
+        return False
+    _statelast = sstate
+    logger.debug( "Save state: snapshot written to %s", filename )
+    return True
 
-        if (engines == []):
-            logging.error( "CxCollector: no engines found to process" )
 
-        # Get scans queue
-        scans = cxgetscansqueue( _hostname, apitoken )
 
-        # fp = open( 'data\scans1.txt', 'r')
-        # try:
-        #     scans = json.load(fp)            
-        # finally:
-        #     fp.close()
 
-        # ----------------------------------------------------------------------------------
-        # Process engines metrics, by relating engines to scans
+# ------------------------------------------------------------------
+# Load collector state
+# ------------------------------------------------------------------
+# Restores the collector warm state from the last valid snapshot
+# found in the state file, if any
+# collector: the aggregator (see CxAggregator.setstate)
+# returns   true if a snapshot was restored
+# ------------------------------------------------------------------
+def loadstate( collector ):
+    global _statelines
+    logger = logging.getLogger('cxprometheus')
+    filename = 'state' + os.path.sep + _statefile
+    if (not os.path.exists(filename)):
+        return False
+    try:
+        fp = open(filename, 'r')
+        try:
+            slines = fp.read().splitlines()
+        finally:
+            fp.close()
+    except OSError as err:
+        logger.error( "Load state: %s", err )
+        return False
+    _statelines = len(slines)
+    idx = len(slines) - 1
+    while idx >= 0:
+        try:
+            srecord = json.loads(slines[idx])
+            break
+        except ValueError:
+            idx = idx - 1
+    if (idx < 0):
+        logger.warning( "Load state: no valid snapshot found in %s", filename )
+        return False
+    if (collector.setstate( srecord["state"] )):
+        logger.info( "Load state: restored snapshot taken %d seconds ago", time.time() - srecord["time"] )
+        return True
+    return False
+
+
+
+
+# ------------------------------------------------------------------
+# Stop
+# ------------------------------------------------------------------
+# Signal handler (SIGTERM), so that the state is saved on exit
+# ------------------------------------------------------------------
+def requeststop( signum, frame ):
+    sys.exit(0)
+
+
+
+
+# ------------------------------------------------------------------
+# Cleanup
+# ------------------------------------------------------------------
+# Just writes closure to log
+# ------------------------------------------------------------------
+def cleanup():
+    logger = logging.getLogger('cxprometheus')
+    logger.info( "Service stoped" )
+    # Flush pending log records
+    if (_loglistener != None):
+        _loglistener.stop()
+
+
+
+# ------------------------------------------------------------------
+# Build metrics
+# ------------------------------------------------------------------
+# Builds the metric families from collected snapshots
+# snapshots:    list of snapshots (see CxCollector.snapshot), the
+#               samples of all of them are merged
+#               histogram sample values are ( buckets, sum )
+# labeltarget:  true if the metrics carry the target label
+# returns       list of metric families, in exposition order
+#               scan metrics over the series budget keep the longest
+#               scans only (see topseries)
+# ------------------------------------------------------------------
+def buildmetrics( snapshots = [], labeltarget = False ):
+    metrics = []
+    dropped = []
+    for name, desc, labels, kind in _metrics:
+        if (labeltarget):
+            labels = [ "target" ] + labels
+        if (kind == "counter"):
+            metric = CounterMetricFamily( name, desc, labels=labels )
+        elif (kind == "histogram"):
+            metric = HistogramMetricFamily( name, desc, labels=labels )
+        else:
+            metric = GaugeMetricFamily( name, desc, labels=labels )
+        budget = seriesbudget( name )
+        if (budget > 0) and (sum( [ len( snapshot.get(name, []) ) for snapshot in snapshots ] ) > budget):
+            samples, others = topseries( [ sample for snapshot in snapshots for sample in snapshot.get(name, []) ], budget, labeltarget )
+            for labelvalues, value in samples:
+                metric.add_metric( labelvalues, value )
+            for prefix, value, count in others:
+                metric.add_metric( prefix + [ "other", "", "", "", "", "", "" ], value )
+                dropped.append( ( prefix + [ name ], count ) )
+        else:
+            for snapshot in snapshots:
+                if (kind == "histogram"):
+                    for labelvalues, value in snapshot.get(name, []):
+                        metric.add_metric( labelvalues, value[0], value[1] )
+                else:
+                    for labelvalues, value in snapshot.get(name, []):
+                        metric.add_metric( labelvalues, value )
+        metrics.append( metric )
+    if (_seriesbudget):
+        labels = _metricb1_labels
+        if (labeltarget):
+            labels = [ "target" ] + labels
+        metric = GaugeMetricFamily( _metricb1_name, _metricb1_desc, labels=labels )
+        for labelvalues, value in dropped:
+            metric.add_metric( labelvalues, value )
+        metrics.append( metric )
+    return metrics
+
+
+
+
+# ------------------------------------------------------------------
+# Series budget
+# ------------------------------------------------------------------
+# Series a scan metric may expose, at most
+# name:         metric family name
+# returns       the series budget, 0 when not limited
+# ------------------------------------------------------------------
+def seriesbudget( name ):
+    if (name not in _scanmetrics):
+        return 0
+    if (type(_seriesbudget) == dict):
+        return _seriesbudget.get( name, 0 )
+    return _seriesbudget
+
+
+
+
+# ------------------------------------------------------------------
+# Top series
+# ------------------------------------------------------------------
+# Keeps the budget longest running or waiting scans of a scan metric,
+# selected with a heap rather than sorting the whole queue, the other
+# scans are summed up by target, so that sums over the metric hold
+# samples:      list of ( labelvalues, minutes ) samples
+# budget:       samples kept
+# labeltarget:  true if the samples lead with the target label
+# returns       ( kept samples, list of ( label prefix, minutes summed, samples summed ) )
+# ------------------------------------------------------------------
+def topseries( samples, budget, labeltarget = False ):
+    kept = heapq.nlargest( budget, samples, key = lambda sample: sample[1] )
+    keptids = set( [ id(sample) for sample in kept ] )
+    if (labeltarget):
+        offset = 1
+    else:
+        offset = 0
+    others = collections.OrderedDict()
+    for sample in samples:
+        if (id(sample) not in keptids):
+            prefix = tuple( sample[0][:offset] )
+            other = others.get( prefix )
+            if (other == None):
+                others[prefix] = [ sample[1], 1 ]
+            else:
+                other[0] = other[0] + sample[1]
+                other[1] = other[1] + 1
+    return kept, [ ( list(prefix), other[0], other[1] ) for prefix, other in others.items() ]
+
+
+
+
+# ------------------------------------------------------------------
+# The streaming sketch class
+# ------------------------------------------------------------------
+# Constant memory estimator of a stream of scan durations: bucket
+# weights over _sketchbounds, decaying exponentially with time
+# (time constant _estimatorwindow), so that the older observations
+# fade away. Gives the exponentially weighted mean, approximate
+# quantiles (within a bucket, 25%) and the rate of observations
+# counts:   decayed weights by bucket, the last one being above bounds
+# total:    decayed sum of the observed values
+# updated:  timestamp the weights were decayed to
+# ------------------------------------------------------------------
+class CxSketch(object):
+
+    def __init__(self, counts = None, total = 0.0, updated = 0.0):
+        self.counts     = counts if (counts != None) else [ 0.0 ] * ( len(_sketchbounds) + 1 )
+        self.total      = total
+        self.updated    = updated
+
+    def decay(self, now):
+        if (now > self.updated):
+            factor = math.exp( ( self.updated - now ) / _estimatorwindow )
+            self.counts  = [ count * factor for count in self.counts ]
+            self.total   = self.total * factor
+            self.updated = now
+
+    def observe(self, value, when):
+        # Observations older than the last one weigh less, as if decayed since
+        if (when >= self.updated):
+            self.decay( when )
+            weight = 1.0
+        else:
+            weight = math.exp( ( when - self.updated ) / _estimatorwindow )
+        self.counts[ bisect.bisect_left( _sketchbounds, value ) ] += weight
+        self.total += value * weight
+
+    def weight(self):
+        return sum( self.counts )
+
+    def mean(self):
+        weight = self.weight()
+        if (weight <= 0.0):
+            return 0.0
+        return self.total / weight
+
+    def quantile(self, q):
+        # Linear interpolation within the bucket holding the quantile
+        target = q * self.weight()
+        cumulative = 0.0
+        for idx, count in enumerate( self.counts ):
+            if (count > 0.0) and (cumulative + count >= target):
+                if (idx >= len(_sketchbounds)):
+                    return _sketchbounds[-1]
+                lower = _sketchbounds[idx - 1] if (idx > 0) else 0.0
+                return lower + ( _sketchbounds[idx] - lower ) * ( target - cumulative ) / count
+            cumulative = cumulative + count
+        return 0.0
+
+    def rate(self, now):
+        # Observations per minute, the decayed weight of a steady stream being rate x window
+        weight = self.weight()
+        if (now > self.updated):
+            weight = weight * math.exp( ( self.updated - now ) / _estimatorwindow )
+        return 60.0 * weight / _estimatorwindow
+
+    def getstate(self):
+        return [ self.counts, self.total, self.updated ]
+
+
+
+
+# ------------------------------------------------------------------
+# The lines of code interval index class
+# ------------------------------------------------------------------
+# Splits the lines of code axis at every engine minLoc and maxLoc, in
+# bands no engine range starts or ends within, each band knowing the
+# engines able to take its scans. Built once per engines list change,
+# a scan band is then found by bisection over the bands lower bounds
+# ranges:   list of ( engine id, minLoc, maxLoc )
+# ------------------------------------------------------------------
+class CxLocIndex(object):
+
+    def __init__(self, ranges = []):
+        self.ranges     = ranges
+        bounds          = set( [ 0 ] )
+        for engineid, locmin, locmax in ranges:
+            bounds.add( locmin )
+            bounds.add( locmax + 1 )
+        self.bounds     = sorted( bounds )          # bands lower bounds
+        self.labels     = []                        # bands ( locMin, locMax ) label values
+        self.engines    = []                        # bands eligible engine ids
+        for idx, lower in enumerate( self.bounds ):
+            if (idx + 1 < len(self.bounds)):
+                self.labels.append( ( str(lower), str( self.bounds[idx + 1] - 1 ) ) )
+            else:
+                self.labels.append( ( str(lower), "+Inf" ) )
+            self.engines.append( [ engineid for engineid, locmin, locmax in ranges if (locmin <= lower) and (locmax >= lower) ] )
+
+    def band(self, loc):
+        return max( bisect.bisect_right( self.bounds, loc ) - 1, 0 )
+
+    def demand(self, locs):
+        # Scans by band, and their running sums, for counts over a range of bands
+        counts = [ 0 ] * len(self.bounds)
+        for loc in locs:
+            counts[ self.band( loc ) ] += 1
+        return counts, [ 0 ] + list( itertools.accumulate( counts ) )
+
+    def between(self, cumulative, locmin, locmax):
+        # Scans from locmin to locmax, bounds of some engine range, hence of bands
+        return cumulative[ self.band( locmax ) + 1 ] - cumulative[ self.band( locmin ) ]
+
+    def capacity(self, free):
+        # Free slots by band, given free slots by engine id
+        return [ sum( [ free.get( engineid, 0 ) for engineid in engines ] ) for engines in self.engines ]
+
+
+
+
+# ------------------------------------------------------------------
+# The details cache class
+# ------------------------------------------------------------------
+# SAST details by ( kind, id ) key, as ( "project", 5 ), each one
+# expiring after its time to live, the least recently used dropped
+# first once more than _enrichcache are kept. Details that could not
+# be read are cached as None, for a shorter time
+# ------------------------------------------------------------------
+class CxDetailCache(object):
+
+    def __init__(self):
+        self.entries    = collections.OrderedDict()     # key -> [ details, expires on ], least recently used first
+        self.lock       = threading.Lock()
+
+    def get(self, key, now):
+        # returns   ( found, details )
+        self.lock.acquire()
+        try:
+            entry = self.entries.get(key)
+            if (entry == None):
+                return False, None
+            if (entry[1] <= now):
+                del self.entries[key]
+                return False, None
+            self.entries.move_to_end(key)
+            return True, entry[0]
+        finally:
+            self.lock.release()
+
+    def put(self, key, details, expires):
+        self.lock.acquire()
+        try:
+            self.entries[key] = [ details, expires ]
+            self.entries.move_to_end(key)
+            while (len(self.entries) > _enrichcache):
+                self.entries.popitem( last = False )
+        finally:
+            self.lock.release()
+
+
+
+
+# ------------------------------------------------------------------
+# The checkmarx collector class
+# ------------------------------------------------------------------
+# Collects one SAST target
+# ------------------------------------------------------------------
+class CxCollector(object):
+
+    def __init__(self, target = "", labeltarget = False):
+        logger = logging.getLogger('cxprometheus')
+        logger.debug( "CxCollector: creating new instance (__init__) for target '%s'", target )
+        self.target     = target
+        self.enginelist = collections.OrderedDict()
+        self.logdebug   = logger.isEnabledFor(logging.DEBUG)
+        self.statehost  = ""                    # SAST host the cached state belongs to
+        self.session    = requests.Session()    # Keeps SAST connections alive between scrapes
+        self.statelock  = threading.Lock()      # Guards the cached state against snapshots
+        # Label values leading every sample
+        if (labeltarget):
+            self.labelprefix = [ target ]
+        else:
+            self.labelprefix = []
+        # Authentication token
+        self.token      = ""                    # token
+        self.tokenread  = 0                     # timestamp the token was last read
+        self.tokengen   = 0                     # connection generation the token was obtained for
+        self.tokenlock  = threading.Lock()      # threading
+        # Scans followed between polls, for throughput counters and histograms
+        self.scanstates = dict()                # scan id -> [ stage, engine id, queued on, engine started on ]
+        self.lastpoll   = time.time()           # only transitions after this moment are accounted
+        self.started    = dict()                # engine id -> scans started
+        self.finished   = dict()                # ( engine id, result ) -> scans finished
+        self.waits      = dict()                # engine id -> [ bucket counts, sum ], queue waits
+        self.durations  = dict()                # engine id -> [ bucket counts, sum ], scan durations
+        self.estimators = dict()                # engine id -> CxSketch, scan durations and completions
+        self.locindex   = CxLocIndex()          # engines lines of code ranges index, rebuilt when they change
+        self.details    = CxDetailCache()       # scan, project and teams details, for the scans enrichment
+        # Engines and scans queue read last, the scans kept up to date by events between polls
+        self.engines    = []
+        self.scans      = collections.OrderedDict()
+        self.polled     = 0                     # timestamp of the last full poll
+        # Engine servers health, probed in background every _probeinterval seconds
+        self.probes     = dict()                # engine id -> [ engine name, reachable, latency ]
+        self.probing    = False                 # a prober thread is running, started and ended under probelock
+        self.probelock  = threading.Lock()
+        self.probestop  = threading.Event()
+
+
+    def gettoken(self):
+        # If the token being used is older than 23.3 hours than get a new one
+        # or if the connection details changed since it was obtained
+        logger = logging.getLogger('cxprometheus')
+        logger.debug( "CxCollector: running internal gettoken" )
+        hostname, username, password, configgen = getconnection( self.target )
+        self.tokenlock.acquire()
+        try:
+            if (self.token == "") or (self.tokenread == 0) or (self.tokengen != configgen) or (time.time() - self.tokenread > _tokenmaxage):
+                if (self.token == "") or (self.tokenread == 0):
+                    logger.debug( "CxCollector: token is null, calling logon" )
+                elif (self.tokengen != configgen):
+                    logger.debug( "CxCollector: connection details changed, calling logon" )
+                elif (time.time() - self.tokenread > _tokenmaxage):
+                    logger.debug( "CxCollector: token is too old, calling logon" )
+                self.token = cxlogon( hostname, username, password, self.session )
+                if (self.token != ""):
+                    self.tokenread = time.time()
+                    self.tokengen  = configgen
+        finally:
+            self.tokenlock.release()
+        return self.token
+
+    def resettoken(self):
+        logger = logging.getLogger('cxprometheus')
+        logger.debug( "CxCollector: running internal resettoken" )
+        self.tokenlock.acquire()
+        try:
+            self.token = ""
+            self.tokenread = 0
+        finally:
+            self.tokenlock.release()
+
+    def checkstate(self, hostname):
+        # Cached state and connections are only valid for the host they came from
+        if (hostname != self.statehost):
+            if (self.statehost != ""):
+                logger = logging.getLogger('cxprometheus')
+                logger.info( "CxCollector: SAST host changed, dropping cached state" )
+                self.statelock.acquire()
+                try:
+                    self.enginelist.clear()
+                    self.scanstates.clear()
+                    self.started.clear()
+                    self.finished.clear()
+                    self.waits.clear()
+                    self.durations.clear()
+                    self.estimators.clear()
+                    self.lastpoll = time.time()
+                    self.engines  = []
+                    self.scans    = collections.OrderedDict()
+                    self.polled   = 0
+                finally:
+                    self.statelock.release()
+                self.session.close()
+                self.session = requests.Session()
+                self.probes  = dict()
+                self.details = CxDetailCache()
+            self.statehost = hostname
+
+    def getstate(self):
+        # Compact, json serializable, snapshot of the warm state
+        hostname, username, password, configgen = getconnection( self.target )
+        self.statelock.acquire()
+        try:
+            engines     = [ [ ikey ] + ivalues for ikey, ivalues in self.enginelist.items() ]
+            scans       = [ [ scanid ] + scanstate for scanid, scanstate in self.scanstates.items() ]
+            started     = [ [ engineid, count ] for engineid, count in self.started.items() ]
+            finished    = [ [ key[0], key[1], count ] for key, count in self.finished.items() ]
+            waits       = [ [ engineid ] + histogram for engineid, histogram in self.waits.items() ]
+            durations   = [ [ engineid ] + histogram for engineid, histogram in self.durations.items() ]
+            estimators  = [ [ engineid ] + sketch.getstate() for engineid, sketch in self.estimators.items() ]
+            lastpoll    = self.lastpoll
+        finally:
+            self.statelock.release()
+        self.tokenlock.acquire()
+        try:
+            if (self.tokengen == configgen):
+                token, tokenread = self.token, self.tokenread
+            else:
+                token, tokenread = "", 0
+        finally:
+            self.tokenlock.release()
+        return { 'host': self.statehost, 'username': username, 'token': token, 'tokenread': tokenread, 'engines': engines,
+                 'lastpoll': lastpoll, 'scans': scans, 'started': started, 'finished': finished, 'waits': waits, 'durations': durations,
+                 'estimators': estimators }
+
+    def setstate(self, state):
+        # Restore a snapshot taken with getstate, if it belongs to the SAST host in use
+        logger = logging.getLogger('cxprometheus')
+        hostname, username, password, configgen = getconnection( self.target )
+        if (state.get('host') != hostname):
+            logger.info( "CxCollector: state snapshot belongs to another SAST host, ignored" )
+            return False
+        self.statelock.acquire()
+        try:
+            self.statehost  = hostname
+            self.enginelist = collections.OrderedDict( [ ( iengine[0], iengine[1:] ) for iengine in state.get('engines', []) ] )
+            # Counters carry on from where they were
+            if ('lastpoll' in state):
+                self.lastpoll   = state['lastpoll']
+                self.scanstates = dict( [ ( iscan[0], iscan[1:] ) for iscan in state.get('scans', []) ] )
+                self.started    = dict( [ ( istarted[0], istarted[1] ) for istarted in state.get('started', []) ] )
+                self.finished   = dict( [ ( ( ifinished[0], ifinished[1] ), ifinished[2] ) for ifinished in state.get('finished', []) ] )
+                self.waits      = dict( [ ( iwait[0], iwait[1:] ) for iwait in state.get('waits', []) ] )
+                self.durations  = dict( [ ( iduration[0], iduration[1:] ) for iduration in state.get('durations', []) ] )
+                self.estimators = dict( [ ( iestimator[0], CxSketch( *iestimator[1:] ) ) for iestimator in state.get('estimators', [])
+                                          if (len(iestimator[1]) == len(_sketchbounds) + 1) ] )
+        finally:
+            self.statelock.release()
+        # The token is only reused for the same user and while still valid
+        if (state.get('username') == username) and (state.get('token', "") != "") and (time.time() - state.get('tokenread', 0) <= _tokenmaxage):
+            self.tokenlock.acquire()
+            try:
+                self.token      = state['token']
+                self.tokenread  = state['tokenread']
+                self.tokengen   = configgen
+            finally:
+                self.tokenlock.release()
+        return True
+
+    def setenginescan(self, scanid, engineid, scanstatus, slots):
+        # Called per scan, only touch the logger when debugging
+        # slots:    the engine slots, from the engines list cache (see updateengines)
+        if (self.logdebug):
+            logging.getLogger('cxprometheus').debug( "CxCollector: running internal setenginescan for scan %s on engine %s", scanid, engineid )
+        lfound = False
+        for iengine in slots:
+            if (iengine[6] == scanid):
+                iengine[7] = scanstatus
+                lfound = True
+                break
+        if (not lfound):
+            for iengine in slots:
+                if (iengine[6] == 0):
+                    iengine[6] = scanid
+                    iengine[7] = scanstatus
+                    break
+
+    def processdatestring( self, thedate ):
+        if (type(thedate) == str):
+            if ( "." in thedate ):
+                return thedate
+            else:
+                return thedate + ".0"
+        else:
+            return thedate
+
+    def parsedate( self, thedate ):
+        # SAST date to timestamp, 0.0 if missing or invalid
+        try:
+            return datetime.datetime.strptime( self.processdatestring(thedate), "%Y-%m-%dT%H:%M:%S.%f" ).timestamp()
+        except:
+            return 0.0
+
+    def observe( self, histograms, buckets, engineid, value ):
+        # Non cumulative bucket counts, the last one being +Inf
+        histogram = histograms.get(engineid)
+        if (histogram == None):
+            histogram = [ [ 0 ] * ( len(buckets) + 1 ), 0.0 ]
+            histograms[engineid] = histogram
+        value = max( value, 0.0 )
+        histogram[0][ bisect.bisect_left( buckets, value ) ] += 1
+        histogram[1] += value
+
+    def histogramsamples( self, histograms, buckets ):
+        # Cumulative buckets, as exposed
+        samples = []
+        for engineid, histogram in histograms.items():
+            cumulative = 0
+            sbuckets = []
+            for idx in range( len(buckets) ):
+                cumulative = cumulative + histogram[0][idx]
+                sbuckets.append( ( str(float(buckets[idx])), cumulative ) )
+            sbuckets.append( ( "+Inf", cumulative + histogram[0][-1] ) )
+            samples.append( ( self.labelprefix + [ engineid ], ( sbuckets, histogram[1] ) ) )
+        return samples
+
+    def updatescans(self, engines, scans, scannow):
+        # ----------------------------------------------------------------------------------
+        # Detect scan transitions since the previous poll, for the throughput counters
+        # and the completed durations histograms. Scans first seen are only accounted
+        # for transitions that happened after the previous poll
+        # ----------------------------------------------------------------------------------
+        logger = logging.getLogger('cxprometheus')
+        logger.debug( "CxCollector: process scans transitions" )
+        since   = self.lastpoll
+        current = dict()
+        # Counters exist for every engine, even before their first scan
+        for engine in engines:
+            engineid = str(engine["id"])
+            self.started.setdefault( engineid, 0 )
+            for result in [ "finished", "canceled", "failed" ]:
+                self.finished.setdefault( ( engineid, result ), 0 )
+        for scan in scans:
+            scanid          = scan["id"]
+            scanstatusid    = scan["stage"]["id"]
+            scanengine      = scan["engine"]
+            if (scanengine != None):
+                scanengineid = str(scanengine["id"])
+            else:
+                scanengineid = "0"
+            scanstate = self.scanstates.get(scanid)
+            if (scanstate == None):
+                scanstate = [ 0, scanengineid, 0.0, 0.0 ]
+                lnew = True
+            else:
+                lnew = False
+            laststatusid = scanstate[0]
+            if (scanengineid != "0"):
+                scanstate[1] = scanengineid
+            if (scanstate[2] <= 0.0):
+                scanstate[2] = self.parsedate( scan.get("queuedOn") )
+            # Started on engine, the queue wait is then known
+            if (scanstate[3] <= 0.0):
+                scanstate[3] = self.parsedate( scan.get("engineStartedOn") )
+                if (scanstate[3] > 0.0) and ((not lnew) or (scanstate[3] >= since)):
+                    self.started[scanstate[1]] = self.started.get(scanstate[1], 0) + 1
+                    if (scanstate[2] > 0.0):
+                        self.observe( self.waits, _metric8_buckets, scanstate[1], ( scanstate[3] - scanstate[2] ) / 60 )
+            # 1=New, 2=PreScan, 3=Queued, 4=Scanning, 6=PostScan, 7=Finished, 8=Canceled, 9=Failed, 10=SourcePullingAndDeployment or 1001=None.
+            if (scanstatusid in [7, 8, 9]) and (laststatusid not in [7, 8, 9]):
+                scanend = self.parsedate( scan.get("completedOn") )
+                if (not lnew) or (scanend >= since):
+                    if (scanend <= 0.0):
+                        scanend = scannow
+                    self.completescan( scanstate, _scanresults[scanstatusid], scanend )
+            scanstate[0] = scanstatusid
+            current[scanid] = scanstate
+        # Scans that left the queue unseen
+        for scanid, scanstate in self.scanstates.items():
+            if (scanid not in current) and (scanstate[0] not in [7, 8, 9]):
+                self.completescan( scanstate, "unknown", scannow )
+        self.scanstates = current
+        self.lastpoll   = scannow
+
+    def completescan(self, scanstate, result, scanend):
+        # Scans that never reached an engine are accounted on engine 0
+        if (scanstate[3] > 0.0):
+            engineid = scanstate[1]
+            self.observe( self.durations, _metric9_buckets, engineid, ( scanend - scanstate[3] ) / 60 )
+            sketch = self.estimators.get(engineid)
+            if (sketch == None):
+                sketch = CxSketch()
+                self.estimators[engineid] = sketch
+            sketch.observe( max( ( scanend - scanstate[3] ) / 60, 0.0 ), scanend )
+        else:
+            engineid = "0"
+        self.finished[ ( engineid, result ) ] = self.finished.get( ( engineid, result ), 0 ) + 1
+
+    def updateengines(self, engines, scans):
+        logger = logging.getLogger('cxprometheus')
+        # ----------------------------------------------------------------------------------
+        # Process engines metrics, by relating engines to scans
         # Uses the dictionary "enginelist" to cache engine states
         # ----------------------------------------------------------------------------------
 
         logger.debug( "CxCollector: process engines" )
         # Remove form engines list cache any engine no longer found
-        idx = len(self.enginelist.keys()) - 1
-        while idx >= 0:
-            ikeys   = self.enginelist.keys()
-            iengx   = list(ikeys)[idx]
+        maxscans = dict( [ ( engine["id"], engine["maxScans"] ) for engine in engines ] )
+        for iengx in list( self.enginelist.keys() ):
             iids    = iengx.split("_")
-            lfound  = False
-            for engine in engines:
-                if (engine["id"] == int(iids[0])):
-                    if (engine["maxScans"] >= int(iids[1])):
-                        lfound = True
-                        break
-            if (lfound == False):
+            if (maxscans.get( int(iids[0]), 0 ) < int(iids[1])):
                 self.enginelist.pop(iengx)
-            idx = idx - 1
         # Add to engines list cache any new engines and found
         for engine in engines:
             idx = 1
@@ -517,23 +1909,24 @@ class CxCollector(object):
                 idx = idx + 1
 
         logger.debug( "CxCollector: check scans assigned to engines and detect concurent ones" )
+        # Scans queued or running, with their engine id, and the engine slots by engine id,
+        # indexed once per cycle rather than searched for every engine slot and scan
+        active = dict()
+        for scan in scans:
+            # 1=New, 2=PreScan, 3=Queued, 4=Scanning, 6=PostScan, 7=Finished, 8=Canceled, 9=Failed, 10=SourcePullingAndDeployment or 1001=None. 
+            scanstatusid = scan["stage"]["id"]
+            if (scanstatusid >= 3) and (scanstatusid <= 6):
+                scanengine  = scan["engine"]
+                if (scanengine != None):
+                    active[scan["id"]] = scanengine["id"]
+                else:
+                    active[scan["id"]] = 0
+        slots = dict()
+        for iengine in self.enginelist.values():
+            slots.setdefault( iengine[0], [] ).append( iengine )
         # Remove from engines any scans finished or no longer found 
         for iengine in self.enginelist.values():
-            scanid = iengine[6]
-            lfound = False
-            for scan in scans:
-                if (scanid == scan["id"]):
-                    # 1=New, 2=PreScan, 3=Queued, 4=Scanning, 6=PostScan, 7=Finished, 8=Canceled, 9=Failed, 10=SourcePullingAndDeployment or 1001=None. 
-                    scanstatusid = scan["stage"]["id"]
-                    if (scanstatusid >= 3) and (scanstatusid <= 6):
-                        scanengine  = scan["engine"]
-                        if (scanengine != None):
-                            scanengineid = scanengine["id"]
-                        else:
-                            scanengineid = 0
-                        if (scanengineid == iengine[0]):
-                            lfound = True
-            if (lfound == False):
+            if (active.get( iengine[6] ) != iengine[0]):
                 iengine[6] = 0
                 iengine[7] = "Idle"
         # Add or update any new or updated scans into engines
@@ -556,24 +1949,446 @@ class CxCollector(object):
                     scanenginestatus  = "Idle"                          
                 # Register in cache
                 if (scanenginestatus != "Idle"):
-                    self.setenginescan(scanid, scanengineid, scanenginestatus)
+                    self.setenginescan(scanid, scanengineid, scanenginestatus, slots.get( scanengineid, [] ))
 
-        logger.debug( "CxCollector: process engine metrics" )
-        # Present metrics for engines (metric1)
-        for iengine in self.enginelist.values():
-            if (iengine[7] == "Idle"):
-                vvalue = 0
+    def ingest(self, events):
+        # ----------------------------------------------------------------------------------
+        # Apply scan events (see checkevent) to the scans queue read last. Scans are
+        # replaced, not changed, as snapshots may be using them
+        # returns   number of events applied
+        # ----------------------------------------------------------------------------------
+        logger = logging.getLogger('cxprometheus')
+        logger.debug( "CxCollector: applying %d scan events", len(events) )
+        now = datetime.datetime.now().strftime( "%Y-%m-%dT%H:%M:%S.%f" )[:-3]
+        self.statelock.acquire()
+        try:
+            for event in events:
+                scanid  = event["scanId"]
+                stageid = event["stage"]
+                when    = event.get("time", now)
+                previous = self.scans.get(scanid)
+                if (previous == None):
+                    scan = { "id": scanid, "stage": None, "engine": None, "dateCreated": when,
+                             "queuedOn": None, "engineStartedOn": None, "completedOn": None }
+                else:
+                    scan = dict(previous)
+                scan["stage"] = { "id": stageid, "value": event["stagename"] }
+                if (event.get("engineId", 0) > 0):
+                    scan["engine"] = { "id": event["engineId"] }
+                # 1=New, 2=PreScan, 3=Queued, 4=Scanning, 6=PostScan, 7=Finished, 8=Canceled, 9=Failed, 10=SourcePullingAndDeployment or 1001=None.
+                if (stageid == 3) and (not scan.get("queuedOn")):
+                    scan["queuedOn"] = when
+                elif (stageid >= 4) and (stageid <= 6) and (not scan.get("engineStartedOn")):
+                    scan["engineStartedOn"] = when
+                elif (stageid in [7, 8, 9]) and (not scan.get("completedOn")):
+                    scan["completedOn"] = when
+                for key in [ "loc", "project", "teamId" ]:
+                    if (key in event):
+                        scan[key] = event[key]
+                self.scans[scanid] = scan
+        finally:
+            self.statelock.release()
+        return len(events)
+
+    def describe(self):
+        logger = logging.getLogger('cxprometheus')
+        logger.debug( "CxCollector: running describe" )
+        # The metrics...
+        for metric in buildmetrics( [], len(self.labelprefix) > 0 ):
+            yield metric
+
+    def snapshot(self):
+        logger = logging.getLogger('cxprometheus')
+        self.logdebug = logger.isEnabledFor(logging.DEBUG)
+        logger.debug( "CxCollector: running snapshot for target '%s'", self.target )
+        # The metrics samples, ( label values, value ) by metric name
+        samples = dict( [ ( metric[0], [] ) for metric in _metrics ] )
+        metric1 = samples[_metric1_name]
+        metric6 = samples[_metric6_name]
+        metric7 = samples[_metric7_name]
+        prefix  = self.labelprefix
+
+        # Configurations may be reloaded meanwhile, use a consistent set
+        hostname = getconnection( self.target )[0]
+        if (hostname == ""):
+            logger.debug( "CxCollector: target '%s' no longer configured", self.target )
+            return samples
+        self.checkstate( hostname )
+
+        # With events, the engines and scans queue are only read every reconciliation
+        # interval, the scans being kept up to date by the events in between
+        if (_events) and (self.polled > 0) and (time.time() - self.polled < _reconcileinterval):
+            logger.debug( "CxCollector: using scans queue kept by events" )
+            self.statelock.acquire()
+            try:
+                engines = self.engines
+                scans   = list( self.scans.values() )
+            finally:
+                self.statelock.release()
+            lscans = True
+        else:
+            # Get authentication token or generate a new one if needed (token shall be valid for 24 hours)
+            apitoken = self.gettoken()
+
+            # Get engines
+            try:
+                engines = cxgetengines( hostname, apitoken, self.session )
+            except:
+                engines = []
+            # If no engines returned, recheck authorizations
+            if (engines == []):
+                self.resettoken()
+                apitoken = self.gettoken()
+                engines = cxgetengines( hostname, apitoken, self.session )
+
+            if (engines == []):
+                logger.error( "CxCollector: no engines found to process" )
+
+            # Get scans queue, transitions can only be followed if it was read
+            scans = cxgetscansqueue( hostname, apitoken, self.session )
+            lscans = (scans != None)
+            if (not lscans):
+                scans = []
             else:
-                vvalue = 1
-            metric1.add_metric( [ str(iengine[0]), iengine[1], str(iengine[2]), iengine[7] ], vvalue )
+                self.statelock.acquire()
+                try:
+                    self.engines = engines
+                    self.scans   = collections.OrderedDict( [ ( scan["id"], scan ) for scan in scans ] )
+                    self.polled  = time.time()
+                finally:
+                    self.statelock.release()
+
+        # fp = open( 'data\scans1.txt', 'r')
+        # try:
+        #     scans = json.load(fp)
+        # finally:
+        #     fp.close()
+
+        # Engines cache is shared with the state snapshots
+        self.statelock.acquire()
+        try:
+            self.updateengines( engines, scans )
+
+            logger.debug( "CxCollector: process engine metrics" )
+            # Present metrics for engines (metric1)
+            # while aggregating slots by engine, [ name, slots, busy ], and by LOC band, [ slots, busy ]
+            engineslots = collections.OrderedDict()
+            bandslots   = collections.OrderedDict()
+            engineband  = dict()
+            for iengine in self.enginelist.values():
+                if (iengine[7] == "Idle"):
+                    vvalue = 0
+                else:
+                    vvalue = 1
+                metric1.append( ( prefix + [ str(iengine[0]), iengine[1], str(iengine[2]), iengine[7] ], vvalue ) )
+                islots = engineslots.get( iengine[0] )
+                if (islots == None):
+                    islots = [ iengine[1], 0, 0 ]
+                    engineslots[ iengine[0] ] = islots
+                islots[1] = islots[1] + 1
+                islots[2] = islots[2] + vvalue
+                islots = bandslots.get( ( iengine[4], iengine[5] ) )
+                if (islots == None):
+                    islots = [ 0, 0 ]
+                    bandslots[ ( iengine[4], iengine[5] ) ] = islots
+                islots[0] = islots[0] + 1
+                islots[1] = islots[1] + vvalue
+                engineband[ iengine[0] ] = ( iengine[4], iengine[5] )
+
+            # Throughput counters and completed durations histograms
+            if (lscans):
+                self.updatescans( engines, scans, time.time() )
+            for engineid, count in self.started.items():
+                metric6.append( ( prefix + [ engineid ], count ) )
+            for key, count in self.finished.items():
+                metric7.append( ( prefix + [ key[0], key[1] ], count ) )
+            samples[_metric8_name] = self.histogramsamples( self.waits, _metric8_buckets )
+            samples[_metric9_name] = self.histogramsamples( self.durations, _metric9_buckets )
+            # Scan durations estimates ( mean, p50, p90, completions per minute ), by engine
+            estimatenow = time.time()
+            estimates = dict( [ ( engineid, ( sketch.mean(), sketch.quantile(0.5), sketch.quantile(0.9), sketch.rate(estimatenow) ) )
+                                for engineid, sketch in self.estimators.items() if (sketch.weight() > 0.0) ] )
+        finally:
+            self.statelock.release()
 
         # ----------------------------------------------------------------------------------
         # Process scans queue metrics, for durations
         # ----------------------------------------------------------------------------------
+        if (_enrichment):
+            details = self.enrich( hostname, scans )
+        else:
+            details = dict()
+        if (numpy != None) and (_columnar > 0) and (len(scans) >= _columnar):
+            queued, enginequeued = self.scancolumns( engines, scans, samples, details )
+        else:
+            queued, enginequeued = self.scansamples( engines, scans, samples, details )
+
+        # ----------------------------------------------------------------------------------
+        # Pre-aggregated capacity and utilization, by engine, overall and by LOC band
+        # ----------------------------------------------------------------------------------
+        logger.debug( "CxCollector: process capacity metrics" )
+        slots   = 0
+        busy    = 0
+        for engineid, islots in engineslots.items():
+            enginelabels = prefix + [ str(engineid), islots[0] ]
+            samples[_metric10_name].append( ( enginelabels, islots[1] ) )
+            samples[_metric11_name].append( ( enginelabels, islots[2] ) )
+            samples[_metric12_name].append( ( enginelabels, enginequeued.get( str(engineid), 0 ) ) )
+            samples[_metric13_name].append( ( enginelabels, islots[2] / islots[1] ) )
+            slots   = slots + islots[1]
+            busy    = busy + islots[2]
+        samples[_metric14_name].append( ( prefix, slots ) )
+        samples[_metric15_name].append( ( prefix, busy ) )
+        samples[_metric16_name].append( ( prefix, queued ) )
+        if (slots > 0):
+            samples[_metric17_name].append( ( prefix, busy / slots ) )
+        else:
+            samples[_metric17_name].append( ( prefix, 0.0 ) )
+        for band, islots in bandslots.items():
+            samples[_metric18_name].append( ( prefix + [ band[0], band[1] ], islots[0] ) )
+            samples[_metric19_name].append( ( prefix + [ band[0], band[1] ], islots[1] ) )
+
+        # ----------------------------------------------------------------------------------
+        # Eligible free slots and queued demand, by LOC band, from the interval index of
+        # the engines ranges, rebuilt only when the engines list changed
+        # ----------------------------------------------------------------------------------
+        ranges = [ ( engineid, int(band[0]), int(band[1]) ) for engineid, band in engineband.items() ]
+        locindex = self.locindex
+        if (ranges != locindex.ranges):
+            logger.debug( "CxCollector: engines changed, indexing %d LOC ranges", len(ranges) )
+            locindex = CxLocIndex( ranges )
+            self.locindex = locindex
+        demand, cumulative = locindex.demand( [ scan.get("loc") or 0 for scan in scans if (scan["stage"]["id"] == 3) ] )
+        capacity = locindex.capacity( dict( [ ( engineid, max( islots[1] - islots[2], 0 ) ) for engineid, islots in engineslots.items() ] ) )
+        for idx, band in enumerate( locindex.labels ):
+            if (locindex.engines[idx] != []) or (demand[idx] > 0):
+                samples[_metric26_name].append( ( prefix + [ band[0], band[1] ], capacity[idx] ) )
+                samples[_metric27_name].append( ( prefix + [ band[0], band[1] ], demand[idx] ) )
+
+        # ----------------------------------------------------------------------------------
+        # Queue wait forecasts, by engine and by LOC band. A new scan waits for the scans
+        # ahead of it (queued and running, less the slots) to complete, the slots
+        # completing scans at the rate given by the estimated mean duration
+        # ----------------------------------------------------------------------------------
+        bandrates = collections.OrderedDict()
+        for engineid, islots in engineslots.items():
+            estimate = estimates.get( str(engineid) )
+            if (estimate == None):
+                continue
+            enginelabels = prefix + [ str(engineid), islots[0] ]
+            samples[_metric22_name].append( ( enginelabels + [ "mean" ], estimate[0] ) )
+            samples[_metric22_name].append( ( enginelabels + [ "p50" ], estimate[1] ) )
+            samples[_metric22_name].append( ( enginelabels + [ "p90" ], estimate[2] ) )
+            samples[_metric23_name].append( ( enginelabels, estimate[3] ) )
+            if (estimate[0] > 0.0):
+                ahead = enginequeued.get( str(engineid), 0 ) + islots[2] - islots[1] + 1
+                samples[_metric24_name].append( ( enginelabels, max( ahead, 0 ) * estimate[0] / islots[1] ) )
+                band = engineband[engineid]
+                bandrates[band] = bandrates.get( band, 0.0 ) + islots[1] / estimate[0]
+        for band, rate in bandrates.items():
+            islots = bandslots[band]
+            ahead = locindex.between( cumulative, int(band[0]), int(band[1]) ) + islots[1] - islots[0] + 1
+            samples[_metric25_name].append( ( prefix + [ band[0], band[1] ], max( ahead, 0 ) / rate ) )
+
+        # Engines health, from the last probes
+        if (_probeinterval > 0):
+            for engineid, iprobe in list(self.probes.items()):
+                enginelabels = prefix + [ str(engineid), iprobe[0] ]
+                samples[_metric20_name].append( ( enginelabels, iprobe[1] ) )
+                samples[_metric21_name].append( ( enginelabels, iprobe[2] ) )
+
+        return samples
+
+    def probeengine(self, engine):
+        # A new connection and request to the engine uri, accepting self-signed certificates
+        # Any answer below 500 means the engine server is up, whatever the path
+        # returns   ( reachable, latency )
+        clock = time.perf_counter()
+        connection = None
+        try:
+            uri = urllib.parse.urlsplit( engine["uri"] )
+            if (uri.scheme == "https"):
+                connection = http.client.HTTPSConnection( uri.hostname, uri.port, timeout = _probetimeout, context = _probecontext )
+            else:
+                connection = http.client.HTTPConnection( uri.hostname, uri.port, timeout = _probetimeout )
+            connection.request( "GET", uri.path or "/" )
+            response = connection.getresponse()
+            response.read( 65536 )
+            reachable = int( response.status < 500 )
+        except (OSError, ValueError, http.client.HTTPException):
+            reachable = 0
+        finally:
+            if (connection != None):
+                connection.close()
+        return reachable, time.perf_counter() - clock
+
+    def probeengines(self):
+        # The engines to probe, the ones read last, or read here until a collection reads them
+        # returns   engines list
+        self.statelock.acquire()
+        try:
+            engines = self.engines
+            polled  = self.polled
+        finally:
+            self.statelock.release()
+        if (polled == 0) and (engines == []):
+            hostname = getconnection( self.target )[0]
+            if (hostname != ""):
+                try:
+                    engines = cxgetengines( hostname, self.gettoken() )
+                except Exception:
+                    engines = []
+        return [ engine for engine in engines if engine.get("uri") ]
+
+    def startprobing(self):
+        # Starts the engine probes, if enabled and not running yet, on configuration
+        # and on reloads enabling them (see probeinterval)
+        self.probelock.acquire()
+        try:
+            if (_probeinterval > 0) and (not self.probing) and (not self.probestop.is_set()):
+                self.probing = True
+                threading.Thread( target = self.probe, name = "cxprober", daemon = True ).start()
+        finally:
+            self.probelock.release()
+
+    def probe(self):
+        # ----------------------------------------------------------------------------------
+        # Engine servers health probes, every _probeinterval seconds, all the engines
+        # read last probed at once, one thread per engine up to _probeworkers, each one
+        # taking _probetimeout seconds at most. Plain http.client, the probes being many
+        # and small. Ends when probes are disabled by a reload or the collector is closed
+        # ----------------------------------------------------------------------------------
+        logger = logging.getLogger('cxprometheus')
+        while True:
+            self.probelock.acquire()
+            try:
+                interval = _probeinterval
+                if (interval <= 0) or (self.probestop.is_set()):
+                    self.probing = False
+                    break
+            finally:
+                self.probelock.release()
+            probestart = time.time()
+            engines = self.probeengines()
+            probes  = dict()
+            if (engines != []):
+                pool = concurrent.futures.ThreadPoolExecutor( max_workers = min( _probeworkers, len(engines) ), thread_name_prefix = "cxprobe" )
+                try:
+                    futures = [ ( engine, pool.submit( self.probeengine, engine ) ) for engine in engines ]
+                    for engine, future in futures:
+                        reachable, latency = future.result()
+                        probes[ engine["id"] ] = [ engine["name"], reachable, latency ]
+                finally:
+                    pool.shutdown( wait = False )
+            self.probes = probes
+            probetime = time.time() - probestart
+            if (probetime > interval):
+                logger.warning( "CxCollector: %d engines probed in %.3f seconds, more than the probes interval (see probeworkers, probetimeout)", len(probes), probetime )
+            elif (self.logdebug):
+                logger.debug( "CxCollector: %d engines probed in %.3f seconds, %d unreachable", len(probes),
+                              probetime, len( [ 1 for iprobe in probes.values() if iprobe[1] == 0 ] ) )
+            self.probestop.wait( max( probestart + interval - time.time(), 0 ) )
+
+    def close(self):
+        # Stops the engine probes, the collector being dropped
+        self.probestop.set()
+
+    def fetchdetail(self, hostname, apitoken, key):
+        # One SAST details request, normalized
+        # returns   scan or project { "id", "name", "teamId" } (project id and name for a scan),
+        #           teams { team id: team full name }, None if not read
+        kind, ident = key
+        if (kind == "scan"):
+            detail = cxgetdetails( hostname, apitoken, "sast/scans/" + str(ident), self.session )
+            if (type(detail) != dict):
+                return None
+            project = detail.get("project") or {}
+            return { "id": project.get("id"), "name": project.get("name"), "teamId": detail.get("owningTeamId") }
+        elif (kind == "project"):
+            detail = cxgetdetails( hostname, apitoken, "projects/" + str(ident), self.session )
+            if (type(detail) != dict):
+                return None
+            return { "id": detail.get("id"), "name": detail.get("name"), "teamId": detail.get("teamId") }
+        else:
+            detail = cxgetdetails( hostname, apitoken, "auth/teams", self.session )
+            if (type(detail) != list):
+                return None
+            return dict( [ ( str(team.get("id")), team.get("fullName") or team.get("name") or "" ) for team in detail if (type(team) == dict) ] )
+
+    def fetchdetails(self, hostname, keys):
+        # Details by key, from the cache, the ones missing or expired requested
+        # at once, _enrichworkers at most in parallel
+        # returns   key -> details, None if they could not be read
+        logger  = logging.getLogger('cxprometheus')
+        now     = time.time()
+        details = dict()
+        missing = []
+        for key in keys:
+            if (key not in details):
+                found, detail = self.details.get( key, now )
+                details[key] = detail
+                if (not found):
+                    missing.append(key)
+        if (missing == []):
+            return details
+        apitoken = self.gettoken()
+        pool = concurrent.futures.ThreadPoolExecutor( max_workers = min( _enrichworkers, len(missing) ), thread_name_prefix = "cxenrich" )
+        try:
+            futures = [ ( key, pool.submit( self.fetchdetail, hostname, apitoken, key ) ) for key in missing ]
+            for key, future in futures:
+                detail = future.result()
+                details[key] = detail
+                if (detail != None):
+                    self.details.put( key, detail, now + _enrichttl )
+                else:
+                    self.details.put( key, detail, now + _enrichttl / 10 )
+        finally:
+            pool.shutdown( wait = False )
+        if (self.logdebug):
+            logger.debug( "CxCollector: %d details requested in %.3f seconds, %d cached", len(missing), time.time() - now, len(details) - len(missing) )
+        return details
+
+    def enrich(self, hostname, scans):
+        # ----------------------------------------------------------------------------------
+        # Project and team names of the scans, from the scans queue when given, otherwise
+        # from the scan and project details. Details are cached, so that SAST is only
+        # requested for the scans and projects not seen lately
+        # returns   scan id -> [ project name, team name ]
+        # ----------------------------------------------------------------------------------
+        details = self.fetchdetails( hostname, [ ( "scan", scan["id"] ) for scan in scans if (not (scan.get("project") or {}).get("id")) ] )
+        projects = dict()                       # scan id -> [ project id, project name, team id ]
+        for scan in scans:
+            project = scan.get("project") or details.get( ( "scan", scan["id"] ) ) or {}
+            projects[ scan["id"] ] = [ project.get("id"), project.get("name"), scan.get("teamId") or project.get("teamId") ]
+        details = self.fetchdetails( hostname, [ ( "project", project[0] ) for project in projects.values()
+                                                 if (project[0] != None) and ((not project[1]) or (not project[2])) ] )
+        for project in projects.values():
+            detail = details.get( ( "project", project[0] ) )
+            if (detail != None):
+                project[1] = project[1] or detail.get("name")
+                project[2] = project[2] or detail.get("teamId")
+        teams = dict()
+        if (len( [ 1 for project in projects.values() if (project[2]) ] ) > 0):
+            teams = self.fetchdetails( hostname, [ ( "teams", "" ) ] ).get( ( "teams", "" ) ) or {}
+        return dict( [ ( scanid, [ str( project[1] or "" ), teams.get( str(project[2]), "" ) if (project[2]) else "" ] )
+                       for scanid, project in projects.items() ] )
+
+    def scansamples(self, engines, scans, samples, details = {}):
+        # Scans queue durations samples (metrics 2 to 5), one scan at a time
+        # details:  scan id -> [ project name, team name ], see enrich
+        # returns   ( number of scans queued, scans queued by engine id )
+        logger = logging.getLogger('cxprometheus')
         logger.debug( "CxCollector: process scans in queue and process metrics" )
+        metric2 = samples[_metric2_name]
+        metric3 = samples[_metric3_name]
+        metric4 = samples[_metric4_name]
+        metric5 = samples[_metric5_name]
+        prefix  = self.labelprefix
+        queued          = 0
+        enginequeued    = dict()
         for scan in scans:
             scanid          = scan["id"]
-            scanstatusid    = scan["stage"]["id"]           
+            scanstatusid    = scan["stage"]["id"]
             # Resolve engine details, if engine is available
             scanengineid        = "0"
             scanenginename      = ""
@@ -588,7 +2403,8 @@ class CxCollector(object):
                         scanenginelocmin    = str(engine["minLoc"])
                         scanenginelocmax    = str(engine["maxLoc"])
                         break
-            # 1=New, 2=PreScan, 3=Queued, 4=Scanning, 6=PostScan, 7=Finished, 8=Canceled, 9=Failed, 10=SourcePullingAndDeployment or 1001=None. 
+            scanlabels = prefix + [ str(scanid), scanengineid, scanenginename, scanenginelocmin, scanenginelocmax ] + details.get( scanid, [ "", "" ] )
+            # 1=New, 2=PreScan, 3=Queued, 4=Scanning, 6=PostScan, 7=Finished, 8=Canceled, 9=Failed, 10=SourcePullingAndDeployment or 1001=None.
             # Resolve duration according to statuses
             val_time        = float(0.0)
             scannew = datetime.datetime.strptime( self.processdatestring(scan["dateCreated"]), "%Y-%m-%dT%H:%M:%S.%f" ).timestamp()
@@ -596,19 +2412,22 @@ class CxCollector(object):
             # The global metrics
             if (scanstatusid == 10) or (scanstatusid >= 1 and scanstatusid <= 6): # Full
                 val_time = ( scannow - scannew ) / 60
-                metric5.add_metric( [ str(scanid), scanengineid, scanenginename, scanenginelocmin, scanenginelocmax ], val_time )
+                metric5.append( ( scanlabels, val_time ) )
             # Process according to status
             if (scanstatusid in [1, 2, 10 ]):                   # Pulling
                 val_time = ( scannow - scannew ) / 60
-                metric2.add_metric( [ str(scanid), scanengineid, scanenginename, scanenginelocmin, scanenginelocmax ], val_time )
+                metric2.append( ( scanlabels, val_time ) )
             elif (scanstatusid == 3):                           # Queued
+                queued = queued + 1
+                if (scanengineid != "0"):
+                    enginequeued[scanengineid] = enginequeued.get(scanengineid, 0) + 1
                 try:
                     scanini = datetime.datetime.strptime( self.processdatestring(scan["queuedOn"]), "%Y-%m-%dT%H:%M:%S.%f" ).timestamp()
                 except:
                     scanini = 0.0
                 if (scanini > 0.0):
                     val_time = ( scannow - scanini ) / 60
-                    metric3.add_metric( [ str(scanid), scanengineid, scanenginename, scanenginelocmin, scanenginelocmax ], val_time )
+                    metric3.append( ( scanlabels, val_time ) )
             elif (scanstatusid >= 4) and (scanstatusid <= 6):   # Scanning
                 try:
                     scanini = datetime.datetime.strptime( self.processdatestring(scan["engineStartedOn"]), "%Y-%m-%dT%H:%M:%S.%f" ).timestamp()
@@ -620,34 +2439,1615 @@ class CxCollector(object):
                     except:
                         scanend = scannow
                     val_time = ( scanend - scanini ) / 60
-                    metric4.add_metric( [ str(scanid), scanengineid, scanenginename, scanenginelocmin, scanenginelocmax ], val_time )
+                    metric4.append( ( scanlabels, val_time ) )
+        return queued, enginequeued
 
+    def datecolumn(self, dates):
+        # SAST dates to a numpy datetime column, NaT if missing or invalid
+        # dates are local times, as the timestamps they are compared with
+        try:
+            return numpy.array( dates, dtype = 'datetime64[ms]' )
+        except ValueError:
+            column = numpy.full( len(dates), numpy.datetime64('NaT'), dtype = 'datetime64[ms]' )
+            for idx, thedate in enumerate(dates):
+                timestamp = self.parsedate( thedate )
+                if (timestamp > 0.0):
+                    column[idx] = numpy.datetime64( datetime.datetime.fromtimestamp(timestamp), 'ms' )
+            return column
+
+    def scancolumns(self, engines, scans, samples, details = {}):
+        # Scans queue durations samples (metrics 2 to 5), same as scansamples but
+        # computed over numpy columns, for very large queues. Label values are only
+        # built for the scans emitted
+        # returns   ( number of scans queued, scans queued by engine id )
+        logger = logging.getLogger('cxprometheus')
+        logger.debug( "CxCollector: process scans in queue and process metrics, columnar (%d scans)", len(scans) )
+        prefix  = self.labelprefix
+        count   = len(scans)
+        # Engine label values, engine id 0 is any engine not found
+        engineslabels = dict( [ ( engine["id"], [ str(engine["id"]), str(engine["name"]), str(engine["minLoc"]), str(engine["maxLoc"]) ] ) for engine in engines ] )
+        enginenone = [ "0", "", "0", "999999999" ]
+        detailnone = [ "", "" ]
+        scanids     = [ scan["id"] for scan in scans ]
+        stages      = numpy.fromiter( ( scan["stage"]["id"] for scan in scans ), dtype = numpy.int32, count = count )
+        engineids   = [ scan["engine"]["id"] if (scan["engine"] != None) and (scan["engine"]["id"] in engineslabels) else 0 for scan in scans ]
+        created     = self.datecolumn( [ self.processdatestring(scan["dateCreated"]) for scan in scans ] )
+        queuedon    = self.datecolumn( [ scan.get("queuedOn") for scan in scans ] )
+        startedon   = self.datecolumn( [ scan.get("engineStartedOn") for scan in scans ] )
+        completedon = self.datecolumn( [ scan.get("completedOn") for scan in scans ] )
+        if (numpy.isnat(created).any()):
+            raise ValueError( "Invalid scan creation date in scans queue" )
+        scannow = numpy.datetime64( datetime.datetime.now(), 'ms' )
+        minute  = numpy.timedelta64( 60, 's' )
+        # 1=New, 2=PreScan, 3=Queued, 4=Scanning, 6=PostScan, 7=Finished, 8=Canceled, 9=Failed, 10=SourcePullingAndDeployment or 1001=None.
+        # Stage masks and durations, in minutes
+        mpulling    = (stages == 1) | (stages == 2) | (stages == 10)
+        mqueued     = (stages == 3)
+        mscanning   = (stages >= 4) & (stages <= 6)
+        mfull       = mpulling | mqueued | mscanning
+        sincenew    = ( scannow - created ) / minute
+        sincequeued = ( scannow - queuedon ) / minute
+        scanend     = numpy.where( numpy.isnat(completedon), scannow, completedon )
+        scanning    = ( scanend - startedon ) / minute
+        # Label values, shared by the metrics of the same scan
+        scanslabels = dict()
+        def emit( metricname, mask, values ):
+            metric = samples[metricname]
+            for idx, value in zip( numpy.flatnonzero(mask).tolist(), values[mask].tolist() ):
+                scanlabels = scanslabels.get(idx)
+                if (scanlabels == None):
+                    scanlabels = prefix + [ str(scanids[idx]) ] + engineslabels.get( engineids[idx], enginenone ) + details.get( scanids[idx], detailnone )
+                    scanslabels[idx] = scanlabels
+                metric.append( ( scanlabels, value ) )
+        emit( _metric5_name, mfull, sincenew )
+        emit( _metric2_name, mpulling, sincenew )
+        emit( _metric3_name, mqueued & ~numpy.isnat(queuedon), sincequeued )
+        emit( _metric4_name, mscanning & ~numpy.isnat(startedon), scanning )
+        # Queued scans, by engine
+        engineids = numpy.array( engineids, dtype = numpy.int64 )
+        ids, counts = numpy.unique( engineids[ mqueued & (engineids != 0) ], return_counts = True )
+        enginequeued = dict( zip( [ str(engineid) for engineid in ids.tolist() ], counts.tolist() ) )
+        return int( numpy.count_nonzero(mqueued) ), enginequeued
+
+    def collect(self):
+        logger = logging.getLogger('cxprometheus')
+        logger.debug( "CxCollector: running collect" )
         # Yield the metrics
-        yield metric1
-        yield metric2
-        yield metric3
-        yield metric4
-        yield metric5
+        for metric in buildmetrics( [ self.snapshot() ], len(self.labelprefix) > 0 ):
+            yield metric
+
+
+
+
+# ------------------------------------------------------------------
+# Worker process
+# ------------------------------------------------------------------
+# Runs the collectors of the targets assigned to it, answering the
+# requests sent by the aggregator through a pipe. Every request,
+# ( sequence, command, arguments ), gets one ( sequence, result ) reply
+# commands: configure   ( configurations, assigned target names )
+#           snapshot    returns list of snapshots, one per target
+#           getstate    returns dictionary of states, by target name
+#           setstate    dictionary of states, by target name
+#           events      dictionary of scan events lists, by target name
+#                       returns number of events applied
+#           stop
+# conn:     the worker end of the pipe
+# logqueue: queue where log records are sent to the main process
+# ------------------------------------------------------------------
+def cxworker( conn, logqueue ):
+    # Interruptions are handled by the main process
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if hasattr(signal, 'SIGHUP'):
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    logger = logging.getLogger('cxprometheus')
+    logger.handlers = [ logging.handlers.QueueHandler(logqueue) ]
+    collectors = collections.OrderedDict()
+    while True:
+        try:
+            seq, command, args = conn.recv()
+        except (EOFError, OSError):
+            break
+        result = None
+        try:
+            if (command == "configure"):
+                configs, assigned = args
+                applyconfigurations( configs )
+                logger.setLevel( configs['loglevel'] )
+                for name in assigned:
+                    if (name not in collectors):
+                        collectors[name] = CxCollector( name, configs['labeltarget'] )
+                for name in list(collectors.keys()):
+                    if (name not in assigned):
+                        collectors.pop(name).close()
+                for collector in collectors.values():
+                    collector.startprobing()
+            elif (command == "snapshot"):
+                result = []
+                for collector in collectors.values():
+                    try:
+                        result.append( collector.snapshot() )
+                    except Exception as err:
+                        logger.error( "Worker: target '%s' collection failed: %s", collector.target, err )
+            elif (command == "getstate"):
+                result = dict( [ ( name, collector.getstate() ) for name, collector in collectors.items() ] )
+            elif (command == "setstate"):
+                for name, state in args.items():
+                    if (name in collectors):
+                        collectors[name].setstate( state )
+            elif (command == "events"):
+                result = 0
+                for name, events in args.items():
+                    if (name in collectors):
+                        result = result + collectors[name].ingest( events )
+            elif (command == "stop"):
+                conn.send( ( seq, None ) )
+                break
+        except Exception as err:
+            logger.error( "Worker: %s failed: %s", command, err )
+        conn.send( ( seq, result ) )
+    conn.close()
+
+
+
+
+# ------------------------------------------------------------------
+# The worker process handle class
+# ------------------------------------------------------------------
+# The aggregator side of a worker process, restarting it if it dies
+# ------------------------------------------------------------------
+class CxShard(object):
+
+    def __init__(self, index, logqueue):
+        self.index          = index
+        self.logqueue       = logqueue
+        self.seq            = 0
+        self.conn           = None
+        self.process        = None
+        self.configuration  = None          # Last configure arguments, replayed on restarts
+        self.start()
+
+    def start(self):
+        logger = logging.getLogger('cxprometheus')
+        logger.debug( "CxShard: starting worker process %d", self.index )
+        self.conn, child = multiprocessing.Pipe()
+        self.process = multiprocessing.Process( target = cxworker, args = ( child, self.logqueue ), name = "cxworker-" + str(self.index), daemon = True )
+        self.process.start()
+        child.close()
+
+    def restart(self):
+        logger = logging.getLogger('cxprometheus')
+        logger.warning( "CxShard: worker process %d not responding, restarting it", self.index )
+        try:
+            self.conn.close()
+            self.process.kill()
+            self.process.join(5)
+        except Exception:
+            pass
+        self.start()
+        if (self.configuration != None):
+            self.request( "configure", self.configuration )
+
+    def send(self, command, args = None):
+        # Returns the request sequence to wait for, 0 if it could not be sent
+        if (not self.process.is_alive()):
+            self.restart()
+        self.seq = self.seq + 1
+        try:
+            self.conn.send( ( self.seq, command, args ) )
+        except (OSError, ValueError):
+            self.restart()
+            return 0
+        return self.seq
+
+    def receive(self, seq, timeout = _workertimeout):
+        # Waits for the reply to the request, replies to older requests that timed out are discarded
+        if (seq == 0):
+            return None
+        deadline = time.time() + timeout
+        try:
+            while True:
+                remaining = deadline - time.time()
+                if (remaining <= 0) or (not self.conn.poll(remaining)):
+                    break
+                rseq, result = self.conn.recv()
+                if (rseq == seq):
+                    return result
+        except (EOFError, OSError):
+            pass
+        self.restart()
+        return None
+
+    def request(self, command, args = None, timeout = _workertimeout):
+        return self.receive( self.send( command, args ), timeout )
+
+    def configure(self, configs, assigned):
+        self.configuration = ( configs, assigned )
+        self.request( "configure", self.configuration )
+
+    def stop(self):
+        try:
+            self.request( "stop", None, 5 )
+            self.process.join(5)
+        except Exception:
+            pass
+        if (self.process.is_alive()):
+            self.process.kill()
+
+
+
+
+# ------------------------------------------------------------------
+# The checkmarx aggregator class
+# ------------------------------------------------------------------
+# The collector registered for exposition. Collects all the targets,
+# in-process or spread over worker processes (see workers), and
+# merges their snapshots into the metric families
+# ------------------------------------------------------------------
+class CxAggregator(object):
+
+    def __init__(self):
+        logger = logging.getLogger('cxprometheus')
+        logger.debug( "CxAggregator: creating new instance (__init__)" )
+        self.lock           = threading.Lock()          # One collection at a time
+        self.labeltarget    = _labeltarget
+        self.collectors     = collections.OrderedDict() # In-process collectors, by target name
+        self.shards         = []                        # Worker processes
+        self.loglistener    = None
+        # Background polling, the last snapshots polled or read from the shared snapshot
+        self.polling        = (_pollinterval > 0)
+        self.poller         = None
+        self.pollstop       = threading.Event()
+        self.polled         = []
+        self.polledtime     = 0
+        self.shared         = None
+        self.leader         = True                      # This replica polls
+        self.interval       = _pollinterval             # Current interval between polls, adapted to the queue activity
+        self.activity       = None                      # Queue activity figures of the last poll
+        self.writer         = None                      # Remote write push, of every poll
+        self.startup        = 0                         # One shot runs, seconds from process start to collection
+        self.collecttime    = 0                         # Seconds the last collection on demand took
+        self.collected      = ( [], 0 )                 # Snapshots of the last collection on demand, and when
+        self.index          = None                      # Query index of the last snapshots (see queryindex)
+        self.indexlock      = threading.Lock()
+        if (_remotewrite != ""):
+            self.writer = CxRemoteWriter()
+        if (_sharedsnapshot != ""):
+            self.shared = CxSharedSnapshot( _sharedsnapshot )
+            self.leader = False
+        if (_workers > 0):
+            logger.info( "CxAggregator: collecting with %d worker processes", _workers )
+            # Worker processes log through the main process
+            self.logqueue = multiprocessing.Queue()
+            self.loglistener = logging.handlers.QueueListener( self.logqueue, _loghandler, respect_handler_level = True )
+            self.loglistener.start()
+            self.shards = [ CxShard( idx, self.logqueue ) for idx in range(_workers) ]
+        self.configure()
+
+    def assign(self, target):
+        # Stable target to worker assignment, so a target keeps its warm state on reloads
+        return zlib.crc32( target.encode('utf-8') ) % len(self.shards)
+
+    def configure(self):
+        # Apply the targets in use, keeping the collectors of the unchanged ones
+        self.lock.acquire()
+        try:
+            if (self.shards != []):
+                assigned = [ [] for shard in self.shards ]
+                for name in _targets.keys():
+                    assigned[ self.assign(name) ].append( name )
+                for shard in self.shards:
+                    shard.configure( _configs, assigned[shard.index] )
+            else:
+                for name in _targets.keys():
+                    if (name not in self.collectors):
+                        self.collectors[name] = CxCollector( name, self.labeltarget )
+                for name in list(self.collectors.keys()):
+                    if (name not in _targets):
+                        self.collectors.pop(name).close()
+                # Engine probes start with the collectors, or when a reload enables them
+                for collector in self.collectors.values():
+                    collector.startprobing()
+        finally:
+            self.lock.release()
+
+    def getstate(self):
+        # Warm state of every target, by target name
+        states = dict()
+        self.lock.acquire()
+        try:
+            if (self.shards != []):
+                for shard in self.shards:
+                    result = shard.request( "getstate" )
+                    if (result != None):
+                        states.update( result )
+            else:
+                for name, collector in self.collectors.items():
+                    states[name] = collector.getstate()
+        finally:
+            self.lock.release()
+        return { 'targets': states }
+
+    def setstate(self, state):
+        # Snapshots from a single target exporter are the unnamed target state
+        if ('targets' in state):
+            states = state['targets']
+        else:
+            states = { '': state }
+        self.lock.acquire()
+        try:
+            if (self.shards != []):
+                for shard in self.shards:
+                    shard.request( "setstate", dict( [ ( name, states[name] ) for name in states if (name in _targets) and (self.assign(name) == shard.index) ] ) )
+            else:
+                for name, collector in self.collectors.items():
+                    if (name in states):
+                        collector.setstate( states[name] )
+        finally:
+            self.lock.release()
+        return True
+
+    def snapshots(self):
+        logger = logging.getLogger('cxprometheus')
+        snapshots = []
+        self.lock.acquire()
+        try:
+            if (self.shards != []):
+                # Ask all workers first, so they collect in parallel
+                seqs = [ shard.send( "snapshot" ) for shard in self.shards ]
+                for shard, seq in zip( self.shards, seqs ):
+                    result = shard.receive( seq )
+                    if (result != None):
+                        snapshots.extend( result )
+            else:
+                for collector in self.collectors.values():
+                    try:
+                        snapshots.append( collector.snapshot() )
+                    except Exception as err:
+                        logger.error( "CxAggregator: target '%s' collection failed: %s", collector.target, err )
+        finally:
+            self.lock.release()
+        return snapshots
+
+    def ingest(self, events):
+        # Scan events (see checkevent) applied by the collector of their target
+        # returns   number of events applied
+        bytarget = collections.OrderedDict()
+        for event in events:
+            if (event["target"] in _targets):
+                bytarget.setdefault( event["target"], [] ).append( event )
+        applied = 0
+        if (self.shards != []):
+            # Workers answer requests in order, one at a time
+            self.lock.acquire()
+            try:
+                for shard in self.shards:
+                    assigned = dict( [ ( name, tevents ) for name, tevents in bytarget.items() if (self.assign(name) == shard.index) ] )
+                    if (assigned != {}):
+                        result = shard.request( "events", assigned )
+                        if (result != None):
+                            applied = applied + result
+            finally:
+                self.lock.release()
+        else:
+            for name, tevents in bytarget.items():
+                collector = self.collectors.get(name)
+                if (collector != None):
+                    applied = applied + collector.ingest( tevents )
+        return applied
+
+    def cycle(self):
+        # Collection cycles run under the profiler only while a profile is requested
+        profiler = _profiler
+        if (profiler != None):
+            return profiler.run( self.snapshots )
+        return self.snapshots()
+
+    def startpolling(self):
+        self.poller = threading.Thread( target = self.poll, name = "cxpoller", daemon = True )
+        self.poller.start()
+
+    def poll(self):
+        # ----------------------------------------------------------------------------------
+        # Background polling, every _pollinterval seconds. With replicas, only the one
+        # holding the shared snapshot lock polls, writing the snapshot the others serve
+        # ----------------------------------------------------------------------------------
+        logger = logging.getLogger('cxprometheus')
+        nextpoll = time.time()
+        while (not self.pollstop.is_set()):
+            if (not self.leader):
+                self.leader = self.shared.trylock()
+                if (self.leader):
+                    logger.info( "CxAggregator: polling SAST, for all the replicas sharing %s", _sharedsnapshot )
+                    nextpoll = time.time()
+            if (self.leader) and (time.time() >= nextpoll):
+                pollstart = time.time()
+                snapshots = self.cycle()
+                self.polled     = snapshots
+                self.polledtime = time.time()
+                self.adapt( snapshots )
+                nextpoll = pollstart + self.interval
+                if (self.writer != None):
+                    self.writer.enqueue( buildmetrics( snapshots, self.labeltarget ), self.polledtime )
+                if (self.shared != None):
+                    try:
+                        self.shared.write( snapshots, self.polledtime )
+                    except (OSError, ValueError) as err:
+                        logger.error( "CxAggregator: unable to write the shared snapshot: %s", err )
+            self.pollstop.wait( max( min( nextpoll - time.time(), 1 ), 0 ) )
+
+    def adapt(self, snapshots):
+        # ----------------------------------------------------------------------------------
+        # Adapts the interval between polls, within _pollmin and _pollmax, to the queue
+        # activity: back to the minimum when the queue grows, halved when scans change
+        # stage, 50% longer when nothing changed since the previous poll
+        # ----------------------------------------------------------------------------------
+        logger = logging.getLogger('cxprometheus')
+        pollmin = _pollmin or _pollinterval
+        pollmax = _pollmax or _pollinterval
+        # Scans started, finished, queued, slots busy and scans in the queue
+        activity = [ 0, 0, 0, 0, 0 ]
+        for snapshot in snapshots:
+            activity[0] += sum( [ value for labels, value in snapshot.get(_metric6_name, []) ] )
+            activity[1] += sum( [ value for labels, value in snapshot.get(_metric7_name, []) ] )
+            activity[2] += sum( [ value for labels, value in snapshot.get(_metric16_name, []) ] )
+            activity[3] += sum( [ value for labels, value in snapshot.get(_metric15_name, []) ] )
+            activity[4] += len( snapshot.get(_metric5_name, []) )
+        interval = self.interval
+        if (self.activity != None):
+            if (activity[2] > self.activity[2]):
+                interval = pollmin
+            elif (activity != self.activity):
+                interval = interval / 2
+            else:
+                interval = interval * 1.5
+        interval = max( min( interval, pollmax ), pollmin )
+        if (interval != self.interval):
+            logger.debug( "CxAggregator: poll interval now %.1f seconds", interval )
+        self.interval = interval
+        self.activity = activity
+
+    def current(self):
+        # The snapshots polled last, by this replica or by the one polling
+        if (self.leader) or (self.shared == None):
+            return self.polled, self.polledtime
+        try:
+            return self.shared.read()
+        except (OSError, ValueError) as err:
+            logger = logging.getLogger('cxprometheus')
+            logger.error( "CxAggregator: unable to read the shared snapshot: %s", err )
+            return [], 0
+
+    def queryindex(self):
+        # Query index of the snapshots served last, built once for each of them
+        # returns   the index (see CxQueryIndex), None if nothing was collected yet
+        if (self.polling):
+            snapshots, timestamp = self.current()
+        else:
+            snapshots, timestamp = self.collected
+        if (timestamp <= 0):
+            return None
+        self.indexlock.acquire()
+        try:
+            if (self.index == None) or (self.index.timestamp != timestamp):
+                self.index = CxQueryIndex( snapshots, timestamp, self.labeltarget )
+            return self.index
+        finally:
+            self.indexlock.release()
+
+    def exportermetrics(self, polledtime = 0):
+        metrics = []
+        if (self.polling):
+            metric = GaugeMetricFamily( _metricp1_name, _metricp1_desc )
+            metric.add_metric( [], int(self.leader) )
+            metrics.append( metric )
+            metric = GaugeMetricFamily( _metricp2_name, _metricp2_desc )
+            if (polledtime > 0):
+                metric.add_metric( [], time.time() - polledtime )
+            metrics.append( metric )
+            metric = GaugeMetricFamily( _metricp3_name, _metricp3_desc )
+            if (self.leader):
+                metric.add_metric( [], self.interval )
+            metrics.append( metric )
+        if (self.writer != None):
+            metrics = metrics + self.writer.metrics()
+        if (self.startup > 0):
+            metric = GaugeMetricFamily( _metrico1_name, _metrico1_desc )
+            metric.add_metric( [], self.startup )
+            metrics.append( metric )
+            metric = GaugeMetricFamily( _metrico2_name, _metrico2_desc )
+            metric.add_metric( [], self.collecttime )
+            metrics.append( metric )
+            metric = GaugeMetricFamily( _metrico3_name, _metrico3_desc )
+            metric.add_metric( [], time.time() )
+            metrics.append( metric )
+        return metrics
+
+    def describe(self):
+        for metric in buildmetrics( [], self.labeltarget ) + self.exportermetrics():
+            yield metric
+
+    def collect(self):
+        logger = logging.getLogger('cxprometheus')
+        logger.debug( "CxAggregator: running collect" )
+        if (self.polling):
+            snapshots, polledtime = self.current()
+        else:
+            clock = time.time()
+            snapshots, polledtime = self.cycle(), 0
+            self.collecttime = time.time() - clock
+            self.collected   = ( snapshots, time.time() )
+        for metric in buildmetrics( snapshots, self.labeltarget ) + self.exportermetrics( polledtime ):
+            yield metric
+
+    def stop(self):
+        if (self.poller != None):
+            self.pollstop.set()
+            self.poller.join( _workertimeout )
+        if (self.writer != None):
+            self.writer.stop()
+        if (self.shared != None):
+            self.shared.close()
+        for collector in self.collectors.values():
+            collector.close()
+        for shard in self.shards:
+            shard.stop()
+        if (self.loglistener != None):
+            self.loglistener.stop()
+
+
+
+
+# ------------------------------------------------------------------
+# The shared snapshot class
+# ------------------------------------------------------------------
+# Snapshots polled by one replica, served by all, through a memory
+# mapped file. The replica holding the lock file (file name + .lock)
+# writes it, the lock being released if the process dies.
+# Layout: header (magic, sequence, timestamp, length) + json payload
+# The sequence is odd while writing. The file only grows, so that
+# readers never access beyond its end
+# ------------------------------------------------------------------
+class CxSharedSnapshot(object):
+
+    def __init__(self, filename):
+        self.filename   = filename
+        self.lockfd     = None
+        self.fd         = None
+        self.map        = None
+        self.seq        = 0                     # Sequence of the snapshots read last
+        self.snapshots  = []
+        self.timestamp  = 0
+
+    def trylock(self):
+        if (self.lockfd == None):
+            self.lockfd = os.open( self.filename + ".lock", os.O_RDWR | os.O_CREAT, 0o600 )
+        try:
+            if (fcntl != None):
+                fcntl.lockf( self.lockfd, fcntl.LOCK_EX | fcntl.LOCK_NB )
+            else:
+                msvcrt.locking( self.lockfd, msvcrt.LK_NBLCK, 1 )
+        except OSError:
+            return False
+        return True
+
+    def mapfile(self, size = 0):
+        # (Re)maps the whole file, growing it to size first, if larger
+        if (self.fd == None):
+            self.fd = os.open( self.filename, os.O_RDWR | os.O_CREAT, 0o600 )
+        if (size > os.fstat(self.fd).st_size):
+            os.ftruncate( self.fd, size )
+        filesize = os.fstat(self.fd).st_size
+        if (self.map == None) or (len(self.map) != filesize):
+            if (self.map != None):
+                self.map.close()
+                self.map = None
+            if (filesize >= _sharedheader.size):
+                self.map = mmap.mmap( self.fd, filesize )
+        return self.map
+
+    def write(self, snapshots, timestamp):
+        payload = json.dumps( snapshots, separators = (',', ':') ).encode('utf-8')
+        size = _sharedheader.size + len(payload)
+        smap = self.mapfile()
+        if (smap == None) or (len(smap) < size):
+            smap = self.mapfile( max( size, 2 * len(smap or b"") ) )
+        magic, seq, stimestamp, length = _sharedheader.unpack_from( smap, 0 )
+        if (magic != _sharedmagic):
+            seq = 0
+        seq = seq + 1 + (seq % 2)
+        _sharedheader.pack_into( smap, 0, _sharedmagic, seq, stimestamp, length )
+        smap[ _sharedheader.size : size ] = payload
+        _sharedheader.pack_into( smap, 0, _sharedmagic, seq + 1, timestamp, len(payload) )
+        smap.flush()
+
+    def read(self):
+        # returns   ( snapshots, timestamp ) written last, the ones read before if being written
+        for attempt in range(5):
+            smap = self.mapfile()
+            if (smap == None):
+                break
+            magic, seq, timestamp, length = _sharedheader.unpack_from( smap, 0 )
+            if (magic != _sharedmagic) or (seq == self.seq):
+                break
+            if (seq % 2 == 1) or (_sharedheader.size + length > len(smap)):
+                time.sleep( 0.01 )
+                continue
+            payload = smap[ _sharedheader.size : _sharedheader.size + length ]
+            if (_sharedheader.unpack_from( smap, 0 )[1] == seq):
+                self.snapshots  = json.loads( payload.decode('utf-8') )
+                self.timestamp  = timestamp
+                self.seq        = seq
+                break
+        return self.snapshots, self.timestamp
+
+    def close(self):
+        if (self.map != None):
+            self.map.close()
+            self.map = None
+        if (self.fd != None):
+            os.close( self.fd )
+            self.fd = None
+        if (self.lockfd != None):
+            os.close( self.lockfd )
+            self.lockfd = None
+
+
+
+
+# ------------------------------------------------------------------
+# The query index class
+# ------------------------------------------------------------------
+# Scans and engines of a set of snapshots (see CxCollector.snapshot),
+# indexed for the query api: scans by id, by engine and by stage,
+# sorted by minutes in the stage, so that answering a query costs
+# the size of its result. Built once for each snapshot served
+# snapshots:    the snapshots, as served
+# timestamp:    when they were collected
+# labeltarget:  true if the samples carry the target label
+# ------------------------------------------------------------------
+class CxQueryIndex(object):
+
+    def __init__(self, snapshots, timestamp, labeltarget):
+        self.timestamp  = timestamp
+        self.offset     = 1 if (labeltarget) else 0     # Target label position, if any
+        self.scans      = dict()                        # scan labels -> scan (dicts keep the queue order)
+        self.engines    = dict()                        # ( target, engine id ) -> engine
+        self.byscan     = dict()                        # scan id -> scans, one by target
+        # Scans by target, None for all the targets, so that queries slice the page they answer
+        self.byqueue    = dict()                        # target -> scans, in queue order
+        self.byengine   = dict()                        # ( target, engine id ) -> scans, in queue order
+        self.bystage    = dict()                        # ( target, stage, "" for any ) -> ( minutes ascending, scans )
+        for snapshot in snapshots:
+            for labels, value in snapshot.get(_metric5_name, []):
+                self.scan( labels )['minutes'] = value
+            for metricname, stage in _apistages.items():
+                for labels, value in snapshot.get(metricname, []):
+                    scan = self.scan( labels )
+                    scan['stage'] = stage
+                    scan['stageMinutes'] = value
+            for metricname, field in _apiengines.items():
+                for labels, value in snapshot.get(metricname, []):
+                    self.engine( labels )[field] = value
+        stages = dict()
+        for scan in self.scans.values():
+            self.byscan.setdefault( scan['scanId'], [] ).append( scan )
+            if (scan['engineId'] != 0):
+                engine = self.engines.get( ( scan.get('target'), scan['engineId'] ) )
+                if (engine != None):
+                    engine['scans'] += 1
+            for target in ( [ None, scan['target'] ] if ('target' in scan) else [ None ] ):
+                self.byqueue.setdefault( target, [] ).append( scan )
+                if (scan['engineId'] != 0):
+                    self.byengine.setdefault( ( target, scan['engineId'] ), [] ).append( scan )
+                if ('stage' in scan):
+                    stages.setdefault( ( target, scan['stage'] ), [] ).append( scan )
+        for target, scans in self.byqueue.items():
+            stages[ ( target, "" ) ] = list( scans )
+        for key, scans in stages.items():
+            field = 'stageMinutes' if (key[1] != "") else 'minutes'
+            scans.sort( key = lambda scan: scan.get( field, 0.0 ) )
+            self.bystage[key] = ( [ scan.get( field, 0.0 ) for scan in scans ], scans )
+
+    def identifier(self, value):
+        # Scan and engine ids, as numbers, -1 if invalid
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            return -1
+
+    def scan(self, labels):
+        # The scan of the samples labels ( [ target ], scan id, engine id, engine name, min loc, max loc, project name, team name )
+        offset = self.offset
+        key = labels[offset] if (offset == 0) else ( labels[0], labels[1] )
+        scan = self.scans.get(key)
+        if (scan == None):
+            scan = { 'scanId': self.identifier( labels[offset] ), 'engineId': self.identifier( labels[offset + 1] ), 'engineName': labels[offset + 2],
+                     'locMin': self.identifier( labels[offset + 3] ), 'locMax': self.identifier( labels[offset + 4] ),
+                     'projectName': labels[offset + 5], 'teamName': labels[offset + 6] }
+            if (offset > 0):
+                scan = dict( [ ( 'target', labels[0] ) ] + list( scan.items() ) )
+            self.scans[key] = scan
+        return scan
+
+    def engine(self, labels):
+        # The engine of the samples labels ( [ target ], engine id, engine name )
+        offset = self.offset
+        target = labels[0] if (offset > 0) else None
+        key = ( target, self.identifier( labels[offset] ) )
+        engine = self.engines.get(key)
+        if (engine == None):
+            engine = dict()
+            if (target != None):
+                engine['target'] = target
+            engine['engineId']      = key[1]
+            engine['engineName']    = labels[offset + 1]
+            engine['scans']         = 0
+            self.engines[key] = engine
+        return engine
+
+    def aged(self, scan, elapsed):
+        # The scan minutes, as of now
+        scan = dict( scan )
+        scan['minutes'] = scan.get('minutes', 0.0) + elapsed
+        if ('stageMinutes' in scan):
+            scan['stageMinutes'] = scan['stageMinutes'] + elapsed
+        return scan
+
+    def enginerecords(self, engineid = None, target = None):
+        engineid = self.identifier( engineid ) if (engineid != None) else None
+        return [ engine for key, engine in self.engines.items() if ((target == None) or (key[0] == target)) and ((engineid == None) or (key[1] == engineid)) ]
+
+    def scanrecord(self, scanid, target = None):
+        elapsed = ( time.time() - self.timestamp ) / 60
+        return [ self.aged( scan, elapsed ) for scan in self.byscan.get( self.identifier(scanid), [] ) if (target == None) or (scan.get('target') == target) ]
+
+    def scanrecords(self, engineid = None, stage = None, olderthan = None, target = None, limit = _apilimit, offset = 0):
+        # Scans matching all the criteria, the page from offset, the oldest first when by age. Pages
+        # are sliced from the index that answers the query, only the engine scans being filtered
+        # when both by engine and by stage or age
+        # returns   ( scans, up to limit, number of scans matching )
+        elapsed = ( time.time() - self.timestamp ) / 60
+        field   = 'stageMinutes' if (stage != None) else 'minutes'
+        limit   = max( limit, 0 )
+        offset  = max( offset, 0 )
+        if (engineid != None):
+            scans = self.byengine.get( ( target, self.identifier( engineid ) ), [] )
+            if (stage != None) or (olderthan != None):
+                scans = [ scan for scan in scans if ((stage == None) or (scan.get('stage') == stage)) and
+                                                    ((olderthan == None) or (scan.get(field, 0.0) + elapsed >= olderthan)) ]
+                if (olderthan != None):
+                    scans.sort( key = lambda scan: scan.get( field, 0.0 ), reverse = True )
+            return [ self.aged( scan, elapsed ) for scan in scans[ offset : offset + limit ] ], len(scans)
+        if (olderthan == None):
+            if (stage != None):
+                scans = self.bystage.get( ( target, stage ), ( [], [] ) )[1]
+            else:
+                scans = self.byqueue.get( target, [] )
+            return [ self.aged( scan, elapsed ) for scan in scans[ offset : offset + limit ] ], len(scans)
+        # By age, the oldest last in the index
+        minutes, scans = self.bystage.get( ( target, stage or "" ), ( [], [] ) )
+        lower = bisect.bisect_left( minutes, olderthan - elapsed )
+        upper = max( len(scans) - offset, lower )
+        return [ self.aged( scan, elapsed ) for scan in reversed( scans[ max( upper - limit, lower ) : upper ] ) ], len(scans) - lower
+
+
+
+
+# ------------------------------------------------------------------
+# Remote write encoding
+# ------------------------------------------------------------------
+# Prometheus remote write request (protobuf WriteRequest), encoded
+# directly, without the protobuf runtime:
+#   WriteRequest { repeated TimeSeries timeseries = 1 }
+#   TimeSeries   { repeated Label labels = 1, repeated Sample samples = 2 }
+#   Label        { string name = 1, string value = 2 }
+#   Sample       { double value = 1, int64 timestamp = 2 }
+# series:   list of ( labels, value, timestamp ), labels being a list
+#           of ( name, value ) sorted by name, timestamp in ms
+# returns:  the request body, snappy compressed
+# ------------------------------------------------------------------
+def protovarint( value ):
+    encoded = bytearray()
+    while (value > 0x7f):
+        encoded.append( (value & 0x7f) | 0x80 )
+        value = value >> 7
+    encoded.append( value )
+    return bytes(encoded)
+
+def protofield( number, payload ):
+    # Length delimited field
+    return protovarint( (number << 3) | 2 ) + protovarint( len(payload) ) + payload
+
+def snappyblock( data ):
+    # Snappy block format, literals only when python-snappy is not available
+    if (snappy != None):
+        return snappy.compress( data )
+    block = bytearray( protovarint( len(data) ) )
+    for pos in range( 0, len(data), 65536 ):
+        chunk = data[ pos : pos + 65536 ]
+        if (len(chunk) <= 60):
+            block.append( (len(chunk) - 1) << 2 )
+        else:
+            block.append( 61 << 2 )
+            block.extend( struct.pack( "<H", len(chunk) - 1 ) )
+        block.extend( chunk )
+    return bytes(block)
+
+def remotewriterequest( series ):
+    request = bytearray()
+    for labels, value, timestamp in series:
+        payload = bytearray()
+        for name, lvalue in labels:
+            payload.extend( protofield( 1, protofield( 1, name.encode('utf-8') ) + protofield( 2, lvalue.encode('utf-8') ) ) )
+        payload.extend( protofield( 2, b"\x09" + struct.pack( "<d", value ) + b"\x10" + protovarint( timestamp ) ) )
+        request.extend( protofield( 1, bytes(payload) ) )
+    return snappyblock( bytes(request) )
+
+
+
+
+# ------------------------------------------------------------------
+# The remote write class
+# ------------------------------------------------------------------
+# Pushes the snapshots of every background poll to a Prometheus
+# remote write endpoint, every _remotewriteflush seconds, in batches
+# of _remotewritebatch samples. Samples not sent are retried, with
+# backoff, kept in a buffer of _remotewritebuffer samples at most
+# (the oldest being dropped) and saved to _remotewritespool on stop.
+# Requests rejected by the endpoint (4xx other than 429) are dropped.
+# Samples come from the background polls, which remote write requires,
+# never from collections of its own
+# ------------------------------------------------------------------
+class CxRemoteWriter(object):
+
+    def __init__(self):
+        self.lock       = threading.Lock()
+        self.pending    = collections.deque()       # ( labels, value, timestamp ) waiting to be sent
+        self.session    = requests.Session()
+        self.thread     = None
+        self.stopevent  = threading.Event()
+        self.backoff    = 0                         # Seconds to wait before retrying, after failures
+        self.retryat    = 0                         # Time of the next retry, after failures
+        self.sent       = 0
+        self.dropped    = 0
+        self.failures   = 0
+        self.load()
+
+    def load(self):
+        # Samples left by the previous run
+        if (_remotewritespool == "") or (not os.path.exists(_remotewritespool)):
+            return
+        logger = logging.getLogger('cxprometheus')
+        try:
+            fp = open( _remotewritespool, 'r' )
+            try:
+                series = json.load(fp)
+            finally:
+                fp.close()
+            self.append( [ ( [ tuple(label) for label in labels ], value, timestamp ) for labels, value, timestamp in series ] )
+            logger.info( "CxRemoteWriter: %d samples not yet pushed loaded from %s", len(self.pending), _remotewritespool )
+        except (OSError, ValueError, TypeError) as err:
+            logger.error( "CxRemoteWriter: unable to load %s: %s", _remotewritespool, err )
+
+    def save(self):
+        # Samples not sent, for the next run, replacing the file at once
+        if (_remotewritespool == ""):
+            return
+        logger = logging.getLogger('cxprometheus')
+        self.lock.acquire()
+        try:
+            series = list(self.pending)
+        finally:
+            self.lock.release()
+        try:
+            if (series == []):
+                if (os.path.exists(_remotewritespool)):
+                    os.remove( _remotewritespool )
+                return
+            folder = os.path.dirname( os.path.abspath(_remotewritespool) )
+            fd, tempname = tempfile.mkstemp( dir = folder, prefix = ".cxspool" )
+            fp = os.fdopen( fd, 'w' )
+            try:
+                json.dump( series, fp, separators = (',', ':') )
+            finally:
+                fp.close()
+            os.replace( tempname, _remotewritespool )
+            logger.info( "CxRemoteWriter: %d samples not yet pushed saved to %s", len(series), _remotewritespool )
+        except OSError as err:
+            logger.error( "CxRemoteWriter: unable to save %s: %s", _remotewritespool, err )
+
+    def append(self, series):
+        self.lock.acquire()
+        try:
+            self.pending.extend( series )
+            overflow = len(self.pending) - _remotewritebuffer
+            for idx in range(overflow):
+                self.pending.popleft()
+            if (overflow > 0):
+                self.dropped += overflow
+        finally:
+            self.lock.release()
+        if (overflow > 0):
+            logger = logging.getLogger('cxprometheus')
+            logger.warning( "CxRemoteWriter: buffer full, %d oldest samples dropped", overflow )
+
+    def enqueue(self, metrics, timestamp):
+        # The samples of the metric families, as exposed on /metrics, with the extra labels
+        timestamp = int( timestamp * 1000 )
+        extra = [ ( str(name), str(value) ) for name, value in _remotewritelabels.items() ]
+        series = []
+        for metric in metrics:
+            for sample in metric.samples:
+                labels = dict( extra )
+                labels.update( sample.labels )
+                labels['__name__'] = sample.name
+                series.append( ( sorted( labels.items() ), float(sample.value), timestamp ) )
+        self.append( series )
+
+    def flush(self):
+        # Sends the pending samples, batch by batch, until done or failing
+        # returns   true if nothing is left pending
+        logger = logging.getLogger('cxprometheus')
+        headers = { 'Content-Encoding': 'snappy', 'Content-Type': 'application/x-protobuf',
+                    'User-Agent': 'cxprometheus/' + __version__, 'X-Prometheus-Remote-Write-Version': '0.1.0' }
+        headers.update( _remotewriteheaders )
+        while (not self.stopevent.is_set()):
+            self.lock.acquire()
+            try:
+                batch = [ self.pending[idx] for idx in range( min( _remotewritebatch, len(self.pending) ) ) ]
+            finally:
+                self.lock.release()
+            if (batch == []):
+                return True
+            try:
+                response = self.session.post( _remotewrite, data = remotewriterequest( batch ), headers = headers, timeout = _remotewritetimeout )
+                status = response.status_code
+                if (status >= 400) and (status < 500) and (status != 429):
+                    logger.error( "CxRemoteWriter: %d samples rejected: %s, %s", len(batch), status, response.text[:200] )
+                elif (status >= 300):
+                    raise requests.RequestException( "HTTP " + str(status) )
+            except requests.RequestException as err:
+                self.failures += 1
+                self.backoff = min( max( 2 * self.backoff, _remotewriteflush ), _remotewritebackoff )
+                self.retryat = time.time() + self.backoff
+                logger.warning( "CxRemoteWriter: push failed, %d samples pending, retrying in %d seconds: %s", len(self.pending), self.backoff, err )
+                return False
+            self.lock.acquire()
+            try:
+                # Some of the samples sent may have been dropped meanwhile (buffer full)
+                sentids = set( [ id(item) for item in batch ] )
+                while (len(self.pending) > 0) and (id(self.pending[0]) in sentids):
+                    self.pending.popleft()
+                if (status < 300):
+                    self.sent += len(batch)
+                else:
+                    self.dropped += len(batch)
+            finally:
+                self.lock.release()
+            self.backoff = 0
+        return False
+
+    def start(self):
+        logger = logging.getLogger('cxprometheus')
+        logger.info( "CxRemoteWriter: pushing to %s every %s seconds", _remotewrite, _remotewriteflush )
+        self.thread = threading.Thread( target = self.run, name = "cxremotewrite", daemon = True )
+        self.thread.start()
+
+    def run(self):
+        while (not self.stopevent.wait( _remotewriteflush )):
+            if (time.time() >= self.retryat):
+                self.flush()
+
+    def metrics(self):
+        metrics = []
+        metric = GaugeMetricFamily( _metricr1_name, _metricr1_desc )
+        metric.add_metric( [], len(self.pending) )
+        metrics.append( metric )
+        metric = CounterMetricFamily( _metricr2_name, _metricr2_desc )
+        metric.add_metric( [], self.sent )
+        metrics.append( metric )
+        metric = CounterMetricFamily( _metricr3_name, _metricr3_desc )
+        metric.add_metric( [], self.dropped )
+        metrics.append( metric )
+        metric = CounterMetricFamily( _metricr4_name, _metricr4_desc )
+        metric.add_metric( [], self.failures )
+        metrics.append( metric )
+        return metrics
+
+    def stop(self):
+        if (self.thread != None):
+            self.stopevent.set()
+            self.thread.join( _remotewritetimeout )
+            # Last chance for what is pending, the rest kept for the next run
+            self.stopevent.clear()
+            if (self.backoff == 0):
+                self.flush()
+        self.save()
+
+
+
+
+# ------------------------------------------------------------------
+# The profiler class
+# ------------------------------------------------------------------
+# Profiles the next collection cycles, one at a time, by mode
+# cprofile:     deterministic profile, as pstats or text
+# sampling:     stacks of the collecting thread sampled every
+#               _profileinterval seconds, as collapsed stacks
+# tracemalloc:  memory snapshots before the first and after the
+#               last cycle, as text (differences) or snapshot dump
+# ------------------------------------------------------------------
+class CxProfiler(object):
+
+    def __init__(self, mode, cycles):
+        self.mode       = mode
+        self.cycles     = cycles
+        self.done       = 0                     # Cycles profiled
+        self.started    = time.time()
+        self.finished   = 0                     # Timestamp finished, 0 while profiling
+        self.lock       = threading.Lock()      # One profiled cycle at a time
+        self.profile    = None                  # cprofile, the profiler and then its stats
+        self.stats      = None
+        self.thread     = None                  # sampling, the thread being sampled, if any
+        self.stacks     = collections.Counter()
+        self.sampler    = None
+        self.samplerstop = threading.Event()
+        self.tracing    = False                 # tracemalloc, started by this profile
+        self.snapshots  = []
+        if (mode == "cprofile"):
+            self.profile = cProfile.Profile()
+
+    def run(self, func):
+        # Runs one collection cycle, func, under the profiler
+        self.lock.acquire()
+        try:
+            if (self.finished > 0):
+                return func()
+            if (self.mode == "cprofile"):
+                self.profile.enable()
+            elif (self.mode == "sampling"):
+                self.thread = threading.get_ident()
+                if (self.sampler == None):
+                    self.sampler = threading.Thread( target = self.sample, name = "cxprofiler", daemon = True )
+                    self.sampler.start()
+            elif (self.mode == "tracemalloc") and (self.done == 0):
+                if (not tracemalloc.is_tracing()):
+                    tracemalloc.start( 25 )
+                    self.tracing = True
+                self.snapshots.append( tracemalloc.take_snapshot() )
+            try:
+                return func()
+            finally:
+                if (self.mode == "cprofile"):
+                    self.profile.disable()
+                elif (self.mode == "sampling"):
+                    self.thread = None
+                self.done = self.done + 1
+                if (self.done >= self.cycles):
+                    self.finish()
+        finally:
+            self.lock.release()
+
+    def sample(self):
+        # Collapsed stacks of the thread running a collection cycle, root first
+        while (not self.samplerstop.wait( _profileinterval )):
+            thread = self.thread
+            if (thread == None):
+                continue
+            frame = sys._current_frames().get( thread )
+            stack = []
+            while (frame != None):
+                code = frame.f_code
+                stack.append( "%s (%s:%d)" % ( code.co_name, os.path.basename(code.co_filename), code.co_firstlineno ) )
+                frame = frame.f_back
+            if (stack != []):
+                self.stacks[ ";".join( reversed(stack) ) ] += 1
+
+    def stop(self):
+        # Finishes the profile before all the cycles requested were run
+        self.lock.acquire()
+        try:
+            self.finish()
+        finally:
+            self.lock.release()
+
+    def finish(self):
+        # Called with the lock held
+        if (self.finished > 0):
+            return
+        self.finished = time.time()
+        if (self.mode == "cprofile"):
+            if (self.done > 0):
+                self.stats = pstats.Stats( self.profile )
+            self.profile = None
+        elif (self.mode == "sampling") and (self.sampler != None):
+            self.samplerstop.set()
+            self.sampler.join()
+        elif (self.mode == "tracemalloc") and (self.snapshots != []):
+            self.snapshots.append( tracemalloc.take_snapshot() )
+            if (self.tracing):
+                tracemalloc.stop()
+        finishprofile( self )
+
+    def status(self):
+        return { 'mode': self.mode, 'cycles': self.cycles, 'done': self.done, 'started': self.started,
+                 'finished': self.finished, 'formats': _profileformats[self.mode] }
+
+    def result(self, format):
+        # returns   ( content type, file name, content ), None if nothing to download in the format
+        filename = "cxprometheus_" + self.mode + "_" + time.strftime( "%Y%m%d%H%M%S", time.localtime(self.started) )
+        if (self.mode == "cprofile") and (self.stats != None):
+            if (format == "pstats"):
+                return ( "application/octet-stream", filename + ".pstats", marshal.dumps( self.stats.stats ) )
+            elif (format == "text"):
+                stream = io.StringIO()
+                pstats.Stats( stream = stream ).add( self.stats ).sort_stats( "cumulative" ).print_stats( 50 )
+                return ( "text/plain; charset=utf-8", filename + ".txt", stream.getvalue().encode('utf-8') )
+        elif (self.mode == "sampling") and (format == "collapsed"):
+            lines = [ stack + " " + str(count) + "\n" for stack, count in self.stacks.most_common() ]
+            return ( "text/plain; charset=utf-8", filename + ".collapsed", "".join(lines).encode('utf-8') )
+        elif (self.mode == "tracemalloc") and (len(self.snapshots) == 2):
+            if (format == "text"):
+                lines = [ str(stat) + "\n" for stat in self.snapshots[1].compare_to( self.snapshots[0], "lineno" )[:50] ]
+                return ( "text/plain; charset=utf-8", filename + ".txt", "".join(lines).encode('utf-8') )
+            elif (format == "snapshot"):
+                fd, tmpname = tempfile.mkstemp( suffix = ".tracemalloc" )
+                os.close( fd )
+                try:
+                    self.snapshots[1].dump( tmpname )
+                    fp = open( tmpname, 'rb' )
+                    try:
+                        content = fp.read()
+                    finally:
+                        fp.close()
+                finally:
+                    os.remove( tmpname )
+                return ( "application/octet-stream", filename + ".tracemalloc", content )
+        return None
+
+
+
+
+# ------------------------------------------------------------------
+# Start and finish profiles
+# ------------------------------------------------------------------
+# mode:     cprofile, sampling or tracemalloc
+# cycles:   collection cycles to profile
+# returns   the profile started, None if another one is in progress
+# ------------------------------------------------------------------
+def startprofile( mode, cycles ):
+    global _profiler
+    logger = logging.getLogger('cxprometheus')
+    _profilelock.acquire()
+    try:
+        if (_profiler != None):
+            return None
+        _profiler = CxProfiler( mode, cycles )
+        logger.info( "Profiling: %s profile of the next %d collection cycles started", mode, cycles )
+        return _profiler
+    finally:
+        _profilelock.release()
+
+
+def finishprofile( profiler ):
+    global _profiler
+    global _profileresult
+    logger = logging.getLogger('cxprometheus')
+    _profilelock.acquire()
+    try:
+        if (_profiler == profiler):
+            _profiler = None
+        _profileresult = profiler
+        logger.info( "Profiling: %s profile finished after %d collection cycles", profiler.mode, profiler.done )
+    finally:
+        _profilelock.release()
+
+
+
+
+# ------------------------------------------------------------------
+# Exporter http server
+# ------------------------------------------------------------------
+# Serves the metrics on any path, as the prometheus client does, and
+# the extra routes given, each one a wsgi application by path prefix
+# port:     listening port
+# registry: the metrics registry
+# routes:   dictionary of wsgi applications by path prefix
+# returns   the server, serving from a background thread
+# ------------------------------------------------------------------
+class CxHTTPServer(socketserver.ThreadingMixIn, wsgiref.simple_server.WSGIServer):
+    daemon_threads = True
+
+
+class CxHTTPHandler(wsgiref.simple_server.WSGIRequestHandler):
+
+    def log_message(self, format, *args):
+        # Requests are not logged
+        pass
+
+
+def startserver( port, registry, routes = {} ):
+    metricsapp = make_wsgi_app( registry )
+    def application( environ, start_response ):
+        path = environ.get('PATH_INFO', '/')
+        for prefix, app in routes.items():
+            if (path == prefix) or (path.startswith(prefix + "/")):
+                return app( environ, start_response )
+        return metricsapp( environ, start_response )
+    server = wsgiref.simple_server.make_server( "0.0.0.0", port, application, CxHTTPServer, CxHTTPHandler )
+    thread = threading.Thread( target = server.serve_forever, name = "cxhttpserver", daemon = True )
+    thread.start()
+    return server
+
+
+def httpauthorized( environ, token ):
+    # Requests shall carry the bearer token, if one is configured
+    if (token == ""):
+        return True
+    authorization = environ.get('HTTP_AUTHORIZATION', '')
+    return hmac.compare_digest( authorization.encode('utf-8'), ( "Bearer " + token ).encode('utf-8') )
+
+
+def httpresponse( start_response, status, content = b"", contenttype = "application/json", headers = [] ):
+    start_response( status, [ ( "Content-Type", contenttype ), ( "Content-Length", str(len(content)) ) ] + headers )
+    return [ content ]
+
+
+def jsonresponse( start_response, status, document ):
+    return httpresponse( start_response, status, json.dumps( document ).encode('utf-8') )
+
+
+
+
+# ------------------------------------------------------------------
+# Profiling endpoint
+# ------------------------------------------------------------------
+# Only answers when profiling is enabled (profiling), and with the
+# bearer token configured (profiletoken), mandatory with profiling
+# POST /debug/profile?mode=cprofile&cycles=N   start profiling
+# GET  /debug/profile                          status
+# POST /debug/profile/stop                     finish now
+# GET  /debug/profile/result?format=pstats     download
+# ------------------------------------------------------------------
+def profileapp( environ, start_response ):
+    if (not _profiling):
+        return httpresponse( start_response, "404 Not Found" )
+    if (not httpauthorized( environ, _profiletoken )):
+        return jsonresponse( start_response, "401 Unauthorized", { 'error': "Missing or invalid token" } )
+    path    = environ.get('PATH_INFO', '/').rstrip("/")
+    method  = environ.get('REQUEST_METHOD', 'GET')
+    query   = urllib.parse.parse_qs( environ.get('QUERY_STRING', '') )
+    if (path == "/debug/profile") and (method == "POST"):
+        mode = query.get('mode', [ "cprofile" ])[0]
+        if (mode not in _profileformats):
+            return jsonresponse( start_response, "400 Bad Request", { 'error': "Invalid mode, shall be one of " + ", ".join(_profileformats.keys()) } )
+        try:
+            cycles = int( query.get('cycles', [ "1" ])[0] )
+        except ValueError:
+            cycles = 0
+        if (cycles < 1) or (cycles > _profilemaxcycles):
+            return jsonresponse( start_response, "400 Bad Request", { 'error': "Invalid cycles, shall be 1 to " + str(_profilemaxcycles) } )
+        profiler = startprofile( mode, cycles )
+        if (profiler == None):
+            return jsonresponse( start_response, "409 Conflict", { 'error': "Another profile is in progress" } )
+        return jsonresponse( start_response, "202 Accepted", profiler.status() )
+    elif (path == "/debug/profile") and (method == "GET"):
+        document = { 'active': None, 'last': None }
+        if (_profiler != None):
+            document['active'] = _profiler.status()
+        if (_profileresult != None):
+            document['last'] = _profileresult.status()
+        return jsonresponse( start_response, "200 OK", document )
+    elif (path == "/debug/profile/stop") and (method == "POST"):
+        profiler = _profiler
+        if (profiler == None):
+            return jsonresponse( start_response, "409 Conflict", { 'error': "No profile in progress" } )
+        profiler.stop()
+        return jsonresponse( start_response, "200 OK", profiler.status() )
+    elif (path == "/debug/profile/result") and (method == "GET"):
+        profiler = _profileresult
+        if (profiler == None):
+            return jsonresponse( start_response, "404 Not Found", { 'error': "No profile finished" } )
+        result = profiler.result( query.get('format', [ _profileformats[profiler.mode][0] ])[0] )
+        if (result == None):
+            return jsonresponse( start_response, "400 Bad Request", { 'error': "Nothing to download in the format, shall be one of " + ", ".join(_profileformats[profiler.mode]) } )
+        return httpresponse( start_response, "200 OK", result[2], result[0], [ ( "Content-Disposition", 'attachment; filename="' + result[1] + '"' ) ] )
+    return jsonresponse( start_response, "404 Not Found", { 'error': "Not found" } )
+
+
+
+
+# ------------------------------------------------------------------
+# Check scan event
+# ------------------------------------------------------------------
+# event:    scan event, as received
+#           { "target": "name",                 (multiple targets only)
+#             "scanId": 1001,
+#             "stage": 4 or "Scanning",
+#             "engineId": 2,                    (optional)
+#             "time": "2020-02-11T10:38:33.553" (optional, SAST date format, now if missing)
+#             "loc": 120000,                    (optional, as in the scans queue)
+#             "project": { "id": 5, "name": "" }, (optional, as in the scans queue)
+#             "teamId": "1" }                   (optional, as in the scans queue)
+# returns   the event normalized, None if invalid
+# ------------------------------------------------------------------
+def checkevent( event ):
+    if (type(event) != dict):
+        return None
+    checked = dict()
+    if (_labeltarget):
+        checked["target"] = str( event.get("target", "") )
+    else:
+        checked["target"] = ""
+    try:
+        checked["scanId"] = int( event["scanId"] )
+        stage = event["stage"]
+        if (type(stage) == str):
+            checked["stage"] = _stageids[stage]
+        else:
+            checked["stage"] = int(stage)
+        checked["engineId"] = int( event.get("engineId") or 0 )
+    except (KeyError, ValueError, TypeError):
+        return None
+    stagenames = [ name for name, stageid in _stageids.items() if (stageid == checked["stage"]) ]
+    if (checked["scanId"] <= 0) or (stagenames == []):
+        return None
+    checked["stagename"] = stagenames[0]
+    if ("time" in event):
+        try:
+            datetime.datetime.strptime( str(event["time"]), "%Y-%m-%dT%H:%M:%S.%f" )
+        except ValueError:
+            return None
+        checked["time"] = str(event["time"])
+    # Optional details, of the types found in the scans queue
+    if ("loc" in event):
+        if (type(event["loc"]) != int) or (event["loc"] < 0):
+            return None
+        checked["loc"] = event["loc"]
+    if ("project" in event):
+        project = event["project"]
+        if (type(project) != dict) or (type(project.get("id", 0)) != int) or (type(project.get("name", "")) != str):
+            return None
+        checked["project"] = project
+    if ("teamId" in event):
+        if (type(event["teamId"]) not in [ int, str ]):
+            return None
+        checked["teamId"] = event["teamId"]
+    return checked
+
+
+
+
+# ------------------------------------------------------------------
+# Scan events endpoint
+# ------------------------------------------------------------------
+# Only answers when events are enabled (events), and with the bearer
+# token configured (eventstoken), mandatory with events
+# POST /events      one scan event or a list of them (see checkevent)
+# collector: the aggregator (see CxAggregator.ingest)
+# returns   the wsgi application
+# ------------------------------------------------------------------
+def eventsapp( collector ):
+    def application( environ, start_response ):
+        if (not _events):
+            return httpresponse( start_response, "404 Not Found" )
+        if (not httpauthorized( environ, _eventstoken )):
+            return jsonresponse( start_response, "401 Unauthorized", { 'error': "Missing or invalid token" } )
+        if (environ.get('REQUEST_METHOD', 'GET') != "POST"):
+            return jsonresponse( start_response, "405 Method Not Allowed", { 'error': "Events shall be posted" } )
+        try:
+            size = int( environ.get('CONTENT_LENGTH') or 0 )
+        except ValueError:
+            size = 0
+        if (size <= 0):
+            return jsonresponse( start_response, "400 Bad Request", { 'error': "Missing events" } )
+        if (size > _eventsmaxsize):
+            return jsonresponse( start_response, "413 Payload Too Large", { 'error': "Events request shall have up to " + str(_eventsmaxsize) + " bytes" } )
+        try:
+            events = json.loads( environ['wsgi.input'].read(size).decode('utf-8') )
+        except ValueError:
+            return jsonresponse( start_response, "400 Bad Request", { 'error': "Invalid json" } )
+        if (type(events) != list):
+            events = [ events ]
+        if (len(events) > _eventsmax):
+            return jsonresponse( start_response, "413 Payload Too Large", { 'error': "Events request shall have up to " + str(_eventsmax) + " events" } )
+        checked = [ event for event in map( checkevent, events ) if (event != None) ]
+        applied = collector.ingest( checked )
+        return jsonresponse( start_response, "202 Accepted", { 'received': len(events), 'invalid': len(events) - len(checked), 'applied': applied } )
+    return application
+
+
+
+
+# ------------------------------------------------------------------
+# Query api endpoint
+# ------------------------------------------------------------------
+# Only answers when the api is enabled (api), and with the bearer
+# token configured (apitoken), if any. Answers from the snapshots
+# served last, never calling SAST (see CxQueryIndex)
+# GET /api/engines                      engines, with slots and health
+# GET /api/engines/{id}                 an engine, with its scans
+# GET /api/scans?engine=&stage=&olderThan=&limit=&offset=
+#                                       scans, by engine, by stage
+#                                       (pulling, queued, scanning) or
+#                                       in it for more than N minutes,
+#                                       limit scans from offset
+# GET /api/scans/{id}                   a scan
+# All of them accept target=, with multiple targets
+# collector: the aggregator (see CxAggregator.queryindex)
+# returns   the wsgi application
+# ------------------------------------------------------------------
+def apiapp( collector ):
+    def application( environ, start_response ):
+        if (not _api):
+            return httpresponse( start_response, "404 Not Found" )
+        if (not httpauthorized( environ, _apitoken )):
+            return jsonresponse( start_response, "401 Unauthorized", { 'error': "Missing or invalid token" } )
+        if (environ.get('REQUEST_METHOD', 'GET') != "GET"):
+            return jsonresponse( start_response, "405 Method Not Allowed", { 'error': "The api is read only" } )
+        path    = environ.get('PATH_INFO', '/').rstrip("/").split("/")[2:]
+        query   = urllib.parse.parse_qs( environ.get('QUERY_STRING', '') )
+        target  = query.get('target', [ None ])[0]
+        try:
+            olderthan = query.get('olderThan', [ None ])[0]
+            if (olderthan != None):
+                olderthan = float(olderthan)
+            limit = int( query.get('limit', [ _apilimit ])[0] )
+            offset = int( query.get('offset', [ 0 ])[0] )
+        except ValueError:
+            return jsonresponse( start_response, "400 Bad Request", { 'error': "Invalid olderThan, limit or offset, shall be numbers" } )
+        stage = query.get('stage', [ None ])[0]
+        if (stage != None) and (stage not in _apistages.values()):
+            return jsonresponse( start_response, "400 Bad Request", { 'error': "Invalid stage, shall be one of " + ", ".join(_apistages.values()) } )
+        if (path == []) or (path[0] not in [ "engines", "scans" ]) or (len(path) > 2):
+            return jsonresponse( start_response, "404 Not Found", { 'error': "Not found" } )
+        index = collector.queryindex()
+        if (index == None):
+            return jsonresponse( start_response, "503 Service Unavailable", { 'error': "Nothing collected yet" } )
+        document = { 'snapshotTime': index.timestamp, 'snapshotAge': time.time() - index.timestamp }
+        if (path == [ "engines" ]):
+            document['engines'] = index.enginerecords( None, target )
+        elif (path[0] == "engines"):
+            document['engines'] = index.enginerecords( path[1], target )
+            if (document['engines'] == []):
+                return jsonresponse( start_response, "404 Not Found", { 'error': "Engine not found" } )
+            document['scans'], document['count'] = index.scanrecords( path[1], None, None, target, limit, offset )
+        elif (path == [ "scans" ]):
+            document['scans'], document['count'] = index.scanrecords( query.get('engine', [ None ])[0], stage, olderthan, target, limit, offset )
+        else:
+            document['scans'] = index.scanrecord( path[1], target )
+            if (document['scans'] == []):
+                return jsonresponse( start_response, "404 Not Found", { 'error': "Scan not found" } )
+        return jsonresponse( start_response, "200 OK", document )
+    return application
+
+
+
+
+# ------------------------------------------------------------------
+# Write text file
+# ------------------------------------------------------------------
+# Replaces a file at once, readers never seeing it partially written
+# The temporary file is in the same folder, not ending in .prom, so
+# that the node_exporter textfile collector ignores it
+# filename: the file to write
+# content:  the file content, bytes
+# ------------------------------------------------------------------
+def writetextfile( filename, content ):
+    folder = os.path.dirname( os.path.abspath(filename) )
+    fd, tempname = tempfile.mkstemp( dir = folder, prefix = "." + os.path.basename(filename), suffix = ".tmp" )
+    try:
+        fp = os.fdopen( fd, 'wb' )
+        try:
+            fp.write( content )
+            fp.flush()
+            os.fsync( fp.fileno() )
+        finally:
+            fp.close()
+        os.chmod( tempname, 0o644 )
+        os.replace( tempname, filename )
+    except OSError:
+        if (os.path.exists(tempname)):
+            os.remove( tempname )
+        raise
+
+
+
+
+# ------------------------------------------------------------------
+# One shot run
+# ------------------------------------------------------------------
+# usage:    cxprometheus.py --once [filename], for cron driven runs:
+#           collects once, writes the exposition (the configured
+#           textfile by default) and exits. The warm state, token
+#           and counters, carries on between runs (see stateinterval)
+# returns:  the exit code
+# ------------------------------------------------------------------
+def runonce( filename = "" ):
+    if (loadconfigurations( True ) == False):
+        return 70
+    logger = logging.getLogger('cxprometheus')
+    if (filename == ""):
+        filename = _textfile
+    collector = None
+    try:
+        reg = CollectorRegistry()
+        collector = CxAggregator()
+        if (_stateinterval > 0):
+            loadstate( collector )
+        reg.register(collector)
+        collector.startup = time.time() - _starttime
+        content = generate_latest( reg )
+        writetextfile( filename, content )
+        if (_stateinterval > 0):
+            savestate( collector )
+        summary = "Wrote %s, %d bytes, startup %.3f seconds, collection %.3f seconds" % ( filename, len(content), collector.startup, collector.collecttime )
+        logger.info( summary )
+        print( summary )
+        return 0
+    except OSError as err:
+        logger.critical( "Unable to write %s: %s", filename, err )
+        print( "Unable to write " + filename + ": " + str(err) )
+        return 73
+    finally:
+        if (collector != None):
+            collector.stop()
+        cleanup()
+
+
 
 
 if __name__ == '__main__':
 
+    # One shot run, for the node_exporter textfile collector
+    if ('--once' in sys.argv):
+        idx = sys.argv.index('--once')
+        sys.exit( runonce( sys.argv[idx + 1] if (len(sys.argv) > idx + 1) else "" ) )
+
     # Load and check configurations
     if (loadconfigurations() == False):
         sys.exit(70)
 
+    collector = None
+
     try:
 
-        # Use a new registry
+        # Use a new registry, warm started from the last state snapshot
         reg = CollectorRegistry()
-        reg.register(CxCollector())
-        start_http_server(_promport, registry=reg)
+        collector = CxAggregator()
+        if (_stateinterval > 0):
+            loadstate( collector )
+        reg.register(collector)
+        startserver( _promport, reg, { "/debug/profile": profileapp, "/events": eventsapp( collector ), "/api": apiapp( collector ) } )
+        if (collector.polling):
+            collector.startpolling()
+        if (collector.writer != None):
+            collector.writer.start()
+
+        # Exit cleanly on SIGTERM, saving state
+        signal.signal(signal.SIGTERM, requeststop)
+
+        # Reload configurations on SIGHUP (where available) or when the file changes
+        if hasattr(signal, 'SIGHUP'):
+            signal.signal(signal.SIGHUP, requestreload)
 
         # Run
-        while True: 
+        statetime = time.time()
+        while True:
             time.sleep(1)
+            if (_reloadevent.is_set()) or (configurationschanged()):
+                _reloadevent.clear()
+                reloadconfigurations( collector )
+            if (_stateinterval > 0) and (time.time() - statetime >= _stateinterval):
+                statetime = time.time()
+                savestate( collector )
 
     finally:
+        # Save state for the next start
+        if (collector != None):
+            if (_stateinterval > 0):
+                savestate( collector )
+            collector.stop()
         # Log finish
         cleanup()
-
@@ -19,6 +19,10 @@ try:
     import datetime
     import collections
     import logging
+    import math
+    import random
+    import heapq
+    import concurrent.futures
 except ImportError:
     print("Could not load needed modules, exiting...")
     sys.exit(65)
@@ -51,10 +55,23 @@ _configfile = "configs.json"        # File name holding configurations
 _logfile    = "cxpromstress.log"    # File name holding log entries (path is ./logs)
 
 
-_concurrentscans    = 0
-_scansrunning       = 0
-_scansqueue         = 0
-_stepmode           = 0 
+_scenariofile   = "scenarios.json"      # File name holding load scenarios
+_scenarioname   = "default"             # Scenario to run, when not given in the command line
+_reportfolder   = "reports"             # Folder where the run reports are written
+_tickinterval   = 60                    # Default seconds between load adjustments
+_phasekinds     = [ "ramp", "step", "spike", "soak" ]
+_percentiles    = [ 50, 90, 95, 99 ]
+
+_simulationfile = "simulations.json"    # File name holding capacity simulations
+_simulationname = "default"             # Simulation to run, when not given in the command line
+_simsampling    = 300                   # Simulated seconds between utilization samples
+_distributions  = [ "constant", "uniform", "exponential", "lognormal" ]
+
+_stressworkers  = 4                     # Concurrent workers submitting scans, when the scenario does not give them (workers)
+_tokenmargin    = 300                   # Seconds before expiry a token is refreshed
+_logonbackoff   = 30                    # Seconds before a user whose logon failed is tried again, doubling on each failure
+_logonbackoffmax = 900                  # Seconds before a user whose logon failed is tried again, at most
+
 _lastproject        = -1
 
 # ------------------------------------------------------------------
@@ -70,6 +87,18 @@ _lastproject        = -1
 #           on error an empty string
 # ------------------------------------------------------------------
 def cxlogon( hostname = "", username = "", password = "" ):
+    return cxlogonexpiry( hostname, username, password )[0]
+
+
+
+# ------------------------------------------------------------------
+# SAST Logon, with token expiry
+# ------------------------------------------------------------------
+# usage:    as cxlogon
+# returns   ( token, seconds until it expires ), the token being an
+#           empty string on error
+# ------------------------------------------------------------------
+def cxlogonexpiry( hostname = "", username = "", password = "" ):
     logger = logging.getLogger('cxprometheus')    
     stoken  = ""
     sapipath = hostname.lower()
@@ -92,7 +121,7 @@ def cxlogon( hostname = "", username = "", password = "" ):
         sresponse = requests.post( sapipath, data = sbody, headers = shead, verify = False )
         if (sresponse.status_code not in [200, 201, 202]):
             logger.error( "Logon response: " + str(sresponse.status_code) + ", " + sresponse.text )
-            return ""
+            return "", 0
     except Exception as err:       
         # This is a critical failure as it is unable to talk to SAST
         serr = str(err)
@@ -107,7 +136,7 @@ def cxlogon( hostname = "", username = "", password = "" ):
     if (skeyval != "") :
         stoken = skeykind + ' ' + skeyval
     logger.debug( "Logon: " + skeykind + " token was retreieved successfully" )        
-    return stoken 
+    return stoken, sjson.get("expires_in", 3600)
 
 
 
@@ -376,7 +405,7 @@ def cxgetenginecaps( hostname = "", apitoken = "" ):
 #           see const_configs for default
 # returns   success true or false
 # ------------------------------------------------------------------
-def loadconfigurations():
+def loadconfigurations( checksast = True ):
     global _promport
     global _hostname
     global _username
@@ -435,12 +464,12 @@ def loadconfigurations():
     logger.addHandler(handler)
 
     _errors = list()
-    # Check configurations
-    if (_hostname == ""):
+    # Check configurations, SAST is only needed if it is to be used
+    if (checksast) and (_hostname == ""):
         _errors.append( "Missing SAST host name in configuration (hostname)" )
-    if (_username == ""):
+    if (checksast) and (_username == ""):
         _errors.append( "Missing SAST user name in configuration (username)" )
-    if (_password == ""):
+    if (checksast) and (_password == ""):
         _errors.append( "Missing SAST user credentials in configuration (password)" )
     if (_promport <= 0):
         _errors.append( "Missing prometheus exporter port in configuration (promport)" )
@@ -468,97 +497,885 @@ def cleanup():
 
 
 
+
+
 # ------------------------------------------------------------------
-# Compute cargo
+# Parse a SAST date
+# ------------------------------------------------------------------
+# usage:    converts a SAST date string (with or without fractional
+#           seconds) to an epoch timestamp
+# returns:  the timestamp, or 0.0 when the date is missing or invalid
+# ------------------------------------------------------------------
+def cxparsedate( thedate ):
+    if (type(thedate) != str) or (thedate == ""):
+        return 0.0
+    if ( "." not in thedate ):
+        thedate = thedate + ".0"
+    try:
+        return datetime.datetime.strptime( thedate, "%Y-%m-%dT%H:%M:%S.%f" ).timestamp()
+    except:
+        return 0.0
+
+
+
+# ------------------------------------------------------------------
+# Percentile
+# ------------------------------------------------------------------
+# usage:    nearest-rank percentile over a list of values
+# values:   the values, not required to be sorted
+# pct:      the percentile, 0 to 100
+# returns:  the percentile value, or None for an empty list
+# ------------------------------------------------------------------
+def percentile( values, pct ):
+    if (values == []):
+        return None
+    svalues = sorted(values)
+    idx = int( math.ceil( (pct / 100.0) * len(svalues) ) ) - 1
+    if (idx < 0):
+        idx = 0
+    return round( svalues[idx], 3 )
+
+
+
 # ------------------------------------------------------------------
-# 
-# ------------------------------------------------------------------
-def computecargo( hostname = "", apitoken = "" ):
-    global _concurrentscans
-    global _scansrunning
-    global _scansqueue
-    global _stepmode
-
-    # Evaluate number of concurrent scans capability
-    _concurrentscans    = cxgetenginecaps( hostname, apitoken )
-    # Determine the number of scans running
-    _scansrunning       = cxgetscansrunningcount( hostname, apitoken )
-    # Determine the number of scans in queue, running or not
-    _scansqueue         = cxgetscansqueuecount( hostname, apitoken )
-    
-    
-    scanstostart = 0
-    if (_stepmode == 0):
-        # Put 3 times the capacity in the queue
-        scanstostart = (_concurrentscans * 3) - (_scansqueue)
+# Load scenario
+# ------------------------------------------------------------------
+# usage:    loads a load scenario from the scenarios file
+#           a scenario is an ordered list of phases, each phase having
+#           a kind (ramp, step, spike, soak), a duration in seconds and
+#           a target, expressed as a multiple of the engines concurrent
+#           scan capacity that shall be kept in the queue
+#           scans are submitted by the virtual users of the scenario
+#           (users, [ { username, password } ], default the configured
+#           user), by its concurrent workers (workers)
+#           see scenarios.json for an example
+# name:     the scenario name
+# returns:  the scenario dictionary, or None if not found or invalid
+# ------------------------------------------------------------------
+def loadscenario( name = "default" ):
+    logger = logging.getLogger('cxprometheus')
+    if (not os.path.exists(_scenariofile)):
+        logger.critical( "Scenarios file not found (" + _scenariofile + ")" )
+        return None
+    fp = open(_scenariofile, 'r')
+    try:
+        sdict = json.load(fp)
+    finally:
+        fp.close()
+    scenario = sdict.get(name)
+    if (scenario == None):
+        logger.critical( "Scenario not found in " + _scenariofile + " (" + name + ")" )
+        return None
+    _errors = list()
+    if (scenario.get('interval', _tickinterval) <= 0):
+        _errors.append( "Invalid scenario interval (interval)" )
+    phases = scenario.get('phases', [])
+    if (phases == []):
+        _errors.append( "Scenario has no phases (phases)" )
+    for phase in phases:
+        if (phase.get('kind') not in _phasekinds):
+            _errors.append( "Invalid phase kind (" + str(phase.get('kind')) + ")" )
+        if (phase.get('duration', 0) <= 0):
+            _errors.append( "Invalid phase duration (" + str(phase.get('duration')) + ")" )
+        if (phase.get('target', -1) < 0):
+            _errors.append( "Invalid phase target (" + str(phase.get('target')) + ")" )
+    for user in scenario.get('users', []):
+        if (type(user) != dict) or (user.get('username', '') == "") or (user.get('password', '') == ""):
+            _errors.append( "Missing user name or credentials in scenario (users)" )
+    if (type(scenario.get('workers', _stressworkers)) != int) or (scenario.get('workers', _stressworkers) <= 0):
+        _errors.append( "Invalid number of concurrent workers in scenario (workers)" )
+    if (_errors != []):
+        for _error in _errors:
+            logger.critical( _error )
+        return None
+    return scenario
+
+
+
+# ------------------------------------------------------------------
+# Phase level
+# ------------------------------------------------------------------
+# usage:    resolves the load level a phase asks for at a given moment
+#           ramp:  linear from the starting level up/down to target
+#           step:  the same, in discrete steps (default 4)
+#           spike: target at once, the queue is then left to drain
+#           soak:  target held for the whole duration
+# phase:    the phase dictionary
+# start:    the level in place when the phase started
+# elapsed:  seconds elapsed since the phase started
+# returns:  the level, as a multiple of the engines capacity
+# ------------------------------------------------------------------
+def phaselevel( phase, start, elapsed ):
+    kind     = phase["kind"]
+    target   = float(phase["target"])
+    duration = float(phase["duration"])
+    progress = min( elapsed / duration, 1.0 )
+    if (kind == "ramp"):
+        return start + (target - start) * progress
+    elif (kind == "step"):
+        steps = max( int(phase.get('steps', 4)), 1 )
+        stepn = min( int(progress * steps) + 1, steps )
+        return start + (target - start) * stepn / steps
     else:
-        scanstostart = (_concurrentscans) - (_scansqueue)
+        return target
+
+
 
+# ------------------------------------------------------------------
+# Compute cargo
+# ------------------------------------------------------------------
+# usage:    the number of scans to start in order to bring the queue
+#           up to the requested level
+# capacity: the engines concurrent scan capacity
+# inqueue:  the number of scans in queue, running or not
+# level:    the requested level, as a multiple of the capacity
+# returns:  the number of scans to start
+# ------------------------------------------------------------------
+def computecargo( capacity = 0, inqueue = 0, level = 0.0 ):
+    scanstostart = int( round(capacity * level) ) - inqueue
     if (scanstostart < 0):
         scanstostart = 0
+    return scanstostart
 
-    _stepmode = _stepmode + 1
-    if (_stepmode > 10):
-        _stepmode = 0
 
-    return scanstostart
 
+# ------------------------------------------------------------------
+# The token pool
+# ------------------------------------------------------------------
+# Tokens of the virtual users submitting scans, obtained on first use
+# and refreshed _tokenmargin seconds before they expire. The first
+# user also monitors the queue
+# ------------------------------------------------------------------
+class CxTokenPool(object):
+
+    def __init__(self, hostname, users):
+        self.hostname   = hostname
+        self.users      = users
+        self.tokens     = [ [ "", 0.0 ] for user in users ]     # [ token, expires at ]
+        self.locks      = [ threading.Lock() for user in users ]
+        self.logons     = [ 0 ] * len(users)
+        self.failures   = [ 0 ] * len(users)
+        self.submitted  = [ 0 ] * len(users)
+        self.failing    = [ 0 ] * len(users)            # consecutive logon failures
+        self.retryat    = [ 0.0 ] * len(users)          # no logon before, after a failure
+        self.nextuser   = 0
+
+    def token(self, idx = 0):
+        # Users whose logon failed are only tried again after a backoff, so that
+        # a bad credential does not trigger a logon on every submission
+        self.locks[idx].acquire()
+        try:
+            token = self.tokens[idx]
+            if ((token[0] == "") or (time.time() >= token[1] - _tokenmargin)) and (time.time() >= self.retryat[idx]):
+                user = self.users[idx]
+                stoken, expiresin = cxlogonexpiry( self.hostname, user['username'], user['password'] )
+                self.logons[idx] += 1
+                if (stoken == ""):
+                    self.failures[idx] += 1
+                    self.failing[idx] += 1
+                    backoff = min( _logonbackoff * 2 ** (self.failing[idx] - 1), _logonbackoffmax )
+                    self.retryat[idx] = time.time() + backoff
+                    logger = logging.getLogger('cxprometheus')
+                    logger.warning( "Logon failed for " + user['username'] + ", next try in " + str(backoff) + "s" )
+                else:
+                    self.failing[idx] = 0
+                token[0] = stoken
+                token[1] = time.time() + expiresin
+            return token[0]
+        finally:
+            self.locks[idx].release()
 
-def startscans(hostname = "", apitoken = "", scanstostart = 0 ):
+    def succeeded(self, idx):
+        self.locks[idx].acquire()
+        try:
+            self.submitted[idx] += 1
+        finally:
+            self.locks[idx].release()
+
+    def invalidate(self, idx):
+        self.locks[idx].acquire()
+        try:
+            self.tokens[idx][0] = ""
+        finally:
+            self.locks[idx].release()
+
+    def next(self):
+        # Virtual users submit in turns, the ones backing off after a failed logon
+        # being skipped while others are available
+        now = time.time()
+        for counter in range(len(self.users)):
+            idx = self.nextuser
+            self.nextuser = (self.nextuser + 1) % len(self.users)
+            if (self.retryat[idx] <= now):
+                return idx
+        return idx
+
+    def summary(self):
+        return [ { 'username': user['username'], 'logons': self.logons[idx], 'logonFailures': self.failures[idx],
+                   'submitted': self.submitted[idx] } for idx, user in enumerate(self.users) ]
+
+
+
+# ------------------------------------------------------------------
+# Start scans
+# ------------------------------------------------------------------
+# usage:    starts scans rotating over the git projects available,
+#           spread over the virtual users of the token pool, by
+#           concurrent workers
+# returns:  the list of started scan ids
+# ------------------------------------------------------------------
+def startscans( hostname = "", pool = None, scanstostart = 0, workers = _stressworkers ):
     global _lastproject
 
     logger = logging.getLogger('cxprometheus')
 
     if (scanstostart <= 0):
-        return
+        return []
 
-    sprojects = cxgetprojects( hostname, apitoken )
+    sprojects = cxgetprojects( hostname, pool.token() )
 
     prjcount = len(sprojects)
+    if (prjcount == 0):
+        logger.error( "No git projects available to scan" )
+        return []
 
-    counter = scanstostart
-
-    logger.info( "Starting " + str(scanstostart) + " new scans" )
-    
-    while( counter > 0):
+    # Projects and users are assigned up front, in turns
+    submissions = []
+    for counter in range(scanstostart):
         _lastproject = _lastproject + 1
         if (_lastproject >= prjcount):
             _lastproject = 0
-        projectid = sprojects[_lastproject]
+        submissions.append( ( pool.next(), sprojects[_lastproject] ) )
 
-        cxstartscan( _hostname, stoken, projectid )
+    logger.info( "Starting " + str(scanstostart) + " new scans" )
 
-        counter = counter - 1
+    def submit( submission ):
+        idx, projectid = submission
+        try:
+            scan = cxstartscan( hostname, pool.token(idx), projectid )
+        except Exception:
+            scan = None
+        if (type(scan) == dict) and (scan.get('id') != None):
+            pool.succeeded( idx )
+            return scan["id"]
+        # The token may no longer be valid, get a new one next time
+        pool.invalidate( idx )
+        return None
+
+    executor = concurrent.futures.ThreadPoolExecutor( max_workers = workers )
+    try:
+        started = [ scanid for scanid in executor.map( submit, submissions ) if (scanid != None) ]
+    finally:
+        executor.shutdown()
 
+    return started
 
 
 
-if __name__ == '__main__':
+# ------------------------------------------------------------------
+# The run tracker
+# ------------------------------------------------------------------
+# Follows every scan seen in the queue between ticks, to account
+# starts, completions, queue waits and scan durations, and keeps
+# the engines utilization time series for the run report
+# ------------------------------------------------------------------
+class CxRunTracker(object):
+
+    def __init__(self, scenarioname, scenario):
+        self.scenarioname   = scenarioname
+        self.scenario       = scenario
+        self.started        = time.time()
+        self.scans          = dict()    # scan id -> [ queuedon, enginestartedon, completedon, stage, finished ]
+        self.submitted      = dict()    # phase -> count of scans submitted
+        self.engined        = dict()    # phase -> count of scans started on an engine
+        self.finished       = dict()    # phase -> count of scans finished (any of finished, canceled, failed)
+        self.failed         = dict()    # phase -> count of scans failed or canceled
+        self.queuewaits     = dict()    # phase -> list of queue waits, in seconds
+        self.durations      = dict()    # phase -> list of scan durations, in seconds
+        self.phasetimes     = dict()    # phase -> [ start, end ]
+        self.timeseries     = list()
+
+    def addcount(self, counts, phase, value = 1):
+        counts[phase] = counts.get(phase, 0) + value
+
+    def submit(self, phase, scanids):
+        self.addcount( self.submitted, phase, len(scanids) )
+
+    def complete(self, phase, record, tickat):
+        record[4] = True
+        self.addcount( self.finished, phase )
+        if (record[3] in [8, 9]):
+            self.addcount( self.failed, phase )
+        if (record[1] > 0.0):
+            scanend = record[2]
+            if (scanend <= 0.0):
+                scanend = tickat
+            self.durations.setdefault( phase, [] ).append( scanend - record[1] )
+
+    def tick(self, phase, level, capacity, scans):
+        tickat = time.time()
+        times = self.phasetimes.setdefault( phase, [tickat, tickat] )
+        times[1] = tickat
+        running = 0
+        queued  = 0
+        seen    = set()
+        for scan in scans:
+            scanid = scan["id"]
+            stage  = scan["stage"]["id"]
+            seen.add(scanid)
+            # 1=New, 2=PreScan, 3=Queued, 4=Scanning, 6=PostScan, 7=Finished, 8=Canceled, 9=Failed, 10=SourcePullingAndDeployment or 1001=None.
+            if (stage == 3):
+                queued = queued + 1
+            elif (stage >= 4) and (stage <= 6):
+                running = running + 1
+            record = self.scans.get(scanid)
+            if (record == None):
+                record = [ 0.0, 0.0, 0.0, stage, False ]
+                self.scans[scanid] = record
+            record[3] = stage
+            if (record[0] <= 0.0):
+                record[0] = cxparsedate( scan.get('queuedOn') )
+            if (record[1] <= 0.0):
+                record[1] = cxparsedate( scan.get('engineStartedOn') )
+                # Scans started before the run are followed, not accounted
+                if (record[1] > 0.0) and (record[1] >= self.started):
+                    self.addcount( self.engined, phase )
+                    if (record[0] > 0.0):
+                        self.queuewaits.setdefault( phase, [] ).append( record[1] - record[0] )
+            if (record[2] <= 0.0):
+                record[2] = cxparsedate( scan.get('completedOn') )
+            if (stage in [7, 8, 9]) and (not record[4]):
+                self.complete( phase, record, tickat )
+        # Scans no longer in queue after being started are accounted as finished
+        for scanid in list(self.scans.keys()):
+            if (scanid not in seen):
+                record = self.scans.pop(scanid)
+                if (record[1] > 0.0) and (not record[4]):
+                    self.complete( phase, record, tickat )
+        if (capacity > 0):
+            utilization = running / capacity
+        else:
+            utilization = 0.0
+        self.timeseries.append( { 'elapsed': round(tickat - self.started, 1), 'phase': phase, 'level': round(level, 3),
+                                  'capacity': capacity, 'running': running, 'queued': queued, 'inqueue': len(scans),
+                                  'utilization': round(utilization, 4) } )
+        return running, queued
+
+    def summarize(self, phases = None):
+        if (phases == None):
+            phases = list(self.phasetimes.keys())
+        first = min( [ self.phasetimes[p][0] for p in phases if p in self.phasetimes ] + [ self.started ] )
+        last  = max( [ self.phasetimes[p][1] for p in phases if p in self.phasetimes ] + [ first ] )
+        minutes = max( (last - first) / 60.0, 1.0 / 60.0 )
+        submitted = sum( [ self.submitted.get(p, 0) for p in phases ] )
+        engined   = sum( [ self.engined.get(p, 0) for p in phases ] )
+        finished  = sum( [ self.finished.get(p, 0) for p in phases ] )
+        failed    = sum( [ self.failed.get(p, 0) for p in phases ] )
+        waits     = [ w / 60.0 for p in phases for w in self.queuewaits.get(p, []) ]
+        durations = [ d / 60.0 for p in phases for d in self.durations.get(p, []) ]
+        utils     = [ t['utilization'] for t in self.timeseries if t['phase'] in phases ]
+        res = dict()
+        res['minutes']      = round(minutes, 2)
+        res['submitted']    = submitted
+        res['started']      = engined
+        res['finished']     = finished
+        res['failed']       = failed
+        res['throughput']   = { 'submittedPerMinute': round(submitted / minutes, 3),
+                                'startedPerMinute':   round(engined / minutes, 3),
+                                'finishedPerMinute':  round(finished / minutes, 3) }
+        res['queueWaitMinutes']    = dict( [ ('p' + str(p), percentile(waits, p)) for p in _percentiles ] )
+        res['scanDurationMinutes'] = dict( [ ('p' + str(p), percentile(durations, p)) for p in _percentiles ] )
+        res['utilization']         = dict( [ ('p' + str(p), percentile(utils, p)) for p in _percentiles ] )
+        return res
+
+    def report(self, hostname, users = None):
+        logger = logging.getLogger('cxprometheus')
+        phasenames = [ phase['name'] for phase in self.scenario['phases'] ]
+        sreport = dict()
+        sreport['scenario']     = self.scenarioname
+        sreport['definition']   = self.scenario
+        sreport['hostname']     = hostname
+        sreport['started']      = datetime.datetime.fromtimestamp(self.started).isoformat()
+        sreport['ended']        = datetime.datetime.now().isoformat()
+        sreport['overall']      = self.summarize( phasenames )
+        sreport['phases']       = dict( [ (p, self.summarize([p])) for p in phasenames if p in self.phasetimes ] )
+        sreport['timeseries']   = self.timeseries
+        if (users != None):
+            sreport['users']    = users
+        # Write report
+        if (not os.path.isdir(_reportfolder)):
+            os.mkdir(_reportfolder)
+        reportname = _reportfolder + os.path.sep + "stress_" + self.scenarioname + "_" + \
+                     datetime.datetime.fromtimestamp(self.started).strftime("%Y%m%d_%H%M%S") + ".json"
+        fp = open(reportname, 'w')
+        try:
+            json.dump(sreport, fp, indent = 2)
+        finally:
+            fp.close()
+        overall = sreport['overall']
+        logger.info( "Run report written to " + reportname )
+        logger.info( "Throughput (per minute): submitted " + str(overall['throughput']['submittedPerMinute']) +
+                     ", started " + str(overall['throughput']['startedPerMinute']) +
+                     ", finished " + str(overall['throughput']['finishedPerMinute']) )
+        logger.info( "Queue wait minutes: " + str(overall['queueWaitMinutes']) )
+        logger.info( "Scan duration minutes: " + str(overall['scanDurationMinutes']) )
+        return reportname
 
-    # Load and check configurations
-    if (loadconfigurations() == False):
-        sys.exit(70)
 
- #   stoken = cxlogon( _hostname, "prometheus", "Cx123456!")
 
-#    cxstartscan( _hostname, stoken, 3 )
+# ------------------------------------------------------------------
+# Run scenario
+# ------------------------------------------------------------------
+# usage:    runs every phase of a scenario in order, ticking at the
+#           scenario interval, and writes the run report at the end
+# returns:  the report file name
+# ------------------------------------------------------------------
+def runscenario( hostname = "", scenarioname = "default", scenario = None ):
+    global _lastproject
+
+    logger = logging.getLogger('cxprometheus')
+
+    interval = scenario.get('interval', _tickinterval)
+    phases   = scenario['phases']
+    idx = 0
+    for phase in phases:
+        if (phase.get('name') == None):
+            phase['name'] = str(idx + 1) + "_" + phase['kind']
+        idx = idx + 1
+
+    # Always rotate projects from the start, for comparable runs
+    _lastproject = -1
+
+    # Virtual users, the configured user when none is given
+    users = scenario.get('users', [])
+    workers = scenario.get('workers', _stressworkers)
+    if (users == []):
+        users = [ { 'username': _username, 'password': _password } ]
+    pool = CxTokenPool( hostname, users )
+
+    tracker = CxRunTracker( scenarioname, scenario )
+    level = 0.0
+    try:
+        for phase in phases:
+            logger.info( "Phase " + phase['name'] + " started (" + phase['kind'] + ", " + str(phase['duration']) + "s, target " + str(phase['target']) + ")" )
+            start = level
+            phasestart = time.time()
+            tickn = 0
+            while (True):
+                elapsed = time.time() - phasestart
+                if (elapsed >= phase['duration']):
+                    break
+
+                stoken = pool.token()
+
+                capacity = cxgetenginecaps( hostname, stoken )
+                scans    = cxgetscansqueue( hostname, stoken )
+                current  = phaselevel( phase, start, elapsed )
+                tracker.tick( phase['name'], current, capacity, scans )
+
+                # A spike loads the queue once and then lets it drain
+                if (phase['kind'] != "spike") or (tickn == 0):
+                    scanstostart = computecargo( capacity, len(scans), current )
+                    if (scanstostart > 0):
+                        tracker.submit( phase['name'], startscans( hostname, pool, scanstostart, workers ) )
+
+                # Wait for the next tick, without drifting
+                tickn = tickn + 1
+                waittime = (phasestart + tickn * interval) - time.time()
+                if (waittime > 0):
+                    time.sleep( min( waittime, max( phase['duration'] - elapsed, 0 ) ) )
+
+            # Spikes are transient, next phase starts from the previous level
+            if (phase['kind'] != "spike"):
+                level = phaselevel( phase, start, phase['duration'] )
+    finally:
+        reportname = tracker.report( hostname, pool.summary() )
+
+    return reportname
+
+
+
+# ------------------------------------------------------------------
+# Load simulation
+# ------------------------------------------------------------------
+# usage:    loads a capacity simulation from the simulations file
+#           a simulation defines the engines farm (engines, a list or
+#           a file holding engineServers output, or read from SAST if
+#           missing), the scans arrivals, lines of code and durations
+#           distributions, optionally fitted from recorded scans queue
+#           data (fit), and the what-if scenarios to compare against
+#           the baseline. See simulations.json for an example
+# name:     the simulation name
+# returns:  the simulation dictionary, or None if not found or invalid
+# ------------------------------------------------------------------
+def loadsimulation( name = "default" ):
+    logger = logging.getLogger('cxprometheus')
+    if (not os.path.exists(_simulationfile)):
+        logger.critical( "Simulations file not found (" + _simulationfile + ")" )
+        return None
+    fp = open(_simulationfile, 'r')
+    try:
+        sdict = json.load(fp)
+    finally:
+        fp.close()
+    simulation = sdict.get(name)
+    if (simulation == None):
+        logger.critical( "Simulation not found in " + _simulationfile + " (" + name + ")" )
+        return None
+    _errors = list()
+    if (simulation.get('days', 7) <= 0):
+        _errors.append( "Invalid simulation days (days)" )
+    if (simulation.get('fit') != None) and (not os.path.exists(simulation['fit'])):
+        _errors.append( "Recorded scans queue file not found (fit, " + str(simulation['fit']) + ")" )
+    if (type(simulation.get('engines')) == str) and (not os.path.exists(simulation['engines'])):
+        _errors.append( "Engines file not found (engines, " + simulation['engines'] + ")" )
+    if (simulation.get('fit') == None) and (simulation.get('arrivals', {}).get('perHour', 0) <= 0):
+        _errors.append( "Invalid scans arrivals rate (arrivals, perHour)" )
+    for key in [ 'loc', 'durations' ]:
+        distribution = simulation.get(key)
+        if (distribution != None) and (distribution.get('distribution', 'lognormal') not in _distributions):
+            _errors.append( "Invalid distribution (" + key + ", " + str(distribution.get('distribution')) + ")" )
+    if (simulation.get('fit') == None) and (simulation.get('durations') == None):
+        _errors.append( "Missing scan durations distribution (durations)" )
+    for whatif in simulation.get('whatif', {}).values():
+        if (whatif.get('arrivalFactor', 1.0) <= 0) or (whatif.get('durationFactor', 1.0) <= 0):
+            _errors.append( "Invalid what-if factor (arrivalFactor, durationFactor)" )
+    if (_errors != []):
+        for _error in _errors:
+            logger.critical( _error )
+        return None
+    return simulation
+
+
+
+# ------------------------------------------------------------------
+# Simulation engines
+# ------------------------------------------------------------------
+# usage:    resolves the engines farm, one entry per engine, from a
+#           list, a file holding engineServers output or from SAST
+#           entries can have a count, to define identical engines
+# returns:  engines list, { name, maxScans, minLoc, maxLoc }
+# ------------------------------------------------------------------
+def simulationengines( engines = None, hostname = "" ):
+    if (type(engines) == str):
+        fp = open(engines, 'r')
+        try:
+            engines = json.load(fp)
+        finally:
+            fp.close()
+    elif (engines == None):
+        stoken  = cxlogon( hostname, _username, _password )
+        engines = cxgetengines( hostname, stoken )
+    res = []
+    for engine in engines:
+        for idx in range( int(engine.get('count', 1)) ):
+            res.append( { 'name':     str(engine.get('name', 'engine' + str(len(res) + 1))),
+                          'maxScans': int(engine['maxScans']),
+                          'minLoc':   int(engine.get('minLoc', 0)),
+                          'maxLoc':   int(engine.get('maxLoc', 999999999)) } )
+    return res
+
+
+
+# ------------------------------------------------------------------
+# Fit recorded
+# ------------------------------------------------------------------
+# usage:    fits the arrivals, lines of code and durations from
+#           recorded scansQueue output, a list of scans or a list of
+#           several such lists, as read over time
+#           arrivals: rate per hour, with an hour of the day profile
+#           when more than a day was recorded
+#           loc, durations (minutes): lognormal
+# returns:  dictionary with the fitted arrivals, loc and durations,
+#           None if the recorded scans could not be read
+# ------------------------------------------------------------------
+def fitrecorded( filename ):
+    logger = logging.getLogger('cxprometheus')
+    try:
+        fp = open(filename, 'r')
+        try:
+            recorded = json.load(fp)
+        finally:
+            fp.close()
+        # Last record of every scan
+        scans = dict()
+        for item in recorded:
+            for scan in (item if type(item) == list else [ item ]):
+                scans[scan["id"]] = scan
+    except (OSError, ValueError, KeyError, TypeError) as err:
+        logger.critical( "Unable to read recorded scans queue (" + filename + "): " + str(err) )
+        return None
+    created   = [ cxparsedate( scan.get('dateCreated') ) for scan in scans.values() ]
+    created   = sorted( [ t for t in created if t > 0.0 ] )
+    durations = []
+    for scan in scans.values():
+        if ((scan.get("stage") or {}).get("id") == 7):
+            scanini = cxparsedate( scan.get('engineStartedOn') )
+            scanend = cxparsedate( scan.get('completedOn') )
+            if (scanini > 0.0) and (scanend > scanini):
+                durations.append( (scanend - scanini) / 60.0 )
+    locs = [ scan['loc'] for scan in scans.values() if (type(scan.get('loc')) in [int, float]) and (scan['loc'] > 0) ]
+    fitted = dict()
+    if (len(created) > 1):
+        hours = max( (created[-1] - created[0]) / 3600.0, 1.0 )
+        fitted['arrivals'] = { 'perHour': len(created) / hours }
+        if (hours >= 24):
+            counts = [ 0 ] * 24
+            for t in created:
+                counts[ datetime.datetime.fromtimestamp(t).hour ] += 1
+            fitted['arrivals']['profile'] = [ round( 24.0 * c / len(created), 3 ) for c in counts ]
+    for key, values in [ ( 'loc', locs ), ( 'durations', durations ) ]:
+        if (len(values) > 1):
+            logs  = [ math.log(v) for v in values ]
+            mean  = sum(logs) / len(logs)
+            sigma = math.sqrt( sum( [ (l - mean) ** 2 for l in logs ] ) / (len(logs) - 1) )
+            fitted[key] = { 'distribution': 'lognormal', 'median': math.exp(mean), 'sigma': sigma }
+    logger.info( "Fitted from " + str(len(scans)) + " recorded scans: " + json.dumps(fitted) )
+    return fitted
+
+
+
+# ------------------------------------------------------------------
+# Random value
+# ------------------------------------------------------------------
+# usage:    draws a value from a distribution definition
+#           constant (value), uniform (min, max), exponential (mean)
+#           or lognormal (median, sigma), the default
+# returns:  the value
+# ------------------------------------------------------------------
+def randomvalue( rng, distribution ):
+    kind = distribution.get('distribution', 'lognormal')
+    if (kind == "constant"):
+        return float(distribution['value'])
+    elif (kind == "uniform"):
+        return rng.uniform( distribution['min'], distribution['max'] )
+    elif (kind == "exponential"):
+        return rng.expovariate( 1.0 / distribution['mean'] )
+    else:
+        return rng.lognormvariate( math.log(distribution['median']), distribution.get('sigma', 0.0) )
+
+
+
+# ------------------------------------------------------------------
+# Generate scans
+# ------------------------------------------------------------------
+# usage:    scans arriving along the simulated days, starting on a
+#           monday at midnight, as a non homogeneous poisson process
+#           following the hour of the day profile (profile, 24 factors)
+#           and the weekend factor (weekend)
+# returns:  list of scans ( arrival, loc, duration ), in seconds
+# ------------------------------------------------------------------
+def generatescans( rng, days, arrivals, locs, durations, arrivalfactor = 1.0, durationfactor = 1.0 ):
+    profile = arrivals.get('profile', [ 1.0 ] * 24)
+    weekend = arrivals.get('weekend', 1.0)
+    perhour = arrivals['perHour'] * arrivalfactor
+    maxrate = perhour * max(profile) * max(weekend, 1.0) / 3600.0
+    horizon = days * 86400.0
+    scans = []
+    if (maxrate <= 0):
+        return scans
+    t = 0.0
+    while (True):
+        t = t + rng.expovariate( maxrate )
+        if (t >= horizon):
+            break
+        rate = perhour * profile[ int(t // 3600) % 24 ] / 3600.0
+        if (int(t // 86400) % 7 >= 5):
+            rate = rate * weekend
+        if (rng.random() * maxrate <= rate):
+            loc = int( randomvalue( rng, locs ) ) if (locs != None) else 0
+            scans.append( ( t, loc, randomvalue( rng, durations ) * 60.0 * durationfactor ) )
+    return scans
+
+
+
+# ------------------------------------------------------------------
+# Simulate
+# ------------------------------------------------------------------
+# usage:    discrete event simulation of the scans on the engines farm
+#           queued scans start, in arrival order, on the first engine
+#           serving their lines of code with a free slot; scans no
+#           engine can serve are accounted as unserved
+# returns:  dictionary with the predicted queue waits, utilization
+#           and queue length
+# ------------------------------------------------------------------
+def simulate( engines, scans, days ):
+    horizon  = days * 86400.0
+    capacity = sum( [ engine['maxScans'] for engine in engines ] )
+    busy     = [ 0 ] * len(engines)
+    busytime = [ 0.0 ] * len(engines)              # Busy slot seconds, up to the horizon
+    queue    = collections.deque()                 # ( arrival, loc, duration )
+    events   = []                                  # ( time, sequence, engine index ), completions
+    waits    = []
+    unserved = 0
+    maxqueue = 0
+    utils    = []
+    nextsample = 0.0
+    seq = 0
+
+    def eligible( idx, loc ):
+        return (engines[idx]['minLoc'] <= loc <= engines[idx]['maxLoc'])
+
+    def startscan( idx, now, scan ):
+        busy[idx] += 1
+        waits.append( now - scan[0] )
+        busytime[idx] += max( min( now + scan[2], horizon ) - min( now, horizon ), 0.0 )
+        heapq.heappush( events, ( now + scan[2], seq, idx ) )
+
+    iscan = 0
+    while (iscan < len(scans)) or (events != []):
+        # Next event, arrivals first on ties
+        if (iscan < len(scans)) and ((events == []) or (scans[iscan][0] <= events[0][0])):
+            now = scans[iscan][0]
+            kind = "arrival"
+        else:
+            now = events[0][0]
+            kind = "completion"
+        # Utilization samples, up to now
+        while (nextsample <= now) and (nextsample < horizon):
+            utils.append( sum(busy) / capacity if (capacity > 0) else 0.0 )
+            nextsample = nextsample + _simsampling
+        seq = seq + 1
+        if (kind == "arrival"):
+            scan = scans[iscan]
+            iscan = iscan + 1
+            candidates = [ idx for idx in range(len(engines)) if eligible( idx, scan[1] ) ]
+            if (candidates == []):
+                unserved = unserved + 1
+                continue
+            free = [ idx for idx in candidates if busy[idx] < engines[idx]['maxScans'] ]
+            if (free != []):
+                startscan( free[0], now, scan )
+            else:
+                queue.append( scan )
+                maxqueue = max( maxqueue, len(queue) )
+        else:
+            etime, eseq, idx = heapq.heappop( events )
+            busy[idx] -= 1
+            # The freed slot takes the oldest queued scan it can serve
+            for qidx in range(len(queue)):
+                if eligible( idx, queue[qidx][1] ):
+                    scan = queue[qidx]
+                    del queue[qidx]
+                    startscan( idx, now, scan )
+                    break
+    res = dict()
+    res['engines']      = len(engines)
+    res['capacity']     = capacity
+    res['scans']        = len(scans)
+    res['started']      = len(waits)
+    res['unserved']     = unserved
+    res['maxQueued']    = maxqueue
+    res['queueWaitMinutes'] = dict( [ ('p' + str(p), percentile( [ w / 60.0 for w in waits ], p )) for p in _percentiles ] )
+    res['utilization']      = dict( [ ('p' + str(p), percentile( utils, p )) for p in _percentiles ] )
+    res['utilizationMean']  = round( sum(busytime) / (capacity * horizon), 4 ) if (capacity > 0) else 0.0
+    res['engineUtilizationMean'] = [ { 'name': engine['name'], 'utilization': round( busytime[idx] / (engine['maxScans'] * horizon), 4 ) }
+                                     for idx, engine in enumerate(engines) ]
+    return res
 
 
+
+# ------------------------------------------------------------------
+# Run simulation
+# ------------------------------------------------------------------
+# usage:    simulates the baseline and every what-if scenario of a
+#           simulation, with the same random seed, and writes the
+#           simulation report
+#           what-if: engines (replacing the farm), addEngines,
+#           arrivalFactor and durationFactor
+# returns:  the report file name
+# ------------------------------------------------------------------
+def runsimulation( hostname = "", simulationname = "default", simulation = None ):
+    logger = logging.getLogger('cxprometheus')
+
+    days    = simulation.get('days', 7)
+    seed    = simulation.get('seed', 1)
+    model   = dict()
+    if (simulation.get('fit') != None):
+        model = fitrecorded( simulation['fit'] )
+        if (model == None):
+            return None
+    for key in [ 'arrivals', 'loc', 'durations' ]:
+        if (simulation.get(key) != None):
+            model[key] = simulation[key]
+    if ('arrivals' not in model) or ('durations' not in model):
+        logger.critical( "Unable to simulate, arrivals or durations missing and not fitted" )
+        return None
+    baseline = simulationengines( simulation.get('engines'), hostname )
+
+    scenarios = collections.OrderedDict( [ ( "baseline", {} ) ] )
+    scenarios.update( simulation.get('whatif', {}) )
+    sreport = dict()
+    sreport['simulation']   = simulationname
+    sreport['definition']   = simulation
+    sreport['model']        = model
+    sreport['started']      = datetime.datetime.now().isoformat()
+    sreport['scenarios']    = collections.OrderedDict()
+    for name, whatif in scenarios.items():
+        clock   = time.time()
+        engines = baseline
+        if (whatif.get('engines') != None):
+            engines = simulationengines( whatif['engines'] )
+        engines = engines + simulationengines( whatif.get('addEngines', []) )
+        # Same seed for all the scenarios, so that they are compared on the same load
+        rng   = random.Random( seed )
+        scans = generatescans( rng, days, model['arrivals'], model.get('loc'), model['durations'],
+                               whatif.get('arrivalFactor', 1.0), whatif.get('durationFactor', 1.0) )
+        res = simulate( engines, scans, days )
+        res['seconds'] = round( time.time() - clock, 3 )
+        sreport['scenarios'][name] = res
+        logger.info( "Simulation " + name + ": " + str(res['scans']) + " scans on " + str(res['capacity']) + " slots, queue wait minutes " +
+                     str(res['queueWaitMinutes']) + ", utilization " + str(res['utilization']) + ", unserved " + str(res['unserved']) )
+    # Write report
+    if (not os.path.isdir(_reportfolder)):
+        os.mkdir(_reportfolder)
+    reportname = _reportfolder + os.path.sep + "simulate_" + simulationname + "_" + \
+                 datetime.datetime.now().strftime("%Y%m%d_%H%M%S") + ".json"
+    fp = open(reportname, 'w')
     try:
+        json.dump(sreport, fp, indent = 2)
+    finally:
+        fp.close()
+    logger.info( "Simulation report written to " + reportname )
+    return reportname
+
+
+
 
-        while (True):
+if __name__ == '__main__':
 
-            #stoken = cxlogon( _hostname, _username, _password)
-            stoken = cxlogon( _hostname, "prometheus", "Cx123456!")
+    # Capacity simulation, no scans are started: cxstresser.py --simulate [name]
+    if (len(sys.argv) > 1) and (sys.argv[1] == "--simulate"):
+        if (loadconfigurations( False ) == False):
+            sys.exit(70)
+        if (len(sys.argv) > 2):
+            _simulationname = sys.argv[2]
+        simulation = loadsimulation( _simulationname )
+        if (simulation == None):
+            sys.exit(70)
+        try:
+            reportfile = runsimulation( _hostname, _simulationname, simulation )
+        finally:
+            cleanup()
+        if (reportfile == None):
+            sys.exit(70)
+        sys.exit(0)
+
+    # Load and check configurations
+    if (loadconfigurations() == False):
+        sys.exit(70)
 
-            scanstostart = computecargo( _hostname, stoken )
+    # Scenario to run, from the scenarios file
+    if (len(sys.argv) > 1):
+        _scenarioname = sys.argv[1]
+    scenario = loadscenario( _scenarioname )
+    if (scenario == None):
+        sys.exit(70)
 
-            if (scanstostart > 0):
-                startscans( _hostname, stoken, scanstostart )
+    try:
 
-            time.sleep(60)      # Wait a minute
+        runscenario( _hostname, _scenarioname, scenario )
 
     finally:
         # Log finish
         cleanup()
-
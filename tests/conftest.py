@@ -0,0 +1,23 @@
+import collections
+import os
+import sys
+
+import pytest
+
+sys.path.insert( 0, os.path.join( os.path.dirname( os.path.dirname( os.path.abspath(__file__) ) ), "src" ) )
+
+import cxprometheus
+
+
+@pytest.fixture
+def target(monkeypatch):
+    # A single unnamed SAST target, never actually requested
+    monkeypatch.setattr( cxprometheus, "_targets", collections.OrderedDict( [ ( "", { 'hostname': "http://sast", 'username': "user",
+                                                                                      'password': "password", 'gen': 1 } ) ] ) )
+    return "http://sast"
+
+
+@pytest.fixture
+def engines():
+    return [ { "id": 1, "name": "small", "minLoc": 0, "maxLoc": 99999, "maxScans": 2, "status": { "id": 1, "value": "Idle" } },
+             { "id": 2, "name": "large", "minLoc": 50000, "maxLoc": 999999999, "maxScans": 1, "status": { "id": 1, "value": "Idle" } } ]
@@ -0,0 +1,41 @@
+import time
+
+import cxprometheus
+
+
+def queryindex( labeltarget = False ):
+    # Scans 1 to 6, scan N in the queue for N minutes, the even ones queued for N / 2 minutes
+    snapshot = { cxprometheus._metric5_name: [], cxprometheus._metric3_name: [] }
+    for scanid in range( 1, 7 ):
+        labels = ( [ "a" ] if (labeltarget) else [] ) + [ str(scanid), str( scanid % 2 + 1 ), "engine", "0", "999999999", "", "" ]
+        snapshot[cxprometheus._metric5_name].append( ( labels, float(scanid) ) )
+        if (scanid % 2 == 0):
+            snapshot[cxprometheus._metric3_name].append( ( labels, scanid / 2.0 ) )
+    return cxprometheus.CxQueryIndex( [ snapshot ], time.time(), labeltarget )
+
+
+def scanids( records ):
+    return [ scan['scanId'] for scan in records[0] ], records[1]
+
+
+def test_scanrecords_pages():
+    index = queryindex()
+    assert scanids( index.scanrecords( limit = 4 ) ) == ( [ 1, 2, 3, 4 ], 6 )
+    assert scanids( index.scanrecords( limit = 4, offset = 4 ) ) == ( [ 5, 6 ], 6 )
+    assert scanids( index.scanrecords( limit = 4, offset = 8 ) ) == ( [], 6 )
+    assert scanids( index.scanrecords( stage = "queued", limit = 2, offset = 1 ) ) == ( [ 4, 6 ], 3 )
+    assert scanids( index.scanrecords( engineid = "1", limit = 2, offset = 1 ) ) == ( [ 4, 6 ], 3 )
+
+
+def test_scanrecords_oldest_first():
+    index = queryindex()
+    assert scanids( index.scanrecords( olderthan = 2.5, limit = 3 ) ) == ( [ 6, 5, 4 ], 4 )
+    assert scanids( index.scanrecords( olderthan = 2.5, limit = 3, offset = 3 ) ) == ( [ 3 ], 4 )
+    assert scanids( index.scanrecords( stage = "queued", olderthan = 1.5, limit = 1, offset = 1 ) ) == ( [ 4 ], 2 )
+    assert scanids( index.scanrecords( engineid = "2", olderthan = 2.5 ) ) == ( [ 5, 3 ], 2 )
+
+
+def test_scanrecords_by_target():
+    index = queryindex( True )
+    assert scanids( index.scanrecords( target = "a", stage = "queued", limit = 1, offset = 2 ) ) == ( [ 6 ], 3 )
+    assert scanids( index.scanrecords( target = "b", stage = "queued" ) ) == ( [], 0 )
@@ -0,0 +1,125 @@
+import datetime
+import json
+import time
+
+import pytest
+
+import cxprometheus
+
+
+def sastdate( minutesago, fraction = True ):
+    # SAST dates are local times, with or without milliseconds
+    thedate = datetime.datetime.now() - datetime.timedelta( minutes = minutesago )
+    if (fraction):
+        return thedate.strftime( "%Y-%m-%dT%H:%M:%S.%f" )[:-3]
+    return thedate.strftime( "%Y-%m-%dT%H:%M:%S" )
+
+
+def scansqueue():
+    scans = []
+    for idx in range(60):
+        stage = [ 1, 2, 3, 3, 4, 6, 10, 7 ][ idx % 8 ]
+        engine = [ None, { "id": 1 }, { "id": 2 }, { "id": 9 } ][ idx % 4 ]
+        scan = { "id": 1000 + idx, "stage": { "id": stage }, "engine": engine, "dateCreated": sastdate( 90 + idx, idx % 2 == 0 ) }
+        if (idx % 5 != 0):
+            scan["queuedOn"] = sastdate( 60 + idx )
+        if (idx % 7 != 0):
+            scan["engineStartedOn"] = sastdate( 30 + idx, False )
+        if (idx % 3 == 0):
+            scan["completedOn"] = sastdate( idx / 2.0 )
+        scans.append( scan )
+    return scans
+
+
+def bylabels( samples, name ):
+    return dict( [ ( tuple(labels), value ) for labels, value in samples[name] ] )
+
+
+def test_scancolumns_match_scansamples(monkeypatch, engines):
+    numpy = pytest.importorskip( "numpy" )
+    monkeypatch.setattr( cxprometheus, "numpy", numpy )
+    collector = cxprometheus.CxCollector()
+    scans = scansqueue()
+    details = { 1004: [ "project", "team" ] }
+    bysample = dict( [ ( metric[0], [] ) for metric in cxprometheus._metrics ] )
+    bycolumn = dict( [ ( metric[0], [] ) for metric in cxprometheus._metrics ] )
+    assert collector.scansamples( engines, scans, bysample, details ) == collector.scancolumns( engines, scans, bycolumn, details )
+    for name in [ cxprometheus._metric2_name, cxprometheus._metric3_name, cxprometheus._metric4_name, cxprometheus._metric5_name ]:
+        expected = bylabels( bysample, name )
+        columns  = bylabels( bycolumn, name )
+        assert expected != {}
+        assert columns.keys() == expected.keys()
+        for labels, value in expected.items():
+            assert columns[labels] == pytest.approx( value, abs = 0.01 )
+
+
+def test_engine_slots_follow_scans(engines):
+    collector = cxprometheus.CxCollector()
+    running = [ { "id": 1001, "stage": { "id": 4 }, "engine": { "id": 1 } },
+                { "id": 1002, "stage": { "id": 3 }, "engine": { "id": 1 } },
+                { "id": 1003, "stage": { "id": 4 }, "engine": { "id": 1 } },
+                { "id": 1004, "stage": { "id": 6 }, "engine": { "id": 2 } },
+                { "id": 1005, "stage": { "id": 4 }, "engine": None } ]
+    collector.updateengines( engines, running )
+    assert [ ( key, iengine[6], iengine[7] ) for key, iengine in collector.enginelist.items() ] == \
+           [ ( "1_1", 1001, "Scanning" ), ( "1_2", 1002, "Queued" ), ( "2_1", 1004, "Scanning" ) ]
+    # Slots freed by the scans that completed, or moved to another engine, are taken again
+    running = [ { "id": 1001, "stage": { "id": 7 }, "engine": { "id": 1 } },
+                { "id": 1002, "stage": { "id": 4 }, "engine": { "id": 2 } },
+                { "id": 1003, "stage": { "id": 4 }, "engine": { "id": 1 } } ]
+    collector.updateengines( engines, running )
+    assert [ ( key, iengine[6], iengine[7] ) for key, iengine in collector.enginelist.items() ] == \
+           [ ( "1_1", 1003, "Scanning" ), ( "1_2", 0, "Idle" ), ( "2_1", 1002, "Scanning" ) ]
+
+
+def polls():
+    # Two polls of the same queue, 10 minutes apart: a scan starts, another one completes
+    first  = [ { "id": 1001, "stage": { "id": 3 }, "engine": { "id": 1 }, "queuedOn": sastdate( 20 ) },
+               { "id": 1002, "stage": { "id": 4 }, "engine": { "id": 2 }, "queuedOn": sastdate( 40 ), "engineStartedOn": sastdate( 30 ) } ]
+    second = [ { "id": 1001, "stage": { "id": 4 }, "engine": { "id": 1 }, "queuedOn": sastdate( 20 ), "engineStartedOn": sastdate( 5 ) },
+               { "id": 1002, "stage": { "id": 7 }, "engine": { "id": 2 }, "queuedOn": sastdate( 40 ), "engineStartedOn": sastdate( 30 ),
+                 "completedOn": sastdate( 2 ) },
+               { "id": 1003, "stage": { "id": 3 }, "engine": None, "queuedOn": sastdate( 1 ) } ]
+    return [ ( time.time() - 600, first ), ( time.time(), second ) ]
+
+
+def warmcollector( monkeypatch, target, engines ):
+    # A collector holding the state of two polls, and a token
+    monkeypatch.setattr( cxprometheus, "cxlogon", lambda hostname, username, password, session = None: "token" )
+    collector = cxprometheus.CxCollector()
+    collector.checkstate( target )
+    collector.gettoken()
+    collector.lastpoll = time.time() - 3600
+    for scannow, scans in polls():
+        collector.updateengines( engines, scans )
+        collector.updatescans( engines, scans, scannow )
+    return collector
+
+
+def test_state_round_trip(monkeypatch, target, engines):
+    collector = warmcollector( monkeypatch, target, engines )
+    state = collector.getstate()
+    assert state['token'] == "token"
+    assert [ iengine[0:2] + iengine[7:] for iengine in state['engines'] ] == [ [ "1_1", 1, 1001, "Scanning" ], [ "1_2", 1, 0, "Idle" ], [ "2_1", 2, 0, "Idle" ] ]
+    assert dict( [ ( istarted[0], istarted[1] ) for istarted in state['started'] ] ) == { "1": 1, "2": 1 }
+    assert [ "2", "finished", 1 ] in state['finished']
+    assert [ iestimator[0] for iestimator in state['estimators'] ] == [ "2" ]
+    # State files hold json documents
+    restored = cxprometheus.CxCollector()
+    assert restored.setstate( json.loads( json.dumps(state) ) )
+    assert restored.getstate() == state
+    assert restored.estimators["2"].quantile( 0.5 ) == collector.estimators["2"].quantile( 0.5 )
+    assert restored.estimators["2"].rate( time.time() ) == pytest.approx( collector.estimators["2"].rate( time.time() ) )
+    # Transitions carry on from the restored scans states
+    scannow, scans = polls()[1]
+    restored.updatescans( engines, scans, scannow )
+    assert restored.started == collector.started
+    assert restored.finished == collector.finished
+
+
+def test_state_of_another_host_ignored(monkeypatch, target, engines):
+    state = warmcollector( monkeypatch, target, engines ).getstate()
+    state['host'] = "http://other"
+    restored = cxprometheus.CxCollector()
+    assert not restored.setstate( state )
+    assert restored.getstate()['engines'] == []
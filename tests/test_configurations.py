@@ -0,0 +1,55 @@
+import json
+
+import pytest
+
+import cxprometheus
+
+
+@pytest.fixture
+def configfile(monkeypatch, tmp_path):
+    # A valid configurations file in use, the module settings restored afterwards
+    for name, value in list( vars(cxprometheus).items() ):
+        if (name.startswith("_")) and (not name.startswith("__")) and (not callable(value)):
+            monkeypatch.setattr( cxprometheus, name, value )
+    filename = tmp_path / "configs.json"
+    monkeypatch.setattr( cxprometheus, "_configfile", str(filename) )
+    def write( **values ):
+        configs = { "hostname": "http://sast", "username": "user", "password": "password", "promport": 9700, "stateinterval": 0 }
+        configs.update( values )
+        filename.write_text( json.dumps(configs) )
+    write()
+    cxprometheus.applyconfigurations( cxprometheus.readconfigurations() )
+    return write
+
+
+def test_wrong_types_reported(configfile):
+    configfile( promport = "9700", pollinterval = "60", api = "yes", remotewritelabels = [], loglevel = "debug" )
+    errors = cxprometheus.checkconfigurations( cxprometheus.readconfigurations() )
+    assert errors == [ "Invalid value in configuration (promport), shall be an integer",
+                       "Invalid value in configuration (loglevel), shall be an integer",
+                       "Invalid value in configuration (pollinterval), shall be a number",
+                       "Invalid value in configuration (api), shall be true or false",
+                       "Invalid value in configuration (remotewritelabels), shall be an object" ]
+
+
+def test_target_wrong_types_reported(configfile):
+    configfile( targets = [ { "name": "a", "hostname": "http://a", "password": 1 } ] )
+    errors = cxprometheus.checkconfigurations( cxprometheus.readconfigurations() )
+    assert errors == [ "Invalid value in configuration (targets, a, password), shall be a string" ]
+
+
+def test_reload_keeps_configurations_of_wrong_type(configfile):
+    configfile( promport = "9700" )
+    assert cxprometheus.reloadconfigurations() == False
+    assert cxprometheus._promport == 9700
+
+
+def test_reload_failure_keeps_configurations(configfile):
+    class Failing(object):
+        def configure(self):
+            raise RuntimeError( "configure failed" )
+    inuse = cxprometheus._configs
+    configfile( pollinterval = 0, stateinterval = 30 )
+    assert cxprometheus.reloadconfigurations( Failing() ) == False
+    assert cxprometheus._configs is inuse
+    assert cxprometheus._stateinterval == 0
@@ -0,0 +1,89 @@
+import math
+import random
+
+import pytest
+
+import cxprometheus
+
+
+def lognormal( count, seed = 7 ):
+    # Scan durations in minutes, median 20, the way real queues spread
+    generator = random.Random( seed )
+    return [ generator.lognormvariate( math.log(20), 0.5 ) for idx in range(count) ]
+
+
+def test_sketch_tracks_lognormal_stream():
+    values = lognormal( 20000 )
+    sketch = cxprometheus.CxSketch()
+    for value in values:
+        sketch.observe( value, 1000.0 )
+    ordered = sorted( values )
+    assert sketch.weight() == pytest.approx( len(values) )
+    assert sketch.mean() == pytest.approx( sum(values) / len(values), rel = 0.001 )
+    assert sketch.quantile( 0.5 ) == pytest.approx( ordered[ len(values) // 2 ], rel = 0.05 )
+    assert sketch.quantile( 0.9 ) == pytest.approx( ordered[ int( len(values) * 0.9 ) ], rel = 0.05 )
+
+
+def test_sketch_rate_of_steady_stream():
+    # 10 scans a minute, for 8 estimator windows
+    sketch = cxprometheus.CxSketch()
+    values = lognormal( int( 8 * cxprometheus._estimatorwindow / 6 ) )
+    for idx, value in enumerate( values ):
+        sketch.observe( value, idx * 6.0 )
+    now = len(values) * 6.0
+    assert sketch.rate( now ) == pytest.approx( 10.0, rel = 0.01 )
+    # Without completions the rate fades away, over the window
+    assert sketch.rate( now + cxprometheus._estimatorwindow ) == pytest.approx( 10.0 / math.e, rel = 0.01 )
+
+
+def test_sketch_older_observations_weigh_less():
+    sketch = cxprometheus.CxSketch()
+    sketch.observe( 10.0, 2 * cxprometheus._estimatorwindow )
+    sketch.observe( 100.0, cxprometheus._estimatorwindow )
+    assert sketch.weight() == pytest.approx( 1.0 + 1.0 / math.e )
+    assert sketch.mean() == pytest.approx( ( 10.0 + 100.0 / math.e ) / ( 1.0 + 1.0 / math.e ) )
+
+
+def test_topseries_keeps_budget_and_sums_others():
+    samples = [ ( [ "a" if (idx % 3) else "b", str(idx) ], float( ( idx * 37 ) % 101 ) ) for idx in range(200) ]
+    kept, others = cxprometheus.topseries( samples, 10, True )
+    assert len(kept) == 10
+    assert sorted( [ value for labels, value in kept ] ) == sorted( [ value for labels, value in samples ] )[-10:]
+    assert sum( [ count for prefix, total, count in others ] ) == 190
+    for prefix, total, count in others:
+        assert total == pytest.approx( sum( [ value for labels, value in samples if (labels[0] == prefix[0]) ] )
+                                       - sum( [ value for labels, value in kept if (labels[0] == prefix[0]) ] ) )
+    kept, others = cxprometheus.topseries( samples, 10 )
+    assert others == [ ( [], pytest.approx( sum( [ value for labels, value in samples ] ) - sum( [ value for labels, value in kept ] ) ), 190 ) ]
+
+
+def test_locindex_band_counts(engines):
+    locindex = cxprometheus.CxLocIndex( [ ( engine["id"], engine["minLoc"], engine["maxLoc"] ) for engine in engines ] )
+    assert locindex.labels == [ ( "0", "49999" ), ( "50000", "99999" ), ( "100000", "999999999" ), ( "1000000000", "+Inf" ) ]
+    assert locindex.engines == [ [ 1 ], [ 1, 2 ], [ 2 ], [] ]
+    counts, cumulative = locindex.demand( [ 0, 49999, 50000, 99999, 100000, 5000000000 ] )
+    assert counts == [ 2, 2, 1, 1 ]
+    assert cumulative == [ 0, 2, 4, 5, 6 ]
+    assert locindex.between( cumulative, 0, 99999 ) == 4
+    assert locindex.between( cumulative, 50000, 999999999 ) == 3
+    assert locindex.capacity( { 1: 2, 2: 1 } ) == [ 2, 3, 1, 0 ]
+
+
+def test_detailcache_evicts_least_recently_used(monkeypatch):
+    monkeypatch.setattr( cxprometheus, "_enrichcache", 2 )
+    cache = cxprometheus.CxDetailCache()
+    cache.put( ( "project", 1 ), { "id": 1 }, 100 )
+    cache.put( ( "project", 2 ), { "id": 2 }, 100 )
+    assert cache.get( ( "project", 1 ), 0 ) == ( True, { "id": 1 } )
+    cache.put( ( "project", 3 ), { "id": 3 }, 100 )
+    assert cache.get( ( "project", 2 ), 0 ) == ( False, None )
+    assert cache.get( ( "project", 1 ), 0 ) == ( True, { "id": 1 } )
+    assert cache.get( ( "project", 3 ), 0 ) == ( True, { "id": 3 } )
+
+
+def test_detailcache_expires_entries():
+    cache = cxprometheus.CxDetailCache()
+    cache.put( ( "scan", 1 ), None, 10 )
+    assert cache.get( ( "scan", 1 ), 9 ) == ( True, None )
+    assert cache.get( ( "scan", 1 ), 10 ) == ( False, None )
+    assert ( "scan", 1 ) not in cache.entries
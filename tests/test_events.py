@@ -0,0 +1,69 @@
+import collections
+import io
+import json
+import time
+
+import cxprometheus
+
+
+def post( application, body, token = "secret" ):
+    environ = { 'REQUEST_METHOD': "POST", 'PATH_INFO': "/events", 'CONTENT_LENGTH': str(len(body)),
+                'wsgi.input': io.BytesIO(body), 'HTTP_AUTHORIZATION': "Bearer " + token }
+    status = []
+    content = b"".join( application( environ, lambda code, headers: status.append(code) ) )
+    return status[0], json.loads( content or b"null" )
+
+
+def eventscollector( monkeypatch, target, engines ):
+    monkeypatch.setattr( cxprometheus, "_events", True )
+    monkeypatch.setattr( cxprometheus, "_eventstoken", "secret" )
+    collector = cxprometheus.CxCollector()
+    collector.statehost = target
+    collector.engines   = engines
+    collector.scans     = collections.OrderedDict()
+    collector.polled    = time.time()
+    return collector
+
+
+def test_checkevent_rejects_invalid_details():
+    assert cxprometheus.checkevent( { "scanId": 999999, "stage": 3, "loc": "12k" } ) == None
+    assert cxprometheus.checkevent( { "scanId": 999999, "stage": 3, "loc": -1 } ) == None
+    assert cxprometheus.checkevent( { "scanId": 999999, "stage": 3, "project": "p" } ) == None
+    assert cxprometheus.checkevent( { "scanId": 999999, "stage": 3, "project": { "id": "5" } } ) == None
+    assert cxprometheus.checkevent( { "scanId": 999999, "stage": 3, "teamId": [ 1 ] } ) == None
+    checked = cxprometheus.checkevent( { "scanId": 999999, "stage": "Queued", "loc": 1200, "project": { "id": 5, "name": "p" }, "teamId": "1" } )
+    assert checked["stage"] == 3
+    assert checked["loc"] == 1200
+
+
+def test_events_ingested_into_snapshot(monkeypatch, target, engines):
+    collector = eventscollector( monkeypatch, target, engines )
+    application = cxprometheus.eventsapp( collector )
+    events = [ { "scanId": 1001, "stage": "Queued", "loc": 70000 },
+               { "scanId": 1002, "stage": "Scanning", "engineId": 1, "loc": 1000 },
+               { "scanId": 1003, "stage": 3, "loc": "12k" } ]
+    status, result = post( application, json.dumps(events).encode('utf-8') )
+    assert status.startswith("202")
+    assert result == { 'received': 3, 'invalid': 1, 'applied': 2 }
+    samples = collector.snapshot()
+    assert [ labels[0] for labels, value in samples[cxprometheus._metric3_name] ] == [ "1001" ]
+    assert [ labels[0:2] for labels, value in samples[cxprometheus._metric4_name] ] == [ [ "1002", "1" ] ]
+    assert samples[cxprometheus._metric16_name] == [ ( [], 1 ) ]
+    demand = dict( [ ( tuple(labels), value ) for labels, value in samples[cxprometheus._metric27_name] ] )
+    assert demand[ ( "50000", "99999" ) ] == 1
+
+
+def test_events_request_checks(monkeypatch, target, engines):
+    application = cxprometheus.eventsapp( eventscollector( monkeypatch, target, engines ) )
+    assert post( application, b"" )[0].startswith("400")
+    assert post( application, b"{" )[0].startswith("400")
+    assert post( application, b"{}", token = "wrong" )[0].startswith("401")
+
+
+def test_events_require_token():
+    configs = cxprometheus.readconfigurations()
+    configs.update( { 'targets': [ { 'name': "", 'hostname': "http://sast", 'username': "user", 'password': "password" } ],
+                      'hostname': "http://sast", 'username': "user", 'password': "password", 'events': True, 'eventstoken': "" } )
+    assert "Scan events endpoint (events) requires a bearer token in configuration (eventstoken)" in cxprometheus.checkconfigurations( configs )
+    configs['eventstoken'] = "secret"
+    assert cxprometheus.checkconfigurations( configs ) == []
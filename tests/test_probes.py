@@ -0,0 +1,70 @@
+import concurrent.futures
+import ssl
+import threading
+
+import cxprometheus
+
+
+def probecollector( monkeypatch, engines ):
+    # A collector probing the engines, without any request
+    monkeypatch.setattr( cxprometheus, "concurrent", concurrent )
+    monkeypatch.setattr( cxprometheus, "_probeinterval", 0.05 )
+    collector = cxprometheus.CxCollector()
+    collector.engines = [ dict( engine, uri = "http://engine%d" % engine["id"] ) for engine in engines ]
+    collector.polled  = 1
+    collector.rounds  = threading.Semaphore(0)
+    def probeengine( engine ):
+        collector.rounds.release()
+        return 1, 0.01
+    monkeypatch.setattr( collector, "probeengine", probeengine )
+    return collector
+
+
+def test_probes_start_once(monkeypatch, target, engines):
+    collector = probecollector( monkeypatch, engines )
+    try:
+        collector.startprobing()
+        collector.startprobing()
+        for attempt in range(100):
+            if (collector.probes != {}):
+                break
+            threading.Event().wait( 0.05 )
+        assert len( [ thread for thread in threading.enumerate() if thread.name == "cxprober" ] ) == 1
+        samples = collector.probes
+        assert samples[1] == [ "small", 1, 0.01 ]
+        assert samples[2] == [ "large", 1, 0.01 ]
+    finally:
+        collector.close()
+
+
+def test_probes_restart_when_enabled_again(monkeypatch, target, engines):
+    collector = probecollector( monkeypatch, engines )
+    try:
+        collector.startprobing()
+        assert collector.rounds.acquire( timeout = 5 )
+        monkeypatch.setattr( cxprometheus, "_probeinterval", 0 )
+        for attempt in range(100):
+            if (not collector.probing):
+                break
+            threading.Event().wait( 0.05 )
+        assert not collector.probing
+        monkeypatch.setattr( cxprometheus, "_probeinterval", 0.05 )
+        collector.startprobing()
+        assert collector.probing
+        while collector.rounds.acquire( blocking = False ):
+            pass
+        assert collector.rounds.acquire( timeout = 5 )
+    finally:
+        collector.close()
+
+
+def test_probes_not_started_once_closed(monkeypatch, target, engines):
+    collector = probecollector( monkeypatch, engines )
+    collector.close()
+    collector.startprobing()
+    assert not collector.probing
+
+
+def test_probes_accept_self_signed_certificates():
+    assert cxprometheus._probecontext.check_hostname == False
+    assert cxprometheus._probecontext.verify_mode == ssl.CERT_NONE
@@ -0,0 +1,136 @@
+import struct
+
+import pytest
+
+import cxprometheus
+
+
+def varint( data, pos ):
+    value = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        shift += 7
+        if (byte < 0x80):
+            return value, pos
+
+
+def fields( data ):
+    # Protobuf fields, as ( number, wire type, value )
+    pos = 0
+    while (pos < len(data)):
+        key, pos = varint( data, pos )
+        number, wiretype = key >> 3, key & 7
+        if (wiretype == 0):
+            value, pos = varint( data, pos )
+        elif (wiretype == 1):
+            value, pos = struct.unpack( "<d", data[pos:pos + 8] )[0], pos + 8
+        elif (wiretype == 2):
+            size, pos = varint( data, pos )
+            value, pos = data[pos:pos + size], pos + size
+        else:
+            raise ValueError( "unexpected wire type %d" % wiretype )
+        yield number, wiretype, value
+
+
+def unsnappy( block ):
+    # Snappy block format decoder, literals and copies
+    size, pos = varint( block, 0 )
+    data = bytearray()
+    while (pos < len(block)):
+        tag = block[pos]
+        pos += 1
+        if (tag & 3 == 0):
+            length = tag >> 2
+            if (length >= 60):
+                extra = length - 59
+                length = int.from_bytes( block[pos:pos + extra], "little" )
+                pos += extra
+            length += 1
+            data.extend( block[pos:pos + length] )
+            pos += length
+        else:
+            if (tag & 3 == 1):
+                length = ((tag >> 2) & 7) + 4
+                offset = ((tag >> 5) << 8) | block[pos]
+                pos += 1
+            elif (tag & 3 == 2):
+                length = (tag >> 2) + 1
+                offset = int.from_bytes( block[pos:pos + 2], "little" )
+                pos += 2
+            else:
+                length = (tag >> 2) + 1
+                offset = int.from_bytes( block[pos:pos + 4], "little" )
+                pos += 4
+            for idx in range(length):
+                data.append( data[-offset] )
+    assert len(data) == size
+    return bytes(data)
+
+
+def decode( request ):
+    # WriteRequest { TimeSeries timeseries = 1 }, TimeSeries { Label labels = 1, Sample samples = 2 }
+    series = []
+    for number, wiretype, timeseries in fields( request ):
+        assert number == 1
+        labels = []
+        samples = []
+        for fnumber, fwiretype, value in fields( timeseries ):
+            if (fnumber == 1):
+                label = dict( [ ( lnumber, lvalue.decode('utf-8') ) for lnumber, lwiretype, lvalue in fields( value ) ] )
+                labels.append( ( label[1], label[2] ) )
+            else:
+                samples.append( dict( [ ( snumber, svalue ) for snumber, swiretype, svalue in fields( value ) ] ) )
+        assert len(samples) == 1
+        series.append( ( labels, samples[0][1], samples[0][2] ) )
+    return series
+
+
+SERIES = [ ( [ ( "__name__", "checkmarx_sast_queue_length" ), ( "job", "cxprometheus" ) ], 12.0, 1792359592478 ),
+           ( [ ( "__name__", "checkmarx_sast_scans_queued" ), ( "engineName", "moteur ü" ), ( "scanId", "1001" ) ], 0.25, 1792359592478 ) ]
+
+
+def test_remotewriterequest_fallback_roundtrip(monkeypatch):
+    monkeypatch.setattr( cxprometheus, "snappy", None )
+    series = SERIES * 40                            # over 60 bytes, and over one 64k literal with more
+    assert decode( unsnappy( cxprometheus.remotewriterequest( series ) ) ) == series
+    big = [ ( [ ( "__name__", "x" * 70000 ) ], 1.0, 1 ) ]
+    assert decode( unsnappy( cxprometheus.remotewriterequest( big ) ) ) == big
+
+
+def test_remotewriterequest_snappy_roundtrip(monkeypatch):
+    snappy = pytest.importorskip( "snappy" )
+    monkeypatch.setattr( cxprometheus, "snappy", snappy )
+    series = SERIES * 40
+    request = cxprometheus.remotewriterequest( series )
+    assert decode( snappy.uncompress( request ) ) == series
+    assert decode( unsnappy( request ) ) == series
+
+
+def test_remotewrite_requires_polling():
+    configs = cxprometheus.readconfigurations()
+    configs.update( { 'hostname': "http://sast", 'username': "user", 'password': "password", 'remotewrite': "http://127.0.0.1:1/write" } )
+    assert cxprometheus.checkconfigurations( configs ) == [ "Remote write (remotewrite) requires background polling in configuration (pollinterval)" ]
+    configs['pollinterval'] = 60
+    assert cxprometheus.checkconfigurations( configs ) == []
+
+
+def test_poll_pushed_without_second_cycle(monkeypatch, target):
+    monkeypatch.setattr( cxprometheus, "_remotewrite", "http://127.0.0.1:1/write" )
+    monkeypatch.setattr( cxprometheus, "_remotewritespool", "" )
+    monkeypatch.setattr( cxprometheus, "_pollinterval", 60 )
+    aggregator = cxprometheus.CxAggregator()
+    cycles = []
+    def cycle():
+        cycles.append( 1 )
+        aggregator.pollstop.set()
+        return [ { cxprometheus._metric16_name: [ ( [], 3 ) ] } ]
+    aggregator.cycle = cycle
+    aggregator.poll()
+    exposed = dict( [ ( metric.name, metric ) for metric in aggregator.collect() ] )
+    assert cycles == [ 1 ]
+    assert exposed[cxprometheus._metric16_name].samples[0].value == 3
+    pushed = [ item for item in aggregator.writer.pending if (( "__name__", cxprometheus._metric16_name ) in item[0]) ]
+    assert [ ( item[1], item[2] ) for item in pushed ] == [ ( 3.0, int( aggregator.polledtime * 1000 ) ) ]